@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import librosa
+import threading
+import numpy as np
+
+from pathlib import Path
+from collections import OrderedDict
+
+
+# hop length of librosa.stft / melspectrogram defaults, one onset envelope frame per hop
+AUDIO_HOP_LENGTH = 2048 // 4
+
+# number of onset envelopes kept by audio_onset_envelope
+AUDIO_ENVELOPE_CACHE_SIZE = 8
+
+AUDIO_ENVELOPE_CACHE = OrderedDict()
+AUDIO_ENVELOPE_CACHE_LOCK = threading.Lock()
+
+
+# Percussive onset strength of audio_filepath from offset for duration seconds (to the end if None), one value per
+# AUDIO_HOP_LENGTH samples, along with its frame rate. Cached by key (e.g. the audio's cdn_id), else by file, plus the parameters
+def audio_onset_envelope(audio_filepath, offset=0.0, duration=None, margin=1.0, sr=None, key=None):
+    if key is None:
+        stat = Path(audio_filepath).stat()
+        key = (str(audio_filepath), stat.st_mtime, stat.st_size)
+    cache_key = (key, offset, duration, margin, sr)
+
+    with AUDIO_ENVELOPE_CACHE_LOCK:
+        if cache_key in AUDIO_ENVELOPE_CACHE:
+            AUDIO_ENVELOPE_CACHE.move_to_end(cache_key)
+            return AUDIO_ENVELOPE_CACHE[cache_key]
+
+    y, sr = librosa.load(audio_filepath, offset=offset, duration=duration, sr=sr)
+
+    # librosa.stft hardcoded defaults...
+    # n_fft defaults to 2048
+    # hop length is win_length // 4
+    # win_length defaults to n_fft
+    D = librosa.stft(y, n_fft=2048, hop_length=AUDIO_HOP_LENGTH, win_length=2048)
+
+    # Extract percussive elements
+    D_harmonic, D_percussive = librosa.decompose.hpss(D, margin=margin)
+    y_percussive = librosa.istft(D_percussive, length=len(y))
+
+    # Get melspectrogram peaks
+    spec_raw = librosa.feature.melspectrogram(y=y_percussive, sr=sr, hop_length=AUDIO_HOP_LENGTH)
+    envelope = (np.amax(spec_raw, axis=0), sr / AUDIO_HOP_LENGTH)
+
+    with AUDIO_ENVELOPE_CACHE_LOCK:
+        AUDIO_ENVELOPE_CACHE[cache_key] = envelope
+        while len(AUDIO_ENVELOPE_CACHE) > AUDIO_ENVELOPE_CACHE_SIZE:
+            AUDIO_ENVELOPE_CACHE.popitem(last=False)
+
+    return envelope
+
+
+# Interpolation timesteps of the duration seconds of an onset envelope starting offset seconds into it
+def timesteps_from_envelope(envelope, frame_rate, offset, duration, fps=30, smooth=0.0):
+    num_frames = int(duration * fps)
+    start = min(int(round(offset * frame_rate)), envelope.shape[-1])
+    end = min(int(round((offset + duration) * frame_rate)) + 1, envelope.shape[-1])
+    spec_max = envelope[start:end]
+
+    if spec_max.shape[-1] < 2 or np.ptp(spec_max) == 0:
+        # silent or past the end of the audio, interpolate linearly
+        return np.linspace(0.0, 1.0, num_frames)
+
+    # Normalize over the segment
+    spec_norm = (spec_max - np.min(spec_max)) / np.ptp(spec_max)
+
+    # Resize cumsum of spec norm to our desired number of interpolation frames
+    x_norm = np.linspace(0, spec_norm.shape[-1], spec_norm.shape[-1])
+    y_norm = np.cumsum(spec_norm)
+    y_norm /= y_norm[-1]
+    x_resize = np.linspace(0, y_norm.shape[-1], num_frames)
+
+    T = np.interp(x_resize, x_norm, y_norm)
+
+    # Apply smoothing
+    return T * (1 - smooth) + np.linspace(0.0, 1.0, T.shape[0]) * smooth
+
+
+# Interpolation timesteps of one span of audio_filepath, analysed on its own
+def get_timesteps_arr(audio_filepath, offset, duration, fps=30, margin=1.0, smooth=0.0, sr=None):
+    envelope, frame_rate = audio_onset_envelope(audio_filepath, offset=offset, duration=duration, margin=margin, sr=sr)
+    return timesteps_from_envelope(envelope, frame_rate, 0.0, duration, fps=fps, smooth=smooth)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import time
+import queue
+import threading
+
+from concurrent.futures import Future
+
+
+class InferenceBatcher:
+    """Coalesces compatible inference requests into a single pipeline call.
+
+    Callers `submit` a request together with a compatibility `key` (model, resolution,
+    steps, ...) and a `run_batch` function. A single scheduler thread takes the first
+    pending request, keeps collecting requests for up to `max_wait` seconds or until
+    `max_batch_size` requests share its key, then calls `run_batch` once per key with
+    the list of requests. `run_batch` must return one result per request, in order.
+    Requests with a different key that arrived inside the window are run as their own
+    batches, so nothing waits longer than one window plus the batches ahead of it.
+    """
+
+    def __init__(self, max_batch_size=4, max_wait=0.05):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.batches_run = 0
+        self.requests_run = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+                self._thread.start()
+
+    # Blocks until the request's batch has run, returns its result or raises its exception
+    def submit(self, key, run_batch, request):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((key, run_batch, request, future))
+        return future.result()
+
+    def _collect(self):
+        first = self._queue.get()
+        batches = {first[0]: [first]}
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batches[first[0]]) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batches.setdefault(item[0], []).append(item)
+
+        return batches
+
+    def _execute(self, items):
+        run_batch = items[0][1]
+        requests = [item[2] for item in items]
+        futures = [item[3] for item in items]
+
+        try:
+            results = run_batch(requests)
+            if len(results) != len(requests):
+                raise ValueError(f'Batch returned {len(results)} results for {len(requests)} requests')
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        self.batches_run += 1
+        self.requests_run += len(requests)
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            batches = self._collect()
+            for items in batches.values():
+                for start in range(0, len(items), self.max_batch_size):
+                    self._execute(items[start:start + self.max_batch_size])
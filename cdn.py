@@ -1,5 +1,17 @@
-import requests
+import io
+import os
+import time
+import atexit
 import base64
+import random
+import shutil
+import hashlib
+import requests
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from disk_cache import DiskCache
 from utils import fetch_env_config
 
 config = fetch_env_config()
@@ -14,51 +26,293 @@ ACCESS_KEY_AUDIO = config['storage_access_key_audio']
 STORAGE_ZONE_VIDEO = config['storage_zone_video']
 ACCESS_KEY_VIDEO = config['storage_access_key_video']
 
+# keep-alive connections kept per storage zone (and host)
+CDN_POOL_SIZE = int(config.get('cdn_pool_size', 10))
+# threads running background uploads / deletes
+CDN_UPLOAD_WORKERS = int(config.get('cdn_upload_workers', 4))
+# background uploads queued or running before callers block until one finishes
+CDN_MAX_PENDING_UPLOADS = int(config.get('cdn_max_pending_uploads', 64))
+# retries of a failed PUT (uploads are idempotent), with jittered exponential backoff starting at CDN_UPLOAD_BACKOFF seconds
+CDN_UPLOAD_RETRIES = int(config.get('cdn_upload_retries', 3))
+CDN_UPLOAD_BACKOFF = float(config.get('cdn_upload_backoff', 0.5))
 
-#############################
-########## IMAGES ###########
-#############################
+# downloads are cached on disk, CDN objects are never overwritten (every upload gets a new cdn_id). 0 disables the cache
+CDN_CACHE_DIR = config.get('cdn_cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cdn_cache'))
+CDN_CACHE_MAX_GB = float(config.get('cdn_cache_max_gb', 5))
 
+# failed uploads of files are copied here until cronjobs/reconcile_uploads.py re-uploads them, instead of into the database
+CDN_PENDING_DIR = config.get('cdn_pending_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pending_uploads'))
 
-# returns image (either full or thumbnail) in binary, or None if not found
-def download_image_from_cdn(user_id, image_id, image_type='full'):
-    url = f'https://storage.bunnycdn.com/{STORAGE_ZONE_NAME}/{user_id}/{image_id}-{image_type}.png'
+# zone -> storage zone name
+STORAGE_ZONES = {
+    'image': STORAGE_ZONE_NAME,
+    'audio': STORAGE_ZONE_AUDIO,
+    'video': STORAGE_ZONE_VIDEO
+}
 
-    headers = {
-        "AccessKey": ACCESS_KEY
-    }
 
-    response = requests.get(url, headers=headers)
-    # image not found
+#############################
+########## CLIENT ###########
+#############################
+
+
+class CDNClient:
+    """Pooled keep-alive sessions per storage zone and a bounded executor for background uploads.
+
+    Each zone has one `requests.Session` carrying its AccessKey, so requests reuse warm TLS
+    connections instead of opening a new one per call. `submit` runs work (uploads, deletes) on
+    at most `workers` threads; once `max_pending` jobs are queued or running it blocks the caller
+    until one finishes, so bursts apply backpressure instead of piling up threads and memory.
+    `flush` waits for everything submitted so far, `shutdown` (registered with atexit) flushes
+    and closes the sessions.
+    """
+
+    def __init__(self, zones, workers=CDN_UPLOAD_WORKERS, max_pending=CDN_MAX_PENDING_UPLOADS, pool_size=CDN_POOL_SIZE):
+        self.zones = zones
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cdn-upload')
+        # single requests fanned out by an upload (e.g. full + thumbnail), separate from the upload executor
+        # so an upload waiting on its parts can never starve them of threads
+        self._transfers = ThreadPoolExecutor(max_workers=workers * 2, thread_name_prefix='cdn-transfer')
+        # called with (zone, path, data, error, source_path) once a PUT has used up its retries, see db.record_pending_upload.
+        # Failed file uploads are passed as the source_path of a copy in CDN_PENDING_DIR, with data None
+        self.on_upload_failed = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._idle = threading.Condition(self._lock)
+
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    def session(self, zone):
+        with self._lock:
+            if zone not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.headers.update({'AccessKey': self.zones[zone]})
+                self._sessions[zone] = session
+            return self._sessions[zone]
+
+    # Run fn(*args) on the upload executor, blocks while max_pending jobs are already queued or running
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if future is None or future.exception() is not None:
+                self.failed += 1
+                if future is not None:
+                    print('CDN background job failed: {}'.format(str(future.exception())))
+            else:
+                self.completed += 1
+            self._idle.notify_all()
+        self._slots.release()
+
+    # Wait until every submitted job has finished, returns False on timeout
+    def flush(self, timeout=None):
+        with self._lock:
+            return self._idle.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def shutdown(self):
+        if self.pending > 0:
+            print('Flushing {} pending CDN upload(s)...'.format(self.pending))
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._transfers.shutdown(wait=True)
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    # Run calls (functions without arguments) concurrently, returns their results in order
+    def parallel(self, *calls):
+        futures = [self._transfers.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'pending_uploads': self.pending,
+                'max_pending_uploads': self.max_pending,
+                'completed_uploads': self.completed,
+                'failed_uploads': self.failed
+            }
+
+
+CDN = CDNClient({
+    'image': ACCESS_KEY,
+    'audio': ACCESS_KEY_AUDIO,
+    'video': ACCESS_KEY_VIDEO
+})
+atexit.register(CDN.shutdown)
+
+
+CDN_CACHE = DiskCache(CDN_CACHE_DIR, CDN_CACHE_MAX_GB * 1024**3) if CDN_CACHE_MAX_GB > 0 else None
+
+
+def storage_url(zone, path):
+    return f'https://storage.bunnycdn.com/{STORAGE_ZONES[zone]}/{path}'
+
+
+# returns the object at `path` in a storage zone in binary (from the disk cache when possible), or None if not found
+def download_from_cdn(zone, path, headers=None):
+    key = f'{zone}/{path}'
+    if CDN_CACHE is not None:
+        content = CDN_CACHE.get(key)
+        if content is not None:
+            return content
+
+    response = CDN.session(zone).get(storage_url(zone, path), headers=headers)
+    # object not found
     if response.status_code != 200:
         return None
 
+    if CDN_CACHE is not None:
+        CDN_CACHE.put(key, response.content)
     return response.content
 
 
-# uploads base 64 image to CDN, returns true if successful or false if unsuccessful
-def upload_image_to_cdn(user_id, image_id, base_64, thumbnail):
+# returns a binary file object for the object at `path` in a storage zone, or None if not found. With the disk
+# cache enabled this is the cached file itself (downloaded in chunks on a miss), so large objects never sit in memory
+def open_from_cdn(zone, path, headers=None):
+    key = f'{zone}/{path}'
+    if CDN_CACHE is None:
+        content = download_from_cdn(zone, path, headers)
+        return io.BytesIO(content) if content is not None else None
+
+    file = CDN_CACHE.open(key)
+    if file is not None:
+        return file
+
+    with CDN.session(zone).get(storage_url(zone, path), headers=headers, stream=True) as response:
+        # object not found
+        if response.status_code != 200:
+            return None
+        file_path = CDN_CACHE.put(key, response.iter_content(chunk_size=1024 * 1024))
+
+    try:
+        return open(file_path, 'rb')
+    except FileNotFoundError:
+        # evicted before it could be opened (e.g. larger than the whole cache), read it from the CDN instead
+        content = download_from_cdn(zone, path, headers)
+        return io.BytesIO(content) if content is not None else None
+
+
+def evict_from_cdn_cache(zone, path):
+    if CDN_CACHE is not None:
+        CDN_CACHE.delete(f'{zone}/{path}')
+
+
+# PUTs data to `path` in a storage zone, retrying 5xx / 429 / connection errors with jittered exponential backoff.
+# Returns True if the upload succeeded. Once the retries are used up the failure is handed to
+# CDN.on_upload_failed (when `record` is set) so the upload can be healed later.
+def put_with_retry(zone, path, data, retries=CDN_UPLOAD_RETRIES, backoff=CDN_UPLOAD_BACKOFF, record=True):
     headers = {
-        "Content-Type": "application/octet-stream",
-        "AccessKey": ACCESS_KEY
+        "Content-Type": "application/octet-stream"
     }
 
-    # upload full image
-    full_response = requests.put(
-        f'https://storage.bunnycdn.com/{STORAGE_ZONE_NAME}/{user_id}/{image_id}-full.png',
-        data=base_64,
-        headers=headers
-    )
+    # data is bytes or a seekable binary file, which requests streams from its current position
+    start = data.tell() if hasattr(data, 'read') else None
+
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+        try:
+            if start is not None:
+                data.seek(start)
+            response = CDN.session(zone).put(storage_url(zone, path), data=data, headers=headers)
+            if response.status_code == 201:
+                return True
+            error = f'HTTP {response.status_code}: {response.text[:200]}'
+            if response.status_code < 500 and response.status_code != 429:
+                # not going to change on a retry
+                break
+        except requests.RequestException as e:
+            error = str(e)
+
+    print(f'Failed to upload {path} to CDN zone {zone}: {error}')
+    if record and CDN.on_upload_failed is not None:
+        try:
+            if start is not None:
+                data.seek(start)
+                CDN.on_upload_failed(zone, path, None, error, source_path=spool_pending_upload(zone, path, data))
+            else:
+                CDN.on_upload_failed(zone, path, data, error)
+        except Exception as e:
+            print(f'Error recording failed upload of {path}: {e}')
+    return False
+
+
+# copies a file being uploaded to CDN_PENDING_DIR, disk to disk, so the caller can remove its own. Returns the copy's path
+def spool_pending_upload(zone, path, file):
+    os.makedirs(CDN_PENDING_DIR, exist_ok=True)
+    pending_path = os.path.join(CDN_PENDING_DIR, hashlib.sha256(f'{zone}/{path}'.encode('utf-8')).hexdigest())
+    temp_path = f'{pending_path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as pending:
+        shutil.copyfileobj(file, pending)
+    os.replace(temp_path, pending_path)
+    return pending_path
+
+
+# uploads the file at file_path streamed from disk, deleting it afterwards if remove
+def put_file_with_retry(zone, path, file_path, remove=False, **kwargs):
+    try:
+        with open(file_path, 'rb') as file:
+            return put_with_retry(zone, path, file, **kwargs)
+    finally:
+        if remove:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+#############################
+########## IMAGES ###########
+#############################
+
+
+# returns image (either full or thumbnail) in binary, or None if not found
+def download_image_from_cdn(user_id, image_id, image_type='full'):
+    return download_from_cdn('image', f'{user_id}/{image_id}-{image_type}.png')
 
-    # upload thumbnail
-    thumb_response = requests.put(
-        f'https://storage.bunnycdn.com/{STORAGE_ZONE_NAME}/{user_id}/{image_id}-thumbnail.png', 
-        data=thumbnail,
-        headers=headers
+
+# uploads base 64 image to CDN, returns true if successful or false if unsuccessful
+def upload_image_to_cdn(user_id, image_id, base_64, thumbnail):
+
+    # upload full image and thumbnail concurrently
+    full_uploaded, thumb_uploaded = CDN.parallel(
+        lambda: put_with_retry('image', f'{user_id}/{image_id}-full.png', base_64),
+        lambda: put_with_retry('image', f'{user_id}/{image_id}-thumbnail.png', thumbnail)
     )
 
-    if full_response.status_code != 201 or thumb_response.status_code != 201:
+    if not full_uploaded or not thumb_uploaded:
         print(f'Failed to upload image with ID {image_id} to CDN')
+        return False
+    return True
+
+
+# queues upload_image_to_cdn on the CDN upload executor, returns its future
+def upload_image_to_cdn_async(user_id, image_id, base_64, thumbnail):
+    return CDN.submit(upload_image_to_cdn, user_id, image_id, base_64, thumbnail)
 
 
 # deletes image from CDN, returns true if successful or false if unsuccessful
@@ -68,12 +322,11 @@ def delete_image_from_cdn(user_id, image_id):
         f'https://{STORAGE_LOCATION_ID}.storage.bunnycdn.com/{STORAGE_ZONE_NAME}/{user_id}/{image_id}-thumbnail.png'
     ]
 
-    headers = {
-        "AccessKey": ACCESS_KEY
-    }
+    evict_from_cdn_cache('image', f'{user_id}/{image_id}-full.png')
+    evict_from_cdn_cache('image', f'{user_id}/{image_id}-thumbnail.png')
 
     for url in urls:
-        response = requests.delete(url, headers=headers)
+        response = CDN.session('image').delete(url)
 
         if response.status_code != 200:
             return False
@@ -85,65 +338,85 @@ def delete_image_from_cdn(user_id, image_id):
 ########## AUDIOS ###########
 #############################
 
+# returns the audio base 64 encoded as a str, or None if not found
 def download_audio_from_cdn(user_id, cdn_id):
-    url = f"https://storage.bunnycdn.com/{STORAGE_ZONE_AUDIO}/{user_id}/{cdn_id}-full.mp3"
-    headers =  {
-        'accept': '*/*',
-        'AccessKey': ACCESS_KEY_AUDIO
-    }
-    
-    response = requests.get(url, headers=headers)
+    pieces = stream_audio_base64_from_cdn(user_id, cdn_id)
     # audio not found
-    if response.status_code != 200:
+    if pieces is None:
+        return None
+
+    return ''.join(pieces)
+
+
+# returns the audio base 64 encoded as a generator of str pieces (e.g. the body of a streamed flask Response), or None if
+# not found. Encoded in chunks of a multiple of 3 bytes, so the pieces join without padding and memory doesn't grow with the audio
+def stream_audio_base64_from_cdn(user_id, cdn_id):
+    audio_file = open_audio_from_cdn(user_id, cdn_id)
+    # audio not found
+    if audio_file is None:
         return None
 
-    content_base64 = base64.b64encode(response.content)
-    content_str = content_base64.decode('utf-8')
-    return content_str
+    def encode():
+        with audio_file:
+            for chunk in iter(lambda: audio_file.read(3 * 256 * 1024), b''):
+                yield base64.b64encode(chunk).decode('utf-8')
+
+    return encode()
 
 
 def download_audio_from_cdn_raw(user_id, cdn_id):
-    url = f"https://storage.bunnycdn.com/{STORAGE_ZONE_AUDIO}/{user_id}/{cdn_id}-full.mp3"
     headers =  {
-        'accept': '*/*',
-        'AccessKey': ACCESS_KEY_AUDIO
+        'accept': '*/*'
     }
-    
-    response = requests.get(url, headers=headers)
-    # audio not found
-    if response.status_code != 200:
-        return None
 
-    return response.content
+    return download_from_cdn('audio', f'{user_id}/{cdn_id}-full.mp3', headers=headers)
+
+
+# returns a binary file object of the audio (e.g. for torchaudio.load), or None if not found
+def open_audio_from_cdn(user_id, cdn_id):
+    headers =  {
+        'accept': '*/*'
+    }
+
+    return open_from_cdn('audio', f'{user_id}/{cdn_id}-full.mp3', headers=headers)
 
 
 # uploads base 64 audio to CDN, returns true if successful or false if unsuccessful
+# base_64 is bytes or a binary file
 def upload_audio_to_cdn(user_id, audio_id, base_64):
-    headers = {
-        "Content-Type": "application/octet-stream",
-        "AccessKey": ACCESS_KEY_AUDIO
-    }
 
     # upload full audio
-    full_response = requests.put(
-        f'https://storage.bunnycdn.com/{STORAGE_ZONE_AUDIO}/{user_id}/{audio_id}-full.mp3',
-        data=base_64,
-        headers=headers
-    )
+    if not put_with_retry('audio', f'{user_id}/{audio_id}-full.mp3', base_64):
+        print(f'Failed to upload audio with ID {audio_id} to CDN')
+        return False
+    return True
+
+
+# queues upload_audio_to_cdn on the CDN upload executor, returns its future
+def upload_audio_to_cdn_async(user_id, audio_id, base_64):
+    return CDN.submit(upload_audio_to_cdn, user_id, audio_id, base_64)
+
+
+# uploads the audio file at file_path streamed from disk, deleting it afterwards if remove
+def upload_audio_file_to_cdn(user_id, audio_id, file_path, remove=False):
 
-    if full_response.status_code != 201:
+    if not put_file_with_retry('audio', f'{user_id}/{audio_id}-full.mp3', file_path, remove=remove):
         print(f'Failed to upload audio with ID {audio_id} to CDN')
+        return False
+    return True
+
+
+# queues upload_audio_file_to_cdn on the CDN upload executor, returns its future
+def upload_audio_file_to_cdn_async(user_id, audio_id, file_path, remove=False):
+    return CDN.submit(upload_audio_file_to_cdn, user_id, audio_id, file_path, remove=remove)
 
 
 # deletes image from CDN, returns true if successful or false if unsuccessful
 def delete_audio_from_cdn(user_id, audio_id):
     url = f'https://storage.bunnycdn.com/{STORAGE_ZONE_AUDIO}/{user_id}/{audio_id}-full.mp3'
-    headers = {
-        "AccessKey": ACCESS_KEY_AUDIO
-    }
-
+    evict_from_cdn_cache('audio', f'{user_id}/{audio_id}-full.mp3')
     
-    response = requests.delete(url, headers=headers)
+    response = CDN.session('audio').delete(url)
 
     if response.status_code != 200:
         return False
@@ -155,33 +428,20 @@ def delete_audio_from_cdn(user_id, audio_id):
 ########## VIDEOS ###########
 #############################
 
-# uploads base 64 video to CDN, returns true if successful or false if unsuccessful
+# uploads video (bytes or a binary file, streamed) to CDN, returns true if successful or false if unsuccessful
 def upload_video_project_to_cdn(user_id, project_id, base_64):
-    headers = {
-        "Content-Type": "application/octet-stream",
-        "AccessKey": ACCESS_KEY_VIDEO
-    }
 
     # upload full video
-    full_response = requests.put(
-        f'https://storage.bunnycdn.com/{STORAGE_ZONE_VIDEO}/{user_id}/{project_id}-full.mp4',
-        data=base_64,
-        headers=headers
-    )
-
-    if full_response.status_code != 201:
-        print(full_response.json())
+    if not put_with_retry('video', f'{user_id}/{project_id}-full.mp4', base_64):
         print(f'Failed to upload video project with id {project_id} to CDN')
+        return False
+    return True
 
 # deletes video from CDN, returns true if successful or false if unsuccessful
 def delete_video_project_from_cdn(user_id, project_id):
     url = f'https://storage.bunnycdn.com/{STORAGE_ZONE_VIDEO}/{user_id}/{project_id}-full.mp4'
-    headers = {
-        "AccessKey": ACCESS_KEY_VIDEO
-    }
-
     
-    response = requests.delete(url, headers=headers)
+    response = CDN.session('video').delete(url)
 
     if response.status_code != 200:
         return False
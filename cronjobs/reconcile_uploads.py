@@ -0,0 +1,56 @@
+import os
+import sys
+import socket
+
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PARENT_DIR)
+
+from db import (
+    fetch_pending_uploads,
+    update_pending_upload_failure,
+    delete_pending_upload
+)
+from cdn import put_with_retry, put_file_with_retry
+
+from utils import fetch_env_config
+
+config = fetch_env_config()
+
+# pending uploads retried per run
+BATCH_SIZE = int(config.get('reconcile_uploads_batch_size', 100))
+# runs an upload is retried for, after that it's left in pending_uploads for inspection
+MAX_ATTEMPTS = int(config.get('reconcile_uploads_max_attempts', 10))
+
+
+# Re-upload CDN uploads that failed after their retries, returns the number healed.
+# Uploads are plain PUTs of the recorded payload or file, so running this twice (or alongside another run) is harmless.
+# Spooled files only exist on the host that spooled them, so each host only picks up its own.
+def reconcile_uploads(limit=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+    healed = 0
+
+    for upload in fetch_pending_uploads(limit, max_attempts, socket.gethostname()):
+        source_path = upload.get('source_path', None)
+        if source_path is not None:
+            if not os.path.exists(source_path):
+                uploaded, error = False, f'Source file {source_path} missing'
+            else:
+                uploaded, error = put_file_with_retry(upload['zone'], upload['path'], source_path, record=False), 'Upload retry failed'
+        else:
+            uploaded, error = put_with_retry(upload['zone'], upload['path'], bytes(upload['payload']), record=False), 'Upload retry failed'
+
+        if uploaded:
+            delete_pending_upload(upload['id'])
+            if source_path is not None:
+                os.remove(source_path)
+            healed += 1
+        else:
+            update_pending_upload_failure(upload['id'], error)
+            if upload['attempts'] + 1 >= max_attempts:
+                print(f"Giving up on upload of {upload['path']} to CDN zone {upload['zone']} after {max_attempts} attempts")
+
+    print(f'Healed {healed} pending upload(s)')
+    return healed
+
+
+if __name__ == '__main__':
+    reconcile_uploads()
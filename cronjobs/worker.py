@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import traceback
+
+PARENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PARENT_DIR)
+
+from jobs import claim_next_job, requeue_expired_jobs, JobLease, JobListener, WORKER_ID
+from utils import fetch_env_config
+
+config = fetch_env_config()
+
+# seconds an idle worker waits for a NOTIFY before polling the queue anyway
+POLL_INTERVAL = float(config.get('worker_poll_interval', 30))
+# jobs processed before the worker exits so its supervisor can restart it with a fresh process (0 = never)
+MAX_JOBS = int(config.get('worker_max_jobs', 0))
+
+SHUTDOWN_REQUESTED = False
+
+
+def request_shutdown(signum, frame):
+    global SHUTDOWN_REQUESTED
+
+    if SHUTDOWN_REQUESTED:
+        # second signal, stop right away
+        sys.exit(1)
+
+    print(f'Received signal {signum}, shutting down after the current job...')
+    SHUTDOWN_REQUESTED = True
+
+
+def load_processor(queue):
+    # importing the cronjob module loads its models, which happens once per worker process
+    if queue == 'video':
+        from generate_videos import generate_video
+        return generate_video
+    elif queue == 'audio':
+        from generate_audios import generate_audio
+        return generate_audio
+    else:
+        raise ValueError(f'Unknown queue: {queue}')
+
+
+def wait_for_work(listener, timeout):
+    deadline = time.time() + timeout
+    while not SHUTDOWN_REQUESTED and time.time() < deadline:
+        # wake up at least once a second to notice shutdown requests
+        if listener.wait(min(1.0, deadline - time.time())):
+            return
+
+
+def run_worker(queue, max_jobs=MAX_JOBS, poll_interval=POLL_INTERVAL):
+    process = load_processor(queue)
+    listener = JobListener(queue)
+    jobs_processed = 0
+
+    print(f'Worker {WORKER_ID} processing {queue} jobs')
+
+    try:
+        while not SHUTDOWN_REQUESTED:
+            try:
+                job = claim_next_job(queue)
+            except Exception as e:
+                print(f'Error claiming {queue} job: {e}')
+                job = None
+
+            if job is None:
+                try:
+                    requeue_expired_jobs(queue)
+                except Exception as e:
+                    print(f'Error re-queueing expired {queue} jobs: {e}')
+                wait_for_work(listener, poll_interval)
+                continue
+
+            print(f"Worker {WORKER_ID} claimed {queue} job {job['id']}")
+            with JobLease(queue, job['id']) as lease:
+                try:
+                    process(job)
+                except Exception:
+                    print(traceback.format_exc())
+            if lease.lost:
+                # the job's final state was left to the worker that re-claimed it, see jobs.finish_job
+                print(f"Worker {WORKER_ID} lost the lease on {queue} job {job['id']} while processing it")
+            jobs_processed += 1
+
+            if max_jobs > 0 and jobs_processed >= max_jobs:
+                print(f'Processed {jobs_processed} jobs, exiting so the worker can be recycled')
+                break
+    finally:
+        listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-running worker that processes queued video or audio jobs')
+    parser.add_argument('queue', choices=['video', 'audio'])
+    parser.add_argument('--max-jobs', type=int, default=MAX_JOBS, help='exit after this many jobs (0 = never)')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='seconds between queue polls when idle')
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    run_worker(args.queue, max_jobs=args.max_jobs, poll_interval=args.poll_interval)
@@ -3,16 +3,23 @@
 
 import os
 import json
+import time
 import base64
 import psycopg2
 import warnings
 import threading
-import pandas as pd
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 import uuid
 import datetime
+import math
+import socket
 
-from cdn import upload_image_to_cdn, delete_image_from_cdn, upload_audio_to_cdn, delete_audio_from_cdn, upload_video_project_to_cdn
+from contextlib import contextmanager
+
+from cdn import upload_image_to_cdn, upload_image_to_cdn_async, delete_image_from_cdn, upload_audio_to_cdn, upload_audio_to_cdn_async, \
+    upload_audio_file_to_cdn, upload_audio_file_to_cdn_async, delete_audio_from_cdn, upload_video_project_to_cdn, CDN
 
 from configparser import ConfigParser
 
@@ -25,6 +32,21 @@ SAVE_IMAGES_TO_DATABASE = config['save_image_to_database']
 DEFAULT_CREDIT_EXPIRATION = config['default_credit_expiration']
 LOGGING = False
 
+# connection pool settings, sized per process (i.e. per gunicorn worker)
+POOL_MAX_CONNECTIONS = int(config.get('db_pool_max_connections', 10))
+# seconds a caller waits for a free connection before giving up
+POOL_TIMEOUT = float(config.get('db_pool_timeout', 30))
+# seconds before a connection is closed and replaced with a fresh one
+POOL_MAX_LIFETIME = float(config.get('db_pool_max_lifetime', 30 * 60))
+# seconds a connection may sit idle before it is pinged on checkout
+POOL_HEALTH_CHECK_INTERVAL = float(config.get('db_pool_health_check_interval', 30))
+
+# queue name -> postgres NOTIFY channel workers listen on for new jobs
+QUEUE_CHANNELS = {
+    'video': 'video_jobs',
+    'audio': 'audio_jobs',
+}
+
 
 def config(section='postgresql'):
 
@@ -50,33 +72,194 @@ def config(section='postgresql'):
     return db
 
 
+########################################################
+######################### POOL #########################
+########################################################
+
+
+class ConnectionPool:
+    """Thread-safe pool of PostgreSQL connections.
+
+    Connections are opened on demand up to `max_connections`, kept open when
+    returned and handed out again. A connection is replaced when it is closed,
+    older than `max_lifetime` seconds, or fails a `SELECT 1` ping after sitting
+    idle for longer than `health_check_interval` seconds.
+    """
+
+    def __init__(self, params, max_connections, timeout, max_lifetime, health_check_interval):
+        self.params = params
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = []
+        # conn -> (created_at, last_used_at)
+        self._timestamps = {}
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.params)
+        now = time.time()
+        with self._lock:
+            self._timestamps[conn] = (now, now)
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._timestamps.pop(conn, None)
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        now = time.time()
+        with self._lock:
+            created_at, last_used_at = self._timestamps.get(conn, (now, now))
+        if now - created_at > self.max_lifetime:
+            return False
+
+        if now - last_used_at > self.health_check_interval:
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT 1;')
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError('Timed out waiting for a database connection')
+
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if len(self._idle) > 0 else None
+                if conn is None:
+                    return self._connect()
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            if not close and not conn.closed:
+                try:
+                    # never hand out a connection with a transaction left open
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+            if close or conn.closed:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    created_at, _ = self._timestamps.get(conn, (time.time(), None))
+                    self._timestamps[conn] = (created_at, time.time())
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+
+    global _pool, _pool_pid
+
+    # the pool is created lazily and per process so that forked gunicorn workers
+    # never share sockets inherited from the master
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                config(),
+                max_connections=POOL_MAX_CONNECTIONS,
+                timeout=POOL_TIMEOUT,
+                max_lifetime=POOL_MAX_LIFETIME,
+                health_check_interval=POOL_HEALTH_CHECK_INTERVAL
+            )
+            _pool_pid = os.getpid()
+
+    return _pool
+
+
+def close_pool():
+
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+
+
 ########################################################
 ####################### HELPERS ########################
 ########################################################
 
 
-# Open the connection with PostgreSQL
+# Open (check out) a pooled connection with PostgreSQL
 def open_connection():
 
     conn = None
     try:
-        params = config()
         if (LOGGING):
             print('Connecting to the PostgreSQL database...')
-        conn = psycopg2.connect(**params)
+        conn = get_pool().getconn()
         return conn
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
 
 
-# Close the connection with PostgreSQL
+# Close (return to the pool) the connection with PostgreSQL
 def close_connection(conn):
 
-    conn.close()
+    get_pool().putconn(conn)
     if (LOGGING):
         print('Database connection closed.')
 
 
+# Context manager around open_connection / close_connection, always returns the
+# connection to the pool (rolling back anything left uncommitted)
+@contextmanager
+def connection():
+
+    conn = open_connection()
+    if conn is None:
+        raise psycopg2.OperationalError('Could not connect to the PostgreSQL database')
+
+    try:
+        yield conn
+    finally:
+        close_connection(conn)
+
+
 # Open the cursor with PostgreSQL
 def create_cursor(conn):
 
@@ -95,6 +278,95 @@ def sanitize_string(string):
     return string.replace("'", "''")
 
 
+# Wake up workers LISTENing for new jobs on a queue, delivered when the transaction commits
+def notify_queue(cur, queue, id):
+
+    cur.execute("SELECT pg_notify(%s, %s);", [QUEUE_CHANNELS[queue], str(id)])
+
+
+########################################################
+###################### ROW MAPPING #####################
+########################################################
+
+
+# Rows are returned as plain dicts shaped exactly like the JSON the API has always
+# served (previously produced by a pandas DataFrame -> to_json -> json.loads round-trip):
+#   - date / timestamp columns become epoch milliseconds
+#   - float / numeric columns become floats rounded to 10 decimal places (NaN -> None)
+#   - json columns are already decoded to dicts / lists by psycopg2
+DATE_TYPE_OIDS = (1082, 1114, 1184) # date, timestamp, timestamptz
+FLOAT_TYPE_OIDS = (700, 701, 1700) # float4, float8, numeric
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def date_to_epoch_ms(value):
+
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // ONE_MILLISECOND
+
+
+def float_to_json(value):
+
+    if value is None:
+        return None
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return round(value, 10)
+
+
+def compile_row_mapper(description):
+
+    columns = [column[0] for column in description]
+    converters = []
+    for index, column in enumerate(description):
+        if column[1] in DATE_TYPE_OIDS:
+            converters.append((index, date_to_epoch_ms))
+        elif column[1] in FLOAT_TYPE_OIDS:
+            converters.append((index, float_to_json))
+
+    if len(converters) == 0:
+        return lambda row: dict(zip(columns, row))
+
+    def map_row(row):
+        row = list(row)
+        for index, converter in converters:
+            row[index] = converter(row[index])
+        return dict(zip(columns, row))
+
+    return map_row
+
+
+def map_rows(description, rows):
+
+    map_row = compile_row_mapper(description)
+    return [map_row(row) for row in rows]
+
+
+# Run a query and return every row as a dict
+def fetch_all(sql, params=None):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(sql, params)
+        rows = map_rows(cur.description, cur.fetchall())
+        close_cursor(cur)
+    return rows
+
+
+# Run a query and return the first row as a dict, or None if there are no rows
+def fetch_one(sql, params=None):
+
+    rows = fetch_all(sql, params)
+    return rows[0] if len(rows) > 0 else None
+
+
 #######################################################
 ######################## USERS ########################
 #######################################################
@@ -102,158 +374,124 @@ def sanitize_string(string):
 
 def create_user(email, password, verify_key, metadata):
     
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("INSERT INTO users (email, password, verify_key, metadata) VALUES (%s, %s, %s, %s) RETURNING id;", (email, password, verify_key, json.dumps(metadata)))
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("INSERT INTO users (email, password, verify_key, metadata) VALUES (%s, %s, %s, %s) RETURNING id;", (email, password, verify_key, json.dumps(metadata)))
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
     return id
 
 
 def fetch_user_for_email(email):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
     sql = "SELECT * FROM users WHERE email=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[email])
-    close_connection(conn)
-    try:
-        return json.loads(users_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [email])
 
 
 def fetch_user_for_verify_key(verify_key):
-    conn = open_connection()
-    cur = create_cursor(conn)
     sql = "SELECT * FROM users WHERE verify_key=%s AND is_verified=FALSE;"
-    users_df = pd.read_sql_query(sql, conn, params=[verify_key])
-    close_connection(conn)
-    try:
-        return json.loads(users_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [verify_key])
 
 
 def fetch_user_for_referral_token(token):
 
-    conn = open_connection()
     sql = "SELECT * FROM users WHERE referral_token=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[token])
-    close_connection(conn)
-    return json.loads(users_df.to_json(orient="records"))[0]
+    return fetch_all(sql, [token])[0]
 
 
 def verify_user_for_id(user_id):
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE users SET verify_key=NULL, is_verified=TRUE WHERE id=%s;", [user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE users SET verify_key=NULL, is_verified=TRUE WHERE id=%s;", [user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def create_password_reset_for_user(email, reset_key):
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("SELECT * FROM users WHERE email=%s;", [email])
-    users = cur.fetchall()
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("SELECT * FROM users WHERE email=%s;", [email])
+        users = cur.fetchall()
 
-    if len(users) == 0:
-        close_cursor(cur)
-        close_connection(conn)
-        return False, 'User not found'
+        if len(users) == 0:
+            close_cursor(cur)
+            return False, 'User not found'
 
-    user = users[0]
-    cur.execute("INSERT INTO password_recovery (user_id, reset_key) VALUES (%s, %s);", [user[0], reset_key])
+        user = users[0]
+        cur.execute("INSERT INTO password_recovery (user_id, reset_key) VALUES (%s, %s);", [user[0], reset_key])
 
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        close_cursor(cur)
+        conn.commit()
     return True, 'success'
 
 
 def get_password_reset(reset_key):
-    conn = open_connection()
-
     sql = "SELECT * FROM password_recovery WHERE reset_key=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[reset_key])
-    close_connection(conn)
-    return json.loads(users_df.to_json(orient="records"))[0]
+    return fetch_all(sql, [reset_key])[0]
 
 
 def verify_password_reset(reset_key, new_password_hash):
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("SELECT * FROM password_recovery WHERE reset_key=%s;", [reset_key])
-    rows = cur.fetchall()
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("SELECT * FROM password_recovery WHERE reset_key=%s;", [reset_key])
+        rows = cur.fetchall()
 
-    if len(rows) == 0:
-        close_cursor(cur)
-        close_connection(conn)
-        return False, 'Reset key not found'
+        if len(rows) == 0:
+            close_cursor(cur)
+            return False, 'Reset key not found'
 
-    user_id = rows[0][1]
+        user_id = rows[0][1]
 
-    cur.execute("UPDATE users SET password=%s WHERE id=%s", [new_password_hash, user_id])
-    cur.execute("DELETE FROM password_recovery WHERE id=%s", [rows[0][0]])
+        cur.execute("UPDATE users SET password=%s WHERE id=%s", [new_password_hash, user_id])
+        cur.execute("DELETE FROM password_recovery WHERE id=%s", [rows[0][0]])
 
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        close_cursor(cur)
+        conn.commit()
 
     return True, 'success'
 
 
 def fetch_user(id):
 
-    conn = open_connection()
     sql = "SELECT * FROM users WHERE id=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    return json.loads(users_df.to_json(orient="records"))[0]
+    return fetch_all(sql, [id])[0]
 
 
 def update_user(id, password, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE users SET password=%s, metadata=%s WHERE id=%s;", [password, json.dumps(metadata), id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE users SET password=%s, metadata=%s WHERE id=%s;", [password, json.dumps(metadata), id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def update_user_referral_token(id, token):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE users SET referral_token=%s WHERE id=%s;", [token, id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE users SET referral_token=%s WHERE id=%s;", [token, id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def update_user_metadata(id, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE users SET metadata=%s WHERE id=%s;", [json.dumps(metadata), id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE users SET metadata=%s WHERE id=%s;", [json.dumps(metadata), id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_user(id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM users WHERE id=%s;", [id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM users WHERE id=%s;", [id])
+        close_cursor(cur)
+        conn.commit()
 
 
 ########################################################
@@ -263,24 +501,19 @@ def delete_user(id):
 
 def create_referral(referrer_id, referred_id, metadata):
     
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("INSERT INTO referrals (referrer_id, referred_id, metadata) VALUES (%s, %s, %s) RETURNING id;", (referrer_id, referred_id, json.dumps(metadata)))
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("INSERT INTO referrals (referrer_id, referred_id, metadata) VALUES (%s, %s, %s) RETURNING id;", (referrer_id, referred_id, json.dumps(metadata)))
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
     return id
 
 
 def fetch_referral_for_referred(referred_id):
 
-    conn = open_connection()
     sql = "SELECT * FROM referrals WHERE referred_id=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[referred_id])
-    close_connection(conn)
-
-    referrals = json.loads(users_df.to_json(orient="records"))
+    referrals = fetch_all(sql, [referred_id])
 
     if len(referrals) == 0:
         return None
@@ -290,12 +523,11 @@ def fetch_referral_for_referred(referred_id):
 
 def delete_referral(id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM referrals WHERE id=%s;", [id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM referrals WHERE id=%s;", [id])
+        close_cursor(cur)
+        conn.commit()
 
 
 ########################################################
@@ -305,11 +537,8 @@ def delete_referral(id):
 
 def fetch_reward(name):
 
-    conn = open_connection()
     sql = "SELECT * FROM rewards WHERE name=%s;"
-    users_df = pd.read_sql_query(sql, conn, params=[name])
-    close_connection(conn)
-    return json.loads(users_df.to_json(orient="records"))[0]
+    return fetch_all(sql, [name])[0]
 
 
 def execute_reward(name, *args):
@@ -317,10 +546,7 @@ def execute_reward(name, *args):
     reward = fetch_reward(name)
     sql_query = reward['sql']
 
-    conn = open_connection()
-    results_df = pd.read_sql_query(sql_query, conn, params=args)
-    close_connection(conn)
-    result = json.loads(results_df.to_json(orient="records"))[0]
+    result = fetch_all(sql_query, args)[0]
 
     # convert expires_at from # of days to datetime
     if 'expires_at' in result:
@@ -333,12 +559,11 @@ def execute_reward(name, *args):
 
 def delete_reward(id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM rewards WHERE id=%s;", [id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM rewards WHERE id=%s;", [id])
+        close_cursor(cur)
+        conn.commit()
 
 
 ########################################################
@@ -350,29 +575,27 @@ def create_transaction(
     user_id, amount, metadata={}, expires_at=None, memo='', amount_remaining=0, t_type='credit'
 ):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute(
-        "INSERT INTO transactions (user_id, amount, amount_remaining, memo, metadata, expires_at, type) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;", (
-            user_id,
-            amount, 
-            amount_remaining,
-            memo,
-            json.dumps(metadata), 
-            expires_at,
-            t_type
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "INSERT INTO transactions (user_id, amount, amount_remaining, memo, metadata, expires_at, type) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;", (
+                user_id,
+                amount, 
+                amount_remaining,
+                memo,
+                json.dumps(metadata), 
+                expires_at,
+                t_type
+            )
         )
-    )
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
     return id
 
 
 def fetch_transactions_for_user(id, expired=False):
 
-    conn = open_connection()
     sql = "SELECT * FROM transactions WHERE user_id=%s"
     params = [id]
     if not expired:
@@ -380,9 +603,7 @@ def fetch_transactions_for_user(id, expired=False):
         params.append(datetime.datetime.utcnow())
     else:
         sql += ";"
-    users_df = pd.read_sql_query(sql, conn, params=params)
-    close_connection(conn)
-    return json.loads(users_df.to_json(orient="records"))
+    return fetch_all(sql, params)
 
 
 ########################################################
@@ -393,27 +614,24 @@ def fetch_transactions_for_user(id, expired=False):
 def create_image(user_id, image_byte_data, thumbnail_byte_data, hash, metadata, is_public=False, is_liked=False, parent_id=0, use_thread=True):
     image_cdn_uuid = str(uuid.uuid4())
 
-    # save to database
-    conn = open_connection()
-    cur = create_cursor(conn)
-    
     user_images_with_hash = fetch_images_for_user_with_hash(user_id, hash)
     if len(user_images_with_hash) > 0:
         return user_images_with_hash[0]['id'], user_images_with_hash[0]['cdn_id']
-    
-    sql = "INSERT INTO images (user_id, base_64, thumb_base_64, hash, metadata, cdn_id, is_public, is_liked, parent_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;"
-    fields = [user_id, '0', '0', hash, json.dumps(metadata), image_cdn_uuid, is_public, is_liked, parent_id]
 
-    cur.execute(sql, fields)
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    # save to database
+    with connection() as conn:
+        cur = create_cursor(conn)
+        sql = "INSERT INTO images (user_id, base_64, thumb_base_64, hash, metadata, cdn_id, is_public, is_liked, parent_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;"
+        fields = [user_id, '0', '0', hash, json.dumps(metadata), image_cdn_uuid, is_public, is_liked, parent_id]
+
+        cur.execute(sql, fields)
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
 
     if use_thread:
-        # Start a new thread for the slow save operation
-        save_thread = threading.Thread(target=upload_image_to_cdn, args=(user_id, image_cdn_uuid, image_byte_data, thumbnail_byte_data))
-        save_thread.start()
+        # queue the slow save operation on the bounded CDN upload executor
+        upload_image_to_cdn_async(user_id, image_cdn_uuid, image_byte_data, thumbnail_byte_data)
     else:
         upload_image_to_cdn(
             user_id,
@@ -427,115 +645,161 @@ def create_image(user_id, image_byte_data, thumbnail_byte_data, hash, metadata,
 
 def fetch_images(limit, offset):
 
-    conn = open_connection()
     sql = "SELECT * FROM images where is_public=True ORDER BY id DESC LIMIT %s OFFSET %s;"
-    images_df = pd.read_sql_query(sql, conn, params=[limit, offset])
-    close_connection(conn)
-    return json.loads(images_df.to_json(orient="records"))
+    return fetch_all(sql, [limit, offset])
 
 
 def fetch_image(id):
 
-    conn = open_connection()
     sql = "SELECT * FROM images WHERE id=%s;"
-    images_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(images_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
     
 
 def fetch_image_with_cdn_id(id):
 
-    conn = open_connection()
     sql = "SELECT * FROM images WHERE cdn_id=%s;"
-    images_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(images_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
 
 
 def fetch_images_with_hash(hash):
 
-    conn = open_connection()
     sql = "SELECT * FROM images where hash=%s;"
-    images_df = pd.read_sql_query(sql, conn, params=[hash])
-    close_connection(conn)
-    return json.loads(images_df.to_json(orient="records"))
+    return fetch_all(sql, [hash])
 
 
 def fetch_images_for_user_with_hash(user_id, hash):
 
-    conn = open_connection()
     sql = "SELECT * FROM images where user_id=%s and hash=%s;"
-    images_df = pd.read_sql_query(sql, conn, params=[user_id, hash])
-    close_connection(conn)
-    return json.loads(images_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id, hash])
 
 
 def fetch_images_for_user(user_id, limit, offset, favorited):
 
-    conn = open_connection()
     sql = "SELECT * FROM images where user_id=%s {} ORDER BY id DESC LIMIT %s OFFSET %s;".format("AND is_liked=True" if favorited else "")
-    images_df = pd.read_sql_query(sql, conn, params=[user_id, limit, offset])
-    close_connection(conn)
-    return json.loads(images_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id, limit, offset])
 
 
 def fetch_image_ids_for_user(user_id):
 
-    conn = open_connection()
     sql = "SELECT id FROM images where user_id=%s;"
-    image_ids_df = pd.read_sql_query(sql, conn, params=[user_id])
-    close_connection(conn)
-    return json.loads(image_ids_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id])
 
 
 def fetch_image_for_user(id, user_id):
 
-    conn = open_connection()
     sql = "SELECT * FROM images WHERE id=%s and user_id=%s;"
-    images_df = pd.read_sql_query(sql, conn, params=[id, user_id])
-    close_connection(conn)
-    try:
-        return json.loads(images_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id, user_id])
     
 
 def fetch_images_for_ids(ids):
-    conn = open_connection()
     sql = "SELECT i.* FROM images i JOIN unnest(%s::int[]) WITH ORDINALITY t(id, ord) USING (id) ORDER BY t.ord;"
-    images_df = pd.read_sql_query(sql, conn, params=['{%s}' % ','.join(map(str, ids))])
-    close_connection(conn)
-    return json.loads(images_df.to_json(orient="records"))
+    return fetch_all(sql, ['{%s}' % ','.join(map(str, ids))])
 
 
 def update_image_for_user(id, user_id, is_public, is_liked):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
     
-    if is_public != None:
-        cur.execute("UPDATE images SET is_public=%s WHERE id=%s and user_id=%s;", [is_public, id, user_id])
-    if is_liked != None:
-        cur.execute("UPDATE images SET is_liked=%s WHERE id=%s and user_id=%s;", [is_liked, id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        if is_public != None:
+            cur.execute("UPDATE images SET is_public=%s WHERE id=%s and user_id=%s;", [is_public, id, user_id])
+        if is_liked != None:
+            cur.execute("UPDATE images SET is_liked=%s WHERE id=%s and user_id=%s;", [is_liked, id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_image_for_user(id, user_id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM images WHERE id=%s and user_id=%s;", [id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM images WHERE id=%s and user_id=%s;", [id, user_id])
+        close_cursor(cur)
+        conn.commit()
+
+
+########################################################
+###################### IMAGE JOBS ######################
+########################################################
+
+IMAGE_JOB_LOST_ERROR = 'The server running the job stopped before finishing it'
+
+
+# jobs run in the process that queued them (worker_id), which keeps renewing their lease while it's alive
+def create_image_job(user_id, metadata, worker_id, lease_duration):
+    job_id = str(uuid.uuid4())
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "INSERT INTO image_jobs (id, user_id, metadata, worker_id, lease_expires_at) VALUES (%s, %s, %s, %s, NOW() + %s * INTERVAL '1 second');",
+            [job_id, user_id, json.dumps(metadata), worker_id, lease_duration]
+        )
+        close_cursor(cur)
+        conn.commit()
+
+    return job_id
+
+
+# the job, marked ERROR first if the process running it died (its lease ran out) before finishing it
+# read-only, polled by every GET /jobs/<id> and event stream; jobs of dead processes are failed by expire_image_jobs
+def fetch_image_job_for_user(id, user_id):
+
+    sql = "SELECT * FROM image_jobs WHERE id=%s and user_id=%s;"
+    return fetch_one(sql, [id, user_id])
+
+
+# extends the lease of every unfinished job of a process, returns the number renewed
+def renew_image_job_leases(worker_id, lease_duration):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "UPDATE image_jobs SET lease_expires_at=NOW() + %s * INTERVAL '1 second' WHERE worker_id=%s AND state IN ('QUEUED', 'PROCESSING');",
+            [lease_duration, worker_id]
+        )
+        renewed = cur.rowcount
+        close_cursor(cur)
+        conn.commit()
+
+    return renewed
+
+
+# marks the unfinished jobs of processes that died (their lease ran out) ERROR, returns the number expired
+def expire_image_jobs():
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "UPDATE image_jobs SET state='ERROR', error=%s, updated_at=NOW() WHERE state IN ('QUEUED', 'PROCESSING') AND lease_expires_at < NOW();",
+            [IMAGE_JOB_LOST_ERROR]
+        )
+        expired = cur.rowcount
+        close_cursor(cur)
+        conn.commit()
+
+    return expired
+
+
+def update_image_job_state(id, state, image_id=None, cdn_id=None, error=None):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "UPDATE image_jobs SET state=%s, progress=CASE WHEN %s='COMPLETED' THEN 1 ELSE progress END, image_id=COALESCE(%s, image_id), cdn_id=COALESCE(%s, cdn_id), error=%s, updated_at=NOW() WHERE id=%s;",
+            [state, state, image_id, cdn_id, error, id]
+        )
+        close_cursor(cur)
+        conn.commit()
+
+
+def update_image_job_progress(id, progress):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE image_jobs SET progress=%s, updated_at=NOW() WHERE id=%s;", [progress, id])
+        close_cursor(cur)
+        conn.commit()
 
 
 #######################################################
@@ -543,27 +807,33 @@ def delete_image_for_user(id, user_id):
 #######################################################
 
 
-def create_audio(user_id, name, size, metadata, state=None, audio_byte_data=None, use_thread=True):
+# the audio is either audio_byte_data or the file at audio_file_path (streamed from disk, then removed)
+def create_audio(user_id, name, size, metadata, state=None, audio_byte_data=None, use_thread=True, audio_file_path=None):
     audio_cdn_uuid = str(uuid.uuid4())
 
     # save to database
-    conn = open_connection()
-    cur = create_cursor(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
     
-    sql = "INSERT INTO audio (user_id, name, size, metadata, cdn_id, state) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;"
-    fields = [user_id, name + audio_cdn_uuid, size, json.dumps(metadata), audio_cdn_uuid, state]
+        sql = "INSERT INTO audio (user_id, name, size, metadata, cdn_id, state) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;"
+        fields = [user_id, name + audio_cdn_uuid, size, json.dumps(metadata), audio_cdn_uuid, state]
 
-    cur.execute(sql, fields)
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        cur.execute(sql, fields)
+        id = cur.fetchone()[0]
+        if state == 'QUEUED':
+            notify_queue(cur, 'audio', id)
+        close_cursor(cur)
+        conn.commit()
 
     if state == None:
-        if use_thread:
-            # Start a new thread for the slow save operation
-            save_thread = threading.Thread(target=upload_audio_to_cdn, args=(user_id, audio_cdn_uuid, audio_byte_data))
-            save_thread.start()
+        if audio_file_path is not None:
+            if use_thread:
+                upload_audio_file_to_cdn_async(user_id, audio_cdn_uuid, audio_file_path, remove=True)
+            else:
+                upload_audio_file_to_cdn(user_id, audio_cdn_uuid, audio_file_path, remove=True)
+        elif use_thread:
+            # queue the slow save operation on the bounded CDN upload executor
+            upload_audio_to_cdn_async(user_id, audio_cdn_uuid, audio_byte_data)
         else:
             upload_audio_to_cdn(user_id=user_id, audio_id=audio_cdn_uuid, base_64=audio_byte_data)
 
@@ -572,95 +842,71 @@ def create_audio(user_id, name, size, metadata, state=None, audio_byte_data=None
 
 def fetch_audios():
 
-    conn = open_connection()
     sql = "SELECT * FROM audio ORDER BY id ASC;"
-    audio_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    return json.loads(audio_df.to_json(orient="records"))
+    return fetch_all(sql)
 
 
 def fetch_audios_for_user(user_id, limit, offset):
 
-    conn = open_connection()
     sql = "SELECT * FROM audio where user_id=%s ORDER BY id DESC LIMIT %s OFFSET %s;"
-    audio_df = pd.read_sql_query(sql, conn, params=[user_id, limit, offset])
-    close_connection(conn)
-    return json.loads(audio_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id, limit, offset])
 
 def fetch_queued_audios():
-    conn = open_connection()
     sql = "SELECT * FROM audio WHERE state like 'QUEUED' ORDER BY updated_at asc;"
-    audio_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    try:
-        return json.loads(audio_df.to_json(orient="records"))
-    except Exception as e:
-        return None
+    return fetch_all(sql)
 
 
 def fetch_audio_for_user(user_id, id):
 
-    conn = open_connection()
     sql = "SELECT * FROM audio WHERE id=%s and user_id=%s;"
-    audio_df = pd.read_sql_query(sql, conn, params=[id, user_id])
-    close_connection(conn)
-    try:
-        return json.loads(audio_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id, user_id])
     
 def fetch_audio_for_id(id):
-    conn = open_connection()
     sql = "SELECT * FROM audio WHERE id=%s"
-    audio_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(audio_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
 
 
 def update_audio_for_user(id, user_id, name, size, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE audio SET name=%s, size=%s, metadata=%s WHERE id=%s and user_id=%s;", [name, size, json.dumps(metadata), id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE audio SET name=%s, size=%s, metadata=%s WHERE id=%s and user_id=%s;", [name, size, json.dumps(metadata), id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 def update_audio_metadata(id, metadata):
     
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE audio SET metadata=%s WHERE id=%s;", [json.dumps(metadata), id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE audio SET metadata=%s WHERE id=%s;", [json.dumps(metadata), id])
+        close_cursor(cur)
+        conn.commit()
 
 def update_audio_state(id, state):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE audio SET state=%s WHERE id=%s;", [state, id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        if state == 'QUEUED':
+            # a fresh run: the attempts and lease of earlier runs mustn't count against it
+            cur.execute("UPDATE audio SET state=%s, attempts=0, worker_id=NULL, lease_expires_at=NULL WHERE id=%s;", [state, id])
+            notify_queue(cur, 'audio', id)
+        else:
+            cur.execute("UPDATE audio SET state=%s WHERE id=%s;", [state, id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_audio_and_video_project_for_user(user_id, id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("SELECT * FROM audio WHERE id=%s and user_id=%s;", [id, user_id])
-    audio_cdn_id = cur.fetchone()[5]
-    cur.execute("DELETE FROM audio WHERE id=%s and user_id=%s;", [id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("SELECT * FROM audio WHERE id=%s and user_id=%s;", [id, user_id])
+        audio_cdn_id = cur.fetchone()[5]
+        cur.execute("DELETE FROM audio WHERE id=%s and user_id=%s;", [id, user_id])
+        close_cursor(cur)
+        conn.commit()
     
-    delete_thread = threading.Thread(target=delete_audio_from_cdn, args=(user_id, audio_cdn_id))
-    delete_thread.start()
+    CDN.submit(delete_audio_from_cdn, user_id, audio_cdn_id)
 
 
 #######################################################
@@ -670,64 +916,49 @@ def delete_audio_and_video_project_for_user(user_id, id):
 
 def create_link(user_id, metadata):
     
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("INSERT INTO links (user_id, metadata) VALUES (%s, %s) RETURNING id;", (user_id, json.dumps(metadata)))
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("INSERT INTO links (user_id, metadata) VALUES (%s, %s) RETURNING id;", (user_id, json.dumps(metadata)))
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
     return id
 
 
 def fetch_links():
 
-    conn = open_connection()
     sql = "SELECT * FROM links ORDER BY id ASC;"
-    links_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    return json.loads(links_df.to_json(orient="records"))
+    return fetch_all(sql)
 
 
 def fetch_link(id):
 
-    conn = open_connection()
     sql = "SELECT * FROM links WHERE id=%s;"
-    links_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(links_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
 
 
 def fetch_links_for_user(user_id, limit, offset):
 
-    conn = open_connection()
     sql = "SELECT * FROM links where user_id=%s ORDER BY id DESC LIMIT %s OFFSET %s;"
-    links_df = pd.read_sql_query(sql, conn, params=[user_id, limit, offset])
-    close_connection(conn)
-    return json.loads(links_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id, limit, offset])
 
 
 def update_link_for_user(id, user_id, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE links SET metadata=%s WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE links SET metadata=%s WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_link_for_user(id, user_id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM links WHERE id=%s and user_id=%s;", [id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM links WHERE id=%s and user_id=%s;", [id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 ########################################################
@@ -735,27 +966,27 @@ def delete_link_for_user(id, user_id):
 ########################################################
 
 
+# video_bytes is bytes or a binary file, which is streamed to the CDN
 def create_video(user_id, metadata, duration, start_frame_id, start_frame_cdn_id, end_frame_id, end_frame_cdn_id, cdn_uuid, video_bytes, name):
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute(
-        "INSERT INTO videos (user_id, metadata, duration, start_frame_id, start_frame_cdn_id, end_frame_id, end_frame_cdn_id, cdn_id, name) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;", 
-        (
-            user_id, 
-            json.dumps(metadata), 
-            duration, 
-            start_frame_id, 
-            start_frame_cdn_id, 
-            end_frame_id, 
-            end_frame_cdn_id,
-            cdn_uuid,
-            name
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            "INSERT INTO videos (user_id, metadata, duration, start_frame_id, start_frame_cdn_id, end_frame_id, end_frame_cdn_id, cdn_id, name) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;", 
+            (
+                user_id, 
+                json.dumps(metadata), 
+                duration, 
+                start_frame_id, 
+                start_frame_cdn_id, 
+                end_frame_id, 
+                end_frame_cdn_id,
+                cdn_uuid,
+                name
+            )
         )
-    )
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
 
     upload_video_project_to_cdn(user_id, cdn_uuid, video_bytes)
 
@@ -764,64 +995,44 @@ def create_video(user_id, metadata, duration, start_frame_id, start_frame_cdn_id
 
 def fetch_videos():
 
-    conn = open_connection()
     sql = "SELECT * FROM videos;"
-    videos_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    return json.loads(videos_df.to_json(orient="records"))
+    return fetch_all(sql)
 
 
 def fetch_video(id):
 
-    conn = open_connection()
     sql = "SELECT * FROM videos WHERE id=%s;"
-    videos_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(videos_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
 
 
 def fetch_videos_for_user(user_id):
 
-    conn = open_connection()
     sql = "SELECT * FROM videos where user_id=%s;"
-    videos_df = pd.read_sql_query(sql, conn, params=[user_id])
-    close_connection(conn)
-    return json.loads(videos_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id])
 
 
 def fetch_video_for_user(id, user_id):
 
-    conn = open_connection()
     sql = "SELECT * FROM videos WHERE id=%s and user_id=%s;"
-    videos_df = pd.read_sql_query(sql, conn, params=[id, user_id])
-    close_connection(conn)
-    try:
-        return json.loads(videos_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id, user_id])
 
 
 def update_video_for_user(id, user_id, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE videos SET metadata=%s WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE videos SET metadata=%s WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_video_for_user(id, user_id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM videos WHERE id=%s and user_id=%s;", [id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM videos WHERE id=%s and user_id=%s;", [id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
     
 ########################################################
@@ -832,44 +1043,33 @@ def delete_video_for_user(id, user_id):
 def create_video_project(user_id, audio_id, metadata):
 
     # save to database
-    conn = open_connection()
-    cur = create_cursor(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
     
-    sql = "INSERT INTO video_projects (user_id, audio_id, metadata, cdn_id) VALUES (%s, %s, %s, %s) RETURNING id;"
-    fields = [user_id, audio_id, json.dumps(metadata), str(uuid.uuid4())]
+        sql = "INSERT INTO video_projects (user_id, audio_id, metadata, cdn_id) VALUES (%s, %s, %s, %s) RETURNING id;"
+        fields = [user_id, audio_id, json.dumps(metadata), str(uuid.uuid4())]
 
-    cur.execute(sql, fields)
-    id = cur.fetchone()[0]
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+        cur.execute(sql, fields)
+        id = cur.fetchone()[0]
+        close_cursor(cur)
+        conn.commit()
 
     return id
 
 
 def fetch_video_projects():
 
-    conn = open_connection()
     sql = "SELECT * FROM video_projects ORDER BY id ASC;"
-    video_projects_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    return json.loads(video_projects_df.to_json(orient="records"))
+    return fetch_all(sql)
 
 
 def fetch_video_project_for_id(id):
-    conn = open_connection()
     sql = "SELECT * FROM video_projects WHERE id=%s;"
-    project_df = pd.read_sql_query(sql, conn, params=[id])
-    close_connection(conn)
-    try:
-        return json.loads(project_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id])
 
 
 def fetch_video_projects_for_user(user_id, limit, offset):
 
-    conn = open_connection()
     sql = """
         SELECT 
             projects.*, audio.cdn_id as audio_cdn_id, audio.name as audio_name
@@ -883,73 +1083,121 @@ def fetch_video_projects_for_user(user_id, limit, offset):
         LIMIT %s 
         OFFSET %s;
     """
-    video_projects_df = pd.read_sql_query(sql, conn, params=[user_id, limit, offset])
-    close_connection(conn)
-    return json.loads(video_projects_df.to_json(orient="records"))
+    return fetch_all(sql, [user_id, limit, offset])
 
 
 def fetch_video_project_for_user(user_id, id):
 
-    conn = open_connection()
     sql = "SELECT * FROM video_projects WHERE id=%s and user_id=%s;"
-    video_project_df = pd.read_sql_query(sql, conn, params=[id, user_id])
-    close_connection(conn)
-    try:
-        return json.loads(video_project_df.to_json(orient="records"))[0]
-    except Exception as e:
-        return None
+    return fetch_one(sql, [id, user_id])
 
 
 def fetch_queued_video_projects():
 
-    conn = open_connection()
     sql = "SELECT * FROM video_projects WHERE state like 'QUEUED' ORDER BY updated_at asc;"
-    video_projects_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    try:
-        return json.loads(video_projects_df.to_json(orient="records"))
-    except Exception as e:
-        return None
+    return fetch_all(sql)
 
 
 def update_video_project_for_user(user_id, id, metadata):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE video_projects SET metadata=%s, updated_at=NOW() WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE video_projects SET metadata=%s, updated_at=NOW() WHERE id=%s and user_id=%s;", [json.dumps(metadata), id, user_id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def update_video_project_state(id, state):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE video_projects SET state=%s WHERE id=%s;", [state, id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        if state == 'QUEUED':
+            # a fresh run (e.g. a regeneration): the attempts and lease of earlier runs mustn't count against it
+            cur.execute("UPDATE video_projects SET state=%s, attempts=0, worker_id=NULL, lease_expires_at=NULL WHERE id=%s;", [state, id])
+            notify_queue(cur, 'video', id)
+        else:
+            cur.execute("UPDATE video_projects SET state=%s WHERE id=%s;", [state, id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def update_video_project_cdn_id(id, cdn_id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("UPDATE video_projects SET cdn_id=%s WHERE id=%s;", [cdn_id, id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE video_projects SET cdn_id=%s WHERE id=%s;", [cdn_id, id])
+        close_cursor(cur)
+        conn.commit()
 
 
 def delete_video_project_for_user(user_id, id):
 
-    conn = open_connection()
-    cur = create_cursor(conn)
-    cur.execute("DELETE FROM video_projects WHERE id=%s and user_id=%s;", [id, user_id])
-    close_cursor(cur)
-    conn.commit()
-    close_connection(conn)
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM video_projects WHERE id=%s and user_id=%s;", [id, user_id])
+        close_cursor(cur)
+        conn.commit()
+
+
+########################################################
+################### PENDING UPLOADS ####################
+########################################################
+
+
+# CDN uploads that failed after their retries, kept until cronjobs/reconcile_uploads.py heals them. Small payloads are
+# stored in the row, files by the source_path of their copy on disk (see cdn.spool_pending_upload)
+def record_pending_upload(zone, path, data, error, source_path=None):
+
+    payload = None
+    if data is not None:
+        payload = psycopg2.Binary(data.encode('utf-8') if isinstance(data, str) else bytes(data))
+
+    # spooled files live on this host's disk, only this host's reconciler can re-upload them
+    host = socket.gethostname() if source_path is not None else None
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(
+            """
+            INSERT INTO pending_uploads (zone, path, payload, source_path, host, last_error) VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (zone, path) DO UPDATE SET payload=EXCLUDED.payload, source_path=EXCLUDED.source_path,
+                host=EXCLUDED.host, last_error=EXCLUDED.last_error, attempts=0, updated_at=NOW();
+            """,
+            [zone, path, payload, source_path, host, error]
+        )
+        close_cursor(cur)
+        conn.commit()
+
+
+# uploads retried fewer than max_attempts times that host can retry (payloads, or files spooled on host), least recently tried first
+def fetch_pending_uploads(limit, max_attempts, host):
+
+    sql = """
+        SELECT * FROM pending_uploads WHERE attempts < %s AND (source_path IS NULL OR host = %s)
+        ORDER BY updated_at ASC LIMIT %s;
+    """
+    return fetch_all(sql, [max_attempts, host, limit])
+
+
+def update_pending_upload_failure(id, error):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("UPDATE pending_uploads SET attempts=attempts + 1, last_error=%s, updated_at=NOW() WHERE id=%s;", [error, id])
+        close_cursor(cur)
+        conn.commit()
+
+
+def delete_pending_upload(id):
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute("DELETE FROM pending_uploads WHERE id=%s;", [id])
+        close_cursor(cur)
+        conn.commit()
+
+
+CDN.on_upload_failed = record_pending_upload
 
 
 ########################################################
@@ -958,8 +1206,5 @@ def delete_video_project_for_user(user_id, id):
 
 def fetch_api_hosts():
 
-    conn = open_connection()
     sql = "SELECT * FROM api_hosts;"
-    api_hosts_df = pd.read_sql_query(sql, conn)
-    close_connection(conn)
-    return api_hosts_df['address'].array
+    return [api_host['address'] for api_host in fetch_all(sql)]
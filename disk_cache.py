@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import os
+import hashlib
+import tempfile
+import threading
+
+
+class DiskCache:
+    """Size-bounded on-disk LRU cache of immutable blobs (e.g. CDN objects keyed by zone/user/cdn_id).
+
+    Entries are files named by the sha256 of their key (keeping the key's extension so decoders
+    can sniff the format), written to a temp file and renamed into place, so readers in other
+    threads or processes never see a partial file. `open` returns the cached file itself so
+    callers can read / decode it without copying it into memory, once open it stays readable
+    even if it's evicted. `path` only names the file, which eviction may remove before it's opened.
+    Hits bump the file's mtime, eviction removes the oldest files once the cache is over `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._size = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _file_path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        extension = os.path.splitext(key)[1]
+        return os.path.join(self.directory, digest[:2], digest + extension)
+
+    # Returns the path of the cached file for key, or None on a miss
+    def path(self, key):
+        file_path = self._file_path(key)
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return file_path
+
+    # Returns the cached file for key opened for binary reading, or None on a miss
+    def open(self, key):
+        file_path = self._file_path(key)
+        try:
+            file = open(file_path, 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            # evicted since it was opened, the open file is still readable
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return file
+
+    def get(self, key):
+        file = self.open(key)
+        if file is None:
+            return None
+        with file:
+            return file.read()
+
+    # Store data (bytes, or an iterable of byte chunks so large blobs are streamed to disk), returns the cached file's path
+    def put(self, key, data):
+        file_path = self._file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        chunks = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            # an overwritten entry no longer takes up its old size
+            try:
+                size -= os.stat(file_path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            self._evict()
+        return file_path
+
+    def delete(self, key):
+        try:
+            os.remove(self._file_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+        return entries
+
+    # called with self._lock held
+    def _evict(self):
+        if self._size is not None and self._size <= self.max_bytes:
+            return
+
+        # other processes share the directory, so the real size is only known after a scan
+        entries = self._entries()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                'evictions': self.evictions,
+                'bytes': self._size,
+                'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import time
+import queue
+import threading
+
+from collections import defaultdict
+
+
+class FrameWriter:
+    """Converts, upsamples, saves and encodes frames on a worker thread while the GPU denoises the next batch.
+
+    `put` queues a batch of (frame_index, frame, upsample). The worker turns each frame into an
+    image with `pipeline.load_frame` (a decoded array, a PIL image or the path of a saved frame,
+    opened only when its turn comes) and hands it to `pipeline.emit_frame` with the `sink`. At
+    most `max_batches` batches wait in the queue, so a slow encoder holds the denoising loop
+    back instead of piling frames up in memory. A single worker keeps the frames in order. A
+    failure in the worker is raised by the next `put` or by `close`.
+
+    `timings` adds up the seconds spent in each stage, producer stages included.
+    """
+
+    def __init__(self, pipeline, sink=None, max_batches=2):
+        self.pipeline = pipeline
+        self.sink = sink
+
+        self.queue = queue.Queue(maxsize=max_batches)
+        self.error = None
+        self.timings = defaultdict(float)
+        self._timings_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_time(self, stage, seconds):
+        with self._timings_lock:
+            self.timings[stage] += seconds
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.error is not None:
+                # keep draining so the producer never blocks on a full queue
+                continue
+
+            frames, save_path, image_file_ext = job
+            try:
+                for frame_index, frame, upsample in frames:
+                    start = time.perf_counter()
+                    image = self.pipeline.load_frame(frame, upsample)
+                    self.add_time('convert', time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    self.pipeline.emit_frame(image, frame_index, self.sink, save_path, image_file_ext)
+                    self.add_time('encode', time.perf_counter() - start)
+            except Exception as e:
+                self.error = e
+
+    def put(self, frames, save_path=None, image_file_ext=".png"):
+        if self.error is not None:
+            raise self.error
+        start = time.perf_counter()
+        self.queue.put((frames, save_path, image_file_ext))
+        self.add_time('queue_wait', time.perf_counter() - start)
+
+    def _stop(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    # Waits for the queued frames to be written
+    def close(self):
+        self._stop()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    # on an exception the queued frames are still written, but a worker error doesn't replace the exception
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop()
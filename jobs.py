@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import os
+import time
+import select
+import socket
+import psycopg2
+import psycopg2.extensions
+import threading
+
+from db import connection, create_cursor, close_cursor, map_rows, QUEUE_CHANNELS
+from db import config as database_config
+from utils import fetch_env_config
+
+config = fetch_env_config()
+
+# queue name -> table holding its jobs (rows move QUEUED -> PROCESSING -> COMPLETED / ERROR)
+QUEUE_TABLES = {
+    'video': 'video_projects',
+    'audio': 'audio',
+}
+
+# seconds a claimed job stays leased to its worker without a heartbeat
+LEASE_DURATION = int(config.get('job_lease_duration', 120))
+# times a job is handed out before a job whose workers keep dying is marked ERROR
+MAX_ATTEMPTS = int(config.get('job_max_attempts', 3))
+
+WORKER_ID = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+#######################################################
+######################## QUEUE ########################
+#######################################################
+
+
+# Atomically claim the oldest queued job, returns the job row or None if the queue is empty.
+# FOR UPDATE SKIP LOCKED lets any number of workers poll the same table without ever
+# handing the same row to two of them.
+def claim_next_job(queue, worker_id=WORKER_ID, lease_duration=LEASE_DURATION):
+
+    table = QUEUE_TABLES[queue]
+    sql = f"""
+        UPDATE {table} SET
+            state='PROCESSING',
+            worker_id=%s,
+            attempts=attempts + 1,
+            heartbeat_at=NOW(),
+            lease_expires_at=NOW() + %s * INTERVAL '1 second'
+        WHERE id = (
+            SELECT id FROM {table}
+            WHERE state='QUEUED'
+            ORDER BY updated_at ASC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *;
+    """
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(sql, [worker_id, lease_duration])
+        jobs = map_rows(cur.description, cur.fetchall())
+        close_cursor(cur)
+        conn.commit()
+
+    return jobs[0] if len(jobs) > 0 else None
+
+
+# Extend the lease on a job, returns False if the job is no longer held by this worker
+def heartbeat(queue, job_id, worker_id=WORKER_ID, lease_duration=LEASE_DURATION):
+
+    table = QUEUE_TABLES[queue]
+    sql = f"""
+        UPDATE {table} SET
+            heartbeat_at=NOW(),
+            lease_expires_at=NOW() + %s * INTERVAL '1 second'
+        WHERE id=%s AND worker_id=%s AND state='PROCESSING';
+    """
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(sql, [lease_duration, job_id, worker_id])
+        updated = cur.rowcount
+        close_cursor(cur)
+        conn.commit()
+
+    return updated > 0
+
+
+# Put jobs whose worker stopped heartbeating back on the queue (or fail them once they
+# have used up their attempts), returns the number of jobs touched
+def requeue_expired_jobs(queue, max_attempts=MAX_ATTEMPTS):
+
+    table = QUEUE_TABLES[queue]
+    sql = f"""
+        UPDATE {table} SET
+            state=CASE WHEN attempts >= %s THEN 'ERROR' ELSE 'QUEUED' END,
+            worker_id=NULL,
+            lease_expires_at=NULL
+        WHERE state='PROCESSING' AND lease_expires_at < NOW();
+    """
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(sql, [max_attempts])
+        updated = cur.rowcount
+        close_cursor(cur)
+        conn.commit()
+
+    if updated > 0:
+        print(f'Re-queued {updated} expired {queue} job(s)')
+    return updated
+
+
+# Set the final state (COMPLETED / ERROR) of a job, only if this worker still holds it. Returns False if the job was
+# re-queued and claimed by another worker in the meantime, whose outcome is the one that counts
+def finish_job(queue, job_id, state, worker_id=WORKER_ID):
+
+    table = QUEUE_TABLES[queue]
+    sql = f"""
+        UPDATE {table} SET
+            state=%s,
+            lease_expires_at=NULL
+        WHERE id=%s AND worker_id=%s AND state='PROCESSING';
+    """
+
+    with connection() as conn:
+        cur = create_cursor(conn)
+        cur.execute(sql, [state, job_id, worker_id])
+        updated = cur.rowcount
+        close_cursor(cur)
+        conn.commit()
+
+    if updated == 0:
+        print(f'Not marking {queue} job {job_id} {state}, it is no longer held by this worker')
+    return updated > 0
+
+
+class JobLease:
+    """Keeps a claimed job's lease alive from a background thread while it is processed.
+
+        with JobLease('video', project['id']):
+            ...
+    """
+
+    def __init__(self, queue, job_id, worker_id=WORKER_ID, lease_duration=LEASE_DURATION):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_duration = lease_duration
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_duration / 4):
+            try:
+                if not heartbeat(self.queue, self.job_id, self.worker_id, self.lease_duration):
+                    print(f'Lost lease on {self.queue} job {self.job_id}')
+                    self.lost = True
+                    return
+            except Exception as e:
+                print(f'Error sending heartbeat for {self.queue} job {self.job_id}: {e}')
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+class JobListener:
+    """LISTENs on a queue's NOTIFY channel so idle workers wake up as soon as a job is queued.
+
+    Uses its own autocommit connection (LISTEN can't go through the pool) and reconnects
+    lazily if the connection drops; while it is down `wait` just sleeps, so workers fall
+    back to polling.
+    """
+
+    def __init__(self, queue):
+        self.channel = QUEUE_CHANNELS[queue]
+        self.conn = None
+
+    def _connect(self):
+        self.conn = psycopg2.connect(**database_config())
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = self.conn.cursor()
+        cur.execute(f'LISTEN {self.channel};')
+        cur.close()
+
+    # Block for up to `timeout` seconds, returns True if a job was queued in the meantime
+    def wait(self, timeout):
+        try:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+
+            if select.select([self.conn], [], [], timeout) == ([], [], []):
+                return False
+
+            self.conn.poll()
+            notified = len(self.conn.notifies) > 0
+            self.conn.notifies.clear()
+            return notified
+        except (psycopg2.Error, OSError) as e:
+            print(f'Error listening on {self.channel}: {e}')
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import time
+import random
+
+
+# the path a request's pipeline is registered under in the host's ModelManager (see middleware.setup_pipelines),
+# as listed in the 'models' of its /load report. None for modes with no per-model pipeline
+def model_path(inference_mode, model_id):
+    if not isinstance(inference_mode, str):
+        return None
+    if inference_mode in ['Text to Image', 'Image to Image', 'Pix to Pix']:
+        return f'{inference_mode}/{model_id}'
+    if inference_mode.split(' ')[0] == 'ControlNet' and len(inference_mode.split(' ')) > 1:
+        return f"ControlNet/{inference_mode.split(' ')[1]}/{model_id}"
+    if inference_mode == 'Mask':
+        return 'Mask/Inpainting'
+    return None
+
+
+class CircuitBreaker:
+    """Stops routing to a host after `failure_threshold` consecutive failures.
+
+    While open the host gets no traffic. `reset_timeout` seconds later the breaker turns
+    half-open and lets a single trial request (or health probe) through: a success closes it,
+    a failure opens it for another `reset_timeout`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self.opened = 0
+
+    def allows(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.trial = False
+        if self.state == self.HALF_OPEN:
+            return not self.trial
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trial = False
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        self.trial = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = now
+            self.opened += 1
+
+
+class HostState:
+    """What the proxy knows about one API host.
+
+    `in_flight` counts the requests this proxy is forwarding to the host right now. `load` is
+    the host's last report from its /load endpoint (requests in flight across every proxy and
+    worker, queued image jobs, resident models), trusted for `stale_after` seconds.
+    `latency` is an exponentially weighted moving average of the time the host takes to
+    answer a forwarded request. `breaker` keeps failing hosts out of rotation.
+    """
+
+    def __init__(self, address, breaker=None):
+        self.address = address
+        self.breaker = breaker or CircuitBreaker()
+
+        self.in_flight = 0
+        self.load = None
+        self.load_at = 0
+        self.latency = None
+
+        self.forwarded = 0
+        self.errors = 0
+
+    def has_fresh_load(self, stale_after, now=None):
+        now = time.monotonic() if now is None else now
+        return self.load is not None and now - self.load_at <= stale_after
+
+    # 'gpu' / 'cpu' if the host reported the model as loaded (and on which device), None otherwise
+    def model_tier(self, path):
+        if self.load is None:
+            return None
+        return self.load.get('models', {}).get(path, None)
+
+    # requests the host is working on or has queued. The report lags behind, so what this proxy sent it since counts too
+    def outstanding(self):
+        if self.load is None:
+            return self.in_flight
+        return max(self.in_flight, self.load.get('in_flight', 0)) + self.load.get('queued_jobs', 0)
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'outstanding': self.outstanding(),
+            'latency': self.latency,
+            'load': self.load,
+            'forwarded': self.forwarded,
+            'errors': self.errors,
+            'breaker': self.breaker.state
+        }
+
+
+class LoadBalancer:
+    """Picks the API host for each proxied request.
+
+    When every candidate has reported its load recently, the request goes to the host with
+    the least outstanding work, ties broken by the lower latency EWMA. Otherwise it falls
+    back to the power of two choices: two random candidates, the one with fewer requests in
+    flight from this proxy wins. Not thread safe, the proxy only uses it from its event loop.
+
+    Requests for a model are kept to the hosts that have it resident (on the GPU, else
+    offloaded to CPU) so each checkpoint is loaded on as few hosts as possible, unless those
+    hosts have more than `affinity_slack` requests more outstanding than the least loaded host.
+
+    Hosts whose circuit breaker is open are skipped, see `record_health`.
+    """
+
+    def __init__(self, stale_after=5, latency_alpha=0.2, affinity_slack=2, failure_threshold=3, reset_timeout=30, rng=None):
+        self.stale_after = stale_after
+        self.latency_alpha = latency_alpha
+        self.affinity_slack = affinity_slack
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.rng = rng or random.Random()
+
+        self.hosts = {}
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+
+    # Keeps the state of hosts that are still listed
+    def set_hosts(self, addresses):
+        self.hosts = {
+            address: self.hosts.get(address, None) or HostState(address, CircuitBreaker(self.failure_threshold, self.reset_timeout))
+            for address in addresses
+        }
+
+    def report_load(self, address, load, now=None):
+        host = self.hosts.get(address, None)
+        if host is not None:
+            host.load = load
+            host.load_at = time.monotonic() if now is None else now
+
+    def _cost(self, host):
+        return (host.outstanding(), host.latency if host.latency is not None else 0)
+
+    # the hosts with the model resident on the best tier any of them has it on, empty if none has it loaded
+    def _warm(self, candidates, model, now=None):
+        fresh = [host for host in candidates if host.has_fresh_load(self.stale_after, now)]
+        for tier in ['gpu', 'cpu']:
+            warm = [host for host in fresh if host.model_tier(model) == tier]
+            if len(warm) > 0:
+                return warm
+        return []
+
+    # model is the model_path the request needs, if any. Hosts in exclude (e.g. already tried) are skipped
+    def pick(self, model=None, now=None, exclude=()):
+        candidates = [host for host in self.hosts.values() if host.address not in exclude and host.breaker.allows(now)]
+        if len(candidates) == 0:
+            return None
+
+        if model is not None:
+            warm = self._warm(candidates, model, now)
+            if len(warm) > 0:
+                host = min(warm, key=self._cost)
+                if host.outstanding() <= min(candidate.outstanding() for candidate in candidates) + self.affinity_slack:
+                    self.affinity_hits += 1
+                    return host
+            self.affinity_misses += 1
+
+        if all(host.has_fresh_load(self.stale_after, now) for host in candidates):
+            return min(candidates, key=self._cost)
+
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = self.rng.sample(candidates, 2)
+        return min(first, second, key=lambda host: (host.in_flight, host.latency if host.latency is not None else 0))
+
+    def start(self, host):
+        host.in_flight += 1
+        if host.breaker.state == CircuitBreaker.HALF_OPEN:
+            # the trial request, no other request goes to the host until it's done
+            host.breaker.trial = True
+
+    # outcome of a forwarded request or a health probe
+    def record_health(self, host, healthy, now=None):
+        if healthy:
+            host.breaker.record_success()
+        else:
+            host.breaker.record_failure(now)
+
+    # health probes only count while the host would get traffic, an open breaker still waits out its reset_timeout
+    def record_probe(self, host, healthy, now=None):
+        if host.breaker.allows(now):
+            self.record_health(host, healthy, now)
+
+    # latency in seconds, None if the request failed before the host answered
+    def finish(self, host, latency=None):
+        host.in_flight -= 1
+        if latency is None:
+            host.errors += 1
+            return
+
+        host.forwarded += 1
+        if host.latency is None:
+            host.latency = latency
+        else:
+            host.latency = self.latency_alpha * latency + (1 - self.latency_alpha) * host.latency
+
+    # a request abandoned by its client, counts neither for nor against the host
+    def cancel(self, host):
+        host.in_flight -= 1
+        if host.breaker.state == CircuitBreaker.HALF_OPEN:
+            # let another request be the trial
+            host.breaker.trial = False
+
+    def stats(self):
+        return {address: host.stats() for address, host in self.hosts.items()}
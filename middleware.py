@@ -14,21 +14,25 @@ import torch
 from PIL import Image
 from googletrans import Translator
 import io
+import gc
 import torchaudio
 
 from transformers import pipeline, AutoImageProcessor, UperNetForSemanticSegmentation
 from clip_interrogator import Config, Interrogator
 from transformers.generation_utils import GenerationMixin
-from diffusers import DiffusionPipeline, DPMSolverMultistepScheduler, StableDiffusionImg2ImgPipeline,\
+from diffusers import DiffusionPipeline, DPMSolverMultistepScheduler, StableDiffusionPipeline, StableDiffusionImg2ImgPipeline,\
     StableDiffusionInstructPix2PixPipeline, EulerAncestralDiscreteScheduler, StableDiffusionUpscalePipeline,\
     StableDiffusionControlNetPipeline, ControlNetModel, UniPCMultistepScheduler
 
-from inpainting import StableDiffusionControlNetInpaintPipeline, image_to_seg
+from inpainting import StableDiffusionControlNetInpaintPipeline
 from segment_anything import sam_model_registry
 from audio_generation import CustomMusicGen, tensor_to_audio_bytes, Demucs, preprocess_audio
+from batching import InferenceBatcher
+from prompt_cache import prompt_embeddings
+from model_manager import ModelManager
 
-from utils import fetch_env_config, get_device, preprocess, adjust_thickness, \
-                 BASE_MODELS, INSTRUCTABLE_MODELS, INTERROGATOR_MODELS, TEXT_MODELS, UPSCALE_MODELS, PALETTE
+from utils import fetch_env_config, get_device, preprocess, adjust_thickness, mask_from_base_64, segment_image, \
+                 BASE_MODELS, INSTRUCTABLE_MODELS, INTERROGATOR_MODELS, TEXT_MODELS, UPSCALE_MODELS
 
 config = fetch_env_config()
 torch.backends.cudnn.benchmark = False
@@ -40,102 +44,181 @@ torch.use_deterministic_algorithms(True, warn_only=True)
 ######################## SETUP ########################
 #######################################################
 
-PIPELINE_DICT = {
-    'Text to Image': {},
-    'Image to Image': {},
-    'Pix to Pix': {},
-    'Text': {},
-    'Mask': {},
-    'Interrogator': {},
-    'Upscale': {},
-    'ControlNet': {
-        'Outlines': {},
-        'Segmentation': {},
-        'Depth': {}
-    },
-    'Image Processor': {},
-    'Image Segmentor': {},
-    'Depth Estimator': {}
-}
+# every model the server can use, keyed by its path, e.g. ('Text to Image', model_id) or ('ControlNet', 'Depth', model_id).
+# Models are loaded on first use and evicted least-recently-used GPU -> CPU -> dropped to stay within the budgets (0 = unlimited)
+MODEL_GPU_MEMORY_BUDGET_GB = float(config.get('model_gpu_memory_budget_gb', 0))
+MODEL_CPU_MEMORY_BUDGET_GB = float(config.get('model_cpu_memory_budget_gb', 0))
+# modes loaded at startup instead of on their first request
+PRELOAD_MODELS = config.get('preload_models', ['Text to Image'])
+
+CONTROL_NET_BASE_MODEL = "runwayml/stable-diffusion-v1-5"
 
 IMAGE_PROCESSOR = None
 IMAGE_SEGMENTOR = None
 DEPTH_ESTIMATOR = None
 
+# single-image Text to Image / Image to Image requests that share a model, resolution and sampler
+# settings and arrive within the wait window are run as one batched pipeline call (1 = no batching)
+INFERENCE_MAX_BATCH_SIZE = int(config.get('inference_max_batch_size', 4))
+INFERENCE_MAX_BATCH_WAIT_MS = float(config.get('inference_max_batch_wait_ms', 50))
+
+INFERENCE_BATCHER = InferenceBatcher(
+    max_batch_size=INFERENCE_MAX_BATCH_SIZE,
+    max_wait=INFERENCE_MAX_BATCH_WAIT_MS / 1000.0
+) if INFERENCE_MAX_BATCH_SIZE > 1 else None
+
 def _no_validate_model_kwargs(self, model_kwargs):
     pass
 
+# The torch modules holding a model's weights (diffusers pipeline, transformers pipeline, plain module or e.g. an Interrogator)
+def torch_modules(model):
+    if isinstance(model, torch.nn.Module):
+        return [model]
+    if hasattr(model, 'components'):
+        return [component for component in model.components.values() if isinstance(component, torch.nn.Module)]
+    if isinstance(getattr(model, 'model', None), torch.nn.Module):
+        return [model.model]
+    return [value for value in getattr(model, '__dict__', {}).values() if isinstance(value, torch.nn.Module)]
+
+def module_bytes(module):
+    return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+# Bytes of weights held by a list of models, modules shared between them are only counted once
+def models_bytes(models):
+    unique = {}
+    for model in models:
+        for module in torch_modules(model):
+            unique[id(module)] = module
+    return sum(module_bytes(module) for module in unique.values())
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+MODEL_MANAGER = ModelManager(
+    gpu_budget=MODEL_GPU_MEMORY_BUDGET_GB * 1024**3,
+    cpu_budget=MODEL_CPU_MEMORY_BUDGET_GB * 1024**3,
+    measure=models_bytes,
+    release=release_memory
+)
+
+# Print the weight memory of every loaded model and how much of it is shared between them
+def report_pipeline_memory(models):
+    total = 0
+    for path, model in models.items():
+        model_bytes = models_bytes([model])
+        total += model_bytes
+        print('{}: {:.2f} GB'.format(path, model_bytes / 1024**3))
+
+    print('Model weights: {:.2f} GB loaded, {:.2f} GB without sharing'.format(models_bytes(list(models.values())) / 1024**3, total / 1024**3))
+    if torch.cuda.is_available():
+        print('CUDA memory allocated: {:.2f} GB, reserved: {:.2f} GB'.format(torch.cuda.memory_allocated() / 1024**3, torch.cuda.memory_reserved() / 1024**3))
+
+# Text to Image, Image to Image and ControlNet Outlines pipelines for a base model, all built from one copy of its
+# weights (unet, vae, text_encoder, ...). Each pipeline only gets its own scheduler, schedulers keep per-run state.
+def load_base_model_pipelines(base_model):
+    control_net_canny = ControlNetModel.from_pretrained("thibaud/controlnet-sd21-canny-diffusers", torch_dtype=torch.float16)
+    components = DiffusionPipeline.from_pretrained(base_model, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16).to('cuda').components
+
+    text_to_image = StableDiffusionPipeline(**components)
+    text_to_image.scheduler = DPMSolverMultistepScheduler.from_config(components['scheduler'].config)
+    image_to_image = StableDiffusionImg2ImgPipeline(**components)
+    image_to_image.scheduler = DPMSolverMultistepScheduler.from_config(components['scheduler'].config)
+    # no cpu offload here: offloading would move the shared unet / vae off the GPU under the other pipelines,
+    # and with shared weights only the controlnet itself is extra memory
+    outlines = StableDiffusionControlNetPipeline(**components, controlnet=control_net_canny.to('cuda'))
+    outlines.scheduler = UniPCMultistepScheduler.from_config(components['scheduler'].config)
+
+    return {
+        ('Text to Image', base_model): text_to_image,
+        ('Image to Image', base_model): image_to_image,
+        ('ControlNet', 'Outlines', base_model): outlines
+    }
+
+def load_control_net_depth():
+    control_net_depth = ControlNetModel.from_pretrained("lllyasviel/control_v11f1p_sd15_depth", torch_dtype=torch.float16)
+    control_net_pipeline = StableDiffusionControlNetPipeline.from_pretrained(CONTROL_NET_BASE_MODEL, controlnet=control_net_depth, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
+    control_net_pipeline.scheduler = UniPCMultistepScheduler.from_config(control_net_pipeline.scheduler.config)
+    control_net_pipeline.enable_model_cpu_offload()
+    return control_net_pipeline
+
+def load_interrogator(interrogator_model):
+    ci_config = Config()
+    ci_config.blip_num_beams = 64
+    ci_config.blip_offload = False
+    ci_config.clip_model_name = interrogator_model
+    return Interrogator(ci_config)
+
+def load_upscale_pipeline(upscale_model):
+    upscale_pipeline = StableDiffusionUpscalePipeline.from_pretrained(upscale_model, safety_checker=None, feature_extractor=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
+    return upscale_pipeline.to('cuda')
+
+# Registers every model with MODEL_MANAGER and loads the PRELOAD_MODELS, the rest are loaded on first use
 def setup_pipelines():
     GenerationMixin._validate_model_kwargs = _no_validate_model_kwargs
-    
-    control_net_canny = ControlNetModel.from_pretrained("thibaud/controlnet-sd21-canny-diffusers", torch_dtype=torch.float16)
-    PIPELINE_DICT['Image Processor'] = AutoImageProcessor.from_pretrained("openmmlab/upernet-convnext-small")
-    PIPELINE_DICT['Image Segmentor'] = UperNetForSemanticSegmentation.from_pretrained("openmmlab/upernet-convnext-small")
+
+    if get_device() != 'cuda':
+        sys.exit('Need CUDA to run this server!')
+
+    MODEL_MANAGER.register_model(('Image Processor',), lambda: AutoImageProcessor.from_pretrained("openmmlab/upernet-convnext-small"), device='cpu')
+    MODEL_MANAGER.register_model(('Image Segmentor',), lambda: UperNetForSemanticSegmentation.from_pretrained("openmmlab/upernet-convnext-small"), device='cpu')
+    MODEL_MANAGER.register_model(('Depth Estimator',), lambda: pipeline('depth-estimation'), device='cpu')
     # control_net_seg = ControlNetModel.from_pretrained("lllyasviel/control_v11p_sd15_seg", torch_dtype=torch.float16)
     # control_net_seg_inpaint = ControlNetModel.from_pretrained('lllyasviel/sd-controlnet-seg', torch_dtype=torch.float16)
-    PIPELINE_DICT['Depth Estimator'] = pipeline('depth-estimation')
-    control_net_depth = ControlNetModel.from_pretrained("lllyasviel/control_v11f1p_sd15_depth", torch_dtype=torch.float16)
-    CONTROL_NET_BASE_MODEL = "runwayml/stable-diffusion-v1-5"
-
-    if get_device() == 'cuda':
-        for base_model in BASE_MODELS:
-            PIPELINE_DICT['Text to Image'][base_model] = DiffusionPipeline.from_pretrained(base_model, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-            PIPELINE_DICT['Text to Image'][base_model].scheduler = DPMSolverMultistepScheduler.from_config(PIPELINE_DICT['Text to Image'][base_model].scheduler.config)
-            PIPELINE_DICT['Text to Image'][base_model] = PIPELINE_DICT['Text to Image'][base_model].to('cuda')
-            PIPELINE_DICT['Image to Image'][base_model] = StableDiffusionImg2ImgPipeline.from_pretrained(base_model, safety_checker=None, feature_extractor=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-            PIPELINE_DICT['Image to Image'][base_model].scheduler = DPMSolverMultistepScheduler.from_config(PIPELINE_DICT['Image to Image'][base_model].scheduler.config)
-            PIPELINE_DICT['Image to Image'][base_model] = PIPELINE_DICT['Image to Image'][base_model].to('cuda')
-            PIPELINE_DICT['ControlNet']['Outlines'][base_model] = StableDiffusionControlNetPipeline.from_pretrained(base_model, controlnet=control_net_canny, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-            PIPELINE_DICT['ControlNet']['Outlines'][base_model].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['ControlNet']['Outlines'][base_model].scheduler.config)
-            PIPELINE_DICT['ControlNet']['Outlines'][base_model].enable_model_cpu_offload()
-        #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL] = StableDiffusionControlNetPipeline.from_pretrained(CONTROL_NET_BASE_MODEL, controlnet=control_net_seg, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-        #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].scheduler.config)
-        #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].enable_model_cpu_offload()
-            PIPELINE_DICT['ControlNet']['Depth'][CONTROL_NET_BASE_MODEL] = StableDiffusionControlNetPipeline.from_pretrained(CONTROL_NET_BASE_MODEL, controlnet=control_net_depth, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-            PIPELINE_DICT['ControlNet']['Depth'][CONTROL_NET_BASE_MODEL].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['ControlNet']['Depth'][CONTROL_NET_BASE_MODEL].scheduler.config)
-            PIPELINE_DICT['ControlNet']['Depth'][CONTROL_NET_BASE_MODEL].enable_model_cpu_offload()
-        # for instructable_model in INSTRUCTABLE_MODELS:
-            # PIPELINE_DICT['Pix to Pix'][instructable_model] = StableDiffusionInstructPix2PixPipeline.from_pretrained(instructable_model, safety_checker=None, feature_extractor=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-            # PIPELINE_DICT['Pix to Pix'][instructable_model] = PIPELINE_DICT['Pix to Pix'][instructable_model].to('cuda')
-            # PIPELINE_DICT['Pix to Pix'][instructable_model].scheduler = EulerAncestralDiscreteScheduler.from_config(PIPELINE_DICT['Pix to Pix'][instructable_model].scheduler.config)
-
-        '''
-        PIPELINE_DICT['Mask']['Inpainting'] = StableDiffusionControlNetInpaintPipeline.from_pretrained('runwayml/stable-diffusion-inpainting', controlnet=control_net_seg_inpaint, safety_checker=None, torch_dtype=torch.float16)
-        PIPELINE_DICT['Mask']['Inpainting'].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['Mask']['Inpainting'].scheduler.config)
-        PIPELINE_DICT['Mask']['Inpainting'].enable_xformers_memory_efficient_attention()
-        PIPELINE_DICT['Mask']['Inpainting'].enable_model_cpu_offload()
-
-        if not os.path.exists('models/sam_vit_h_4b8939.pth'):
-            if not os.path.isdir('models'):
-                os.mkdir('models')
-
-            print('Downloading SAM model...')
-            res = requests.get('https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth')
-            with open('models/sam_vit_h_4b8939.pth', 'wb') as f:
-                f.write(res.content)
-
-        PIPELINE_DICT['Mask']['SAM'] = sam_model_registry["default"](checkpoint="models/sam_vit_h_4b8939.pth").to(device='cuda')
-        '''
 
-            
-    else:
-        sys.exit('Need CUDA to run this server!')
-    
+    for base_model in BASE_MODELS:
+        # the shared weights are loaded, offloaded and evicted as one group
+        MODEL_MANAGER.register(
+            base_model,
+            lambda base_model=base_model: load_base_model_pipelines(base_model),
+            paths=[('Text to Image', base_model), ('Image to Image', base_model), ('ControlNet', 'Outlines', base_model)],
+            offload=True
+        )
+    # enable_model_cpu_offload() already keeps this one on the CPU between calls
+    MODEL_MANAGER.register_model(('ControlNet', 'Depth', CONTROL_NET_BASE_MODEL), load_control_net_depth, device='cpu')
+    #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL] = StableDiffusionControlNetPipeline.from_pretrained(CONTROL_NET_BASE_MODEL, controlnet=control_net_seg, safety_checker=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
+    #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].scheduler.config)
+    #     PIPELINE_DICT['ControlNet']['Segmentation'][CONTROL_NET_BASE_MODEL].enable_model_cpu_offload()
+    # for instructable_model in INSTRUCTABLE_MODELS:
+        # PIPELINE_DICT['Pix to Pix'][instructable_model] = StableDiffusionInstructPix2PixPipeline.from_pretrained(instructable_model, safety_checker=None, feature_extractor=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
+        # PIPELINE_DICT['Pix to Pix'][instructable_model] = PIPELINE_DICT['Pix to Pix'][instructable_model].to('cuda')
+        # PIPELINE_DICT['Pix to Pix'][instructable_model].scheduler = EulerAncestralDiscreteScheduler.from_config(PIPELINE_DICT['Pix to Pix'][instructable_model].scheduler.config)
+
+    '''
+    PIPELINE_DICT['Mask']['Inpainting'] = StableDiffusionControlNetInpaintPipeline.from_pretrained('runwayml/stable-diffusion-inpainting', controlnet=control_net_seg_inpaint, safety_checker=None, torch_dtype=torch.float16)
+    PIPELINE_DICT['Mask']['Inpainting'].scheduler = UniPCMultistepScheduler.from_config(PIPELINE_DICT['Mask']['Inpainting'].scheduler.config)
+    PIPELINE_DICT['Mask']['Inpainting'].enable_xformers_memory_efficient_attention()
+    PIPELINE_DICT['Mask']['Inpainting'].enable_model_cpu_offload()
+
+    if not os.path.exists('models/sam_vit_h_4b8939.pth'):
+        if not os.path.isdir('models'):
+            os.mkdir('models')
+
+        print('Downloading SAM model...')
+        res = requests.get('https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth')
+        with open('models/sam_vit_h_4b8939.pth', 'wb') as f:
+            f.write(res.content)
+
+    PIPELINE_DICT['Mask']['SAM'] = sam_model_registry["default"](checkpoint="models/sam_vit_h_4b8939.pth").to(device='cuda')
+    '''
+
     for text_model in TEXT_MODELS:
-        PIPELINE_DICT['Text'][text_model] = pipeline('text-generation', model=text_model, device=0)
+        # transformers pipelines keep their device, so they are dropped rather than offloaded
+        MODEL_MANAGER.register_model(('Text', text_model), lambda text_model=text_model: pipeline('text-generation', model=text_model, device=0))
 
     for interrogator_model in INTERROGATOR_MODELS:
-        ci_config = Config()
-        ci_config.blip_num_beams = 64
-        ci_config.blip_offload = False
-        ci_config.clip_model_name = interrogator_model
-        PIPELINE_DICT['Interrogator'][interrogator_model] = Interrogator(ci_config)
+        MODEL_MANAGER.register_model(('Interrogator', interrogator_model), lambda interrogator_model=interrogator_model: load_interrogator(interrogator_model))
 
     for upscale_model in UPSCALE_MODELS:
-        PIPELINE_DICT['Upscale'][upscale_model] = StableDiffusionUpscalePipeline.from_pretrained(upscale_model, safety_checker=None, feature_extractor=None, use_auth_token=config['huggingface_token'], torch_dtype=torch.float16)
-        PIPELINE_DICT['Upscale'][upscale_model] = PIPELINE_DICT['Upscale'][upscale_model].to('cuda')
+        MODEL_MANAGER.register_model(('Upscale', upscale_model), lambda upscale_model=upscale_model: load_upscale_pipeline(upscale_model), offload=True)
+
+    for mode in PRELOAD_MODELS:
+        MODEL_MANAGER.preload(*mode.split('/'))
+
+    report_pipeline_memory(MODEL_MANAGER.loaded())
 
-    return PIPELINE_DICT
+    return MODEL_MANAGER
 
 AUDIO_DICT = {
     'Text to Audio': {},
@@ -199,7 +282,7 @@ def separate_audio_tracks(audio_pipline, wav, sr):
         yield buffer.read(), name
     
 
-def txt_to_img(img_pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, seed=None):
+def txt_to_img(img_pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, seed=None, callback=None):
 
     translator = Translator()
 
@@ -230,35 +313,101 @@ def txt_to_img(img_pipeline, prompt, generator, n_images, negative_prompt, steps
         return images
     
     else:
+        prompt = "" if len(prompt) == 0 else translator.translate(prompt).text
+        negative_prompt = "" if len(negative_prompt) == 0 else translator.translate(negative_prompt).text
+        height = int(aspect_ratio.split(':')[1])
+        width = int(aspect_ratio.split(':')[0])
+
+        # one image per request keeps each request's own generator, so batched output matches unbatched output
+        if INFERENCE_BATCHER is not None and n_images == 1:
+            return INFERENCE_BATCHER.submit(
+                key=('Text to Image', id(img_pipeline), steps, scale, height, width),
+                run_batch=lambda requests: txt_to_img_batch(img_pipeline, requests, steps, scale, height, width),
+                request={'prompt': prompt, 'negative_prompt': negative_prompt, 'generator': generator, 'callback': callback}
+            )
+
         images = img_pipeline(
-            "" if len(prompt) == 0 else translator.translate(prompt).text,
+            **prompt_embeddings(img_pipeline, prompt, negative_prompt),
             generator=generator,
             num_images_per_prompt=n_images,
-            negative_prompt= "" if len(negative_prompt) == 0 else translator.translate(negative_prompt).text,
             num_inference_steps=steps,
             guidance_scale=scale,
-            height=int(aspect_ratio.split(':')[1]),
-            width=int(aspect_ratio.split(':')[0])
+            height=height,
+            width=width,
+            callback=callback
         ).images
         return images
 
 
-def img_to_img(i2i_pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, img, strength):
+# Fan a batched pipeline's step callback out to the callbacks of the requests in the batch
+def batch_callback(requests):
+
+    callbacks = [request['callback'] for request in requests if request.get('callback') is not None]
+    if len(callbacks) == 0:
+        return None
+
+    def callback(step, timestep, latents):
+        for request_callback in callbacks:
+            request_callback(step, timestep, latents)
+    return callback
+
+
+# Run several single-image Text to Image requests as one pipeline call, returns a list of images per request
+def txt_to_img_batch(img_pipeline, requests, steps, scale, height, width):
+
+    images = img_pipeline(
+        **prompt_embeddings(img_pipeline, [request['prompt'] for request in requests], [request['negative_prompt'] for request in requests]),
+        generator=[request['generator'] for request in requests],
+        num_images_per_prompt=1,
+        num_inference_steps=steps,
+        guidance_scale=scale,
+        height=height,
+        width=width,
+        callback=batch_callback(requests)
+    ).images
+    return [[image] for image in images]
+
+
+def img_to_img(i2i_pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, img, strength, callback=None):
 
     img = preprocess(img)
+
+    if INFERENCE_BATCHER is not None and n_images == 1:
+        return INFERENCE_BATCHER.submit(
+            key=('Image to Image', id(i2i_pipeline), int(steps), scale, strength, tuple(img.shape)),
+            run_batch=lambda requests: img_to_img_batch(i2i_pipeline, requests, int(steps), scale, strength),
+            request={'prompt': prompt, 'negative_prompt': negative_prompt or "", 'generator': generator, 'img': img, 'callback': callback}
+        )
+
     images = i2i_pipeline(
-        prompt,
+        **prompt_embeddings(i2i_pipeline, prompt, negative_prompt),
         generator=generator,
         num_images_per_prompt = n_images,
-        negative_prompt = negative_prompt,
         num_inference_steps = int(steps),
         guidance_scale = scale,
         image = img,
-        strength = strength
+        strength = strength,
+        callback = callback
     ).images
     return images
 
 
+# Run several single-image Image to Image requests (same input size) as one pipeline call
+def img_to_img_batch(i2i_pipeline, requests, steps, scale, strength):
+
+    images = i2i_pipeline(
+        **prompt_embeddings(i2i_pipeline, [request['prompt'] for request in requests], [request['negative_prompt'] for request in requests]),
+        generator=[request['generator'] for request in requests],
+        num_images_per_prompt = 1,
+        num_inference_steps = steps,
+        guidance_scale = scale,
+        image = torch.cat([request['img'] for request in requests]),
+        strength = strength,
+        callback = batch_callback(requests)
+    ).images
+    return [[image] for image in images]
+
+
 def pix_to_pix(p2p_pipeline, prompt, generator, n_images, steps, scale, img):
 
     img = preprocess(img)
@@ -277,9 +426,8 @@ def control_net_outlines(control_net_pipeline, prompt, generator, negative_promp
     
     canny_img = adjust_thickness(img, thickness)
     images = control_net_pipeline(
-        prompt,
-        canny_img,
-        negative_prompt= "" if len(negative_prompt) == 0 else negative_prompt,
+        image=canny_img,
+        **prompt_embeddings(control_net_pipeline, prompt, negative_prompt),
         generator=generator,
         num_inference_steps=steps,
     ).images
@@ -288,16 +436,16 @@ def control_net_outlines(control_net_pipeline, prompt, generator, negative_promp
 
 def control_net_depth(control_net_pipeline, prompt, generator, negative_prompt, steps, img):
     
-    image = PIPELINE_DICT['Depth Estimator'](img)['depth']
+    with MODEL_MANAGER.use('Depth Estimator') as depth_estimator:
+        image = depth_estimator(img)['depth']
     image = numpy.array(image)
     image = image[:, :, None]
     image = numpy.concatenate([image, image, image], axis=2)
     depth_img = Image.fromarray(image)
 
     images = control_net_pipeline(
-        prompt,
-        depth_img,
-        negative_prompt= "" if len(negative_prompt) == 0 else negative_prompt,
+        image=depth_img,
+        **prompt_embeddings(control_net_pipeline, prompt, negative_prompt),
         generator=generator,
         num_inference_steps=steps,
     ).images
@@ -306,22 +454,12 @@ def control_net_depth(control_net_pipeline, prompt, generator, negative_prompt,
 
 def control_net_segmentation(control_net_pipeline, prompt, generator, negative_prompt, steps, img):
     
-    pixel_values = PIPELINE_DICT['Image Processor'](img, return_tensors="pt").pixel_values
-
-    with torch.no_grad():
-        outputs = PIPELINE_DICT['Image Segmentor'](pixel_values)
-
-    seg = PIPELINE_DICT['Image Processor'].post_process_semantic_segmentation(outputs, target_sizes=[img.size[::-1]])[0]
-    color_seg = numpy.zeros((seg.shape[0], seg.shape[1], 3), dtype=numpy.uint8)
-    for label, color in enumerate(PALETTE):
-        color_seg[seg == label, :] = color
-    color_seg = color_seg.astype(numpy.uint8)
-    segmented_img = Image.fromarray(color_seg)
+    with MODEL_MANAGER.use('Image Processor') as image_processor, MODEL_MANAGER.use('Image Segmentor') as image_segmentor:
+        segmented_img = segment_image(image_processor, image_segmentor, img)
 
     images = control_net_pipeline(
-        prompt,
-        segmented_img,
-        negative_prompt= "" if len(negative_prompt) == 0 else negative_prompt,
+        image=segmented_img,
+        **prompt_embeddings(control_net_pipeline, prompt, negative_prompt),
         generator=generator,
         num_inference_steps=steps,
     ).images
@@ -329,26 +467,16 @@ def control_net_segmentation(control_net_pipeline, prompt, generator, negative_p
 
 
 def control_net_mask(mask_pipeline, prompt, generator, negative_prompt, steps, img, base64_mask):
-    byte_mask = base64.b64decode(base64_mask)
-    binary_mask = numpy.frombuffer(byte_mask, dtype=numpy.uint8)
-    boolean_mask = numpy.unpackbits(binary_mask, axis=-1).astype(bool)
+    mask_image = mask_from_base_64(base64_mask, img.width, img.height)
 
-    dimensions = (img.width, img.height)
-    mask_image = Image.new('RGB', dimensions, (0, 0, 0))
-
-    for y in range(dimensions[1]):
-        for x in range(dimensions[0]):
-            if boolean_mask[y * dimensions[0] + x]:
-                mask_image.putpixel((x, y), (255, 255, 255))
-
-    conditioning_image = image_to_seg(PIPELINE_DICT['Image Processor'], PIPELINE_DICT['Image Segmentor'], img)
+    with MODEL_MANAGER.use('Image Processor') as image_processor, MODEL_MANAGER.use('Image Segmentor') as image_segmentor:
+        conditioning_image = segment_image(image_processor, image_segmentor, img)
 
     generated_images = mask_pipeline(
-        prompt,
-        img,
-        mask_image,
-        conditioning_image,
-        negative_prompt=negative_prompt,
+        image=img,
+        mask_image=mask_image,
+        controlnet_conditioning_image=conditioning_image,
+        **prompt_embeddings(mask_pipeline, prompt, negative_prompt),
         generator=generator,
         num_inference_steps=steps
     ).images
@@ -456,20 +584,21 @@ def control_net_mask(mask_pipeline, prompt, generator, negative_prompt, steps, i
 #         return False
 
 
-def inference(pipeline, inf_mode, prompt, n_images=4, negative_prompt="", steps=25, scale=7.5, seed=1437181781, aspect_ratio='768:768', img=None, strength=0.5, mask=None):
+# `callback(step, timestep, latents)` is called after every denoising step (Text to Image / Image to Image only)
+def inference(pipeline, inf_mode, prompt, n_images=4, negative_prompt="", steps=25, scale=7.5, seed=1437181781, aspect_ratio='768:768', img=None, strength=0.5, mask=None, callback=None):
 
     generator = torch.Generator('cuda').manual_seed(seed)
 
     try:
         
         if inf_mode == 'Text to Image':
-            return txt_to_img(pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, seed)
+            return txt_to_img(pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, seed, callback=callback)
         else:
             if img is None:
                 return None
             
             if inf_mode == 'Image to Image':
-                return img_to_img(pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, img, strength)
+                return img_to_img(pipeline, prompt, generator, n_images, negative_prompt, steps, scale, aspect_ratio, img, strength, callback=callback)
         
             elif inf_mode == 'Pix to Pix':
                 return pix_to_pix(pipeline, prompt, generator, n_images, steps, scale, img)
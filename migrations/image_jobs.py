@@ -0,0 +1,40 @@
+import sys
+sys.path.append('../nouns-ai-sd-server')  # allows import from parent directory
+
+import db
+
+if __name__ == '__main__':
+    conn = db.open_connection()
+    cur = db.create_cursor(conn)
+
+    print('Creating table: image_jobs')
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS image_jobs (
+            id VARCHAR(36) NOT NULL,
+            user_id INT NOT NULL,
+            state VARCHAR(36) NOT NULL DEFAULT 'QUEUED',
+            progress REAL NOT NULL DEFAULT 0,
+            image_id INT,
+            cdn_id VARCHAR(256),
+            error TEXT,
+            metadata JSON NOT NULL,
+            worker_id VARCHAR(256),
+            lease_expires_at TIMESTAMP,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY(id),
+            CONSTRAINT fk_user FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # tables created before jobs were leased to the process running them
+    cur.execute("ALTER TABLE image_jobs ADD COLUMN IF NOT EXISTS worker_id VARCHAR(256);")
+    cur.execute("ALTER TABLE image_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;")
+    conn.commit()
+
+    db.close_cursor(cur)
+    db.close_connection(conn)
+
+    print('finished')
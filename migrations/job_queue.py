@@ -0,0 +1,35 @@
+import sys
+sys.path.append('../nouns-ai-sd-server')  # allows import from parent directory
+
+import db
+
+if __name__ == '__main__':
+    conn = db.open_connection()
+    cur = db.create_cursor(conn)
+
+    for table in ['video_projects', 'audio']:
+        print(f'TABLE {table}: adding worker_id, attempts, heartbeat_at, lease_expires_at fields')
+
+        cur.execute(
+            f"""
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS worker_id VARCHAR(128);
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP;
+            ALTER TABLE {table} ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+            """
+        )
+        conn.commit()
+
+        print(f'TABLE {table}: adding queue index')
+
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {table}_queue_idx ON {table} (updated_at) WHERE state = 'QUEUED';
+            """
+        )
+        conn.commit()
+
+    db.close_cursor(cur)
+    db.close_connection(conn)
+
+    print('finished')
@@ -0,0 +1,40 @@
+import sys
+sys.path.append('../nouns-ai-sd-server')  # allows import from parent directory
+
+import db
+
+if __name__ == '__main__':
+    conn = db.open_connection()
+    cur = db.create_cursor(conn)
+
+    print('Creating table: pending_uploads')
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            id INT GENERATED ALWAYS AS IDENTITY,
+            zone VARCHAR(36) NOT NULL,
+            path VARCHAR(512) NOT NULL,
+            payload BYTEA,
+            source_path VARCHAR(1024),
+            host VARCHAR(256),
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY(id),
+            UNIQUE(zone, path)
+        );
+        """
+    )
+    # tables created before failed file uploads were kept on disk
+    cur.execute("ALTER TABLE pending_uploads ADD COLUMN IF NOT EXISTS source_path VARCHAR(1024);")
+    cur.execute("ALTER TABLE pending_uploads ALTER COLUMN payload DROP NOT NULL;")
+    # the host a file was spooled on, only that host can read it back
+    cur.execute("ALTER TABLE pending_uploads ADD COLUMN IF NOT EXISTS host VARCHAR(256);")
+    conn.commit()
+
+    db.close_cursor(cur)
+    db.close_connection(conn)
+
+    print('finished')
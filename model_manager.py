@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+class ModelGroup:
+    """Models that are loaded, moved and evicted together, e.g. every pipeline built on one base model's weights."""
+
+    def __init__(self, name, loader, paths, device, offload):
+        self.name = name
+        self.loader = loader
+        self.paths = [tuple(path) for path in paths]
+        self.device = device
+        self.offload = offload
+
+        self.lock = threading.Lock()
+        self.models = None
+        self.tier = None # 'gpu' / 'cpu' while loaded, None when only on disk (e.g. the huggingface cache)
+        self.bytes = 0
+        self.last_used = 0
+        self.in_use = 0
+        self.evicting = False # being moved / dropped, its lock is held until that's done
+
+    # tier the group occupies when it's on its own device
+    @property
+    def home_tier(self):
+        return 'cpu' if self.device == 'cpu' else 'gpu'
+
+
+class ModelManager:
+    """Loads models on first use and keeps them within a GPU / CPU memory budget.
+
+    Models are registered under their PIPELINE_DICT paths, e.g. ('Text to Image', model_id),
+    with a loader that is only called when the path is first used:
+
+        with MODEL_MANAGER.use('Text to Image', model_id) as pipeline:
+            ...
+
+    When a tier goes over budget the least recently used groups that aren't in use are moved
+    GPU -> CPU (if `offload` is set, otherwise dropped) and CPU -> dropped. Dropped models are
+    reloaded from disk on their next use. A budget of 0 means unlimited. Victims are picked under
+    the manager lock but moved and released outside of it, holding only their own group lock,
+    so other groups can be used meanwhile and uses of the victim wait until it has settled.
+
+    `measure(models)` returns the bytes a list of models occupies, `release()` is called after
+    models were moved or dropped (e.g. to empty the CUDA cache).
+    """
+
+    def __init__(self, gpu_budget=0, cpu_budget=0, measure=None, release=None):
+        self.gpu_budget = gpu_budget
+        self.cpu_budget = cpu_budget
+        self.measure = measure if measure is not None else (lambda models: 0)
+        self.release = release if release is not None else (lambda: None)
+
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._paths = {}
+        self._stats = {}
+        self._clock = 0
+
+    def register(self, name, loader, paths, device='cuda', offload=True):
+        """Register a group, `loader()` must return a {path: model} dict for all of `paths`."""
+        group = ModelGroup(name, loader, paths, device, offload)
+        with self._lock:
+            self._groups[name] = group
+            for path in group.paths:
+                self._paths[path] = group
+                self._stats[path] = {'hits': 0, 'misses': 0, 'restores': 0, 'evictions': 0, 'load_seconds': 0.0}
+
+    def register_model(self, path, loader, device='cuda', offload=False):
+        path = tuple(path)
+        self.register('/'.join(path), lambda: {path: loader()}, [path], device=device, offload=offload)
+
+    def paths(self):
+        return list(self._paths.keys())
+
+    @contextmanager
+    def use(self, *path):
+        group = self._acquire(tuple(path))
+        try:
+            yield group.models[tuple(path)]
+        finally:
+            with self._lock:
+                group.in_use -= 1
+
+    def preload(self, *prefix):
+        """Load every registered path starting with `prefix`, e.g. preload('Text to Image')."""
+        for path in self.paths():
+            if path[:len(prefix)] == tuple(prefix):
+                with self.use(*path):
+                    pass
+
+    def _acquire(self, path):
+        group = self._paths[path]
+        stats = self._stats[path]
+
+        # the group lock serialises loads / restores of one group without blocking the others
+        with group.lock:
+            with self._lock:
+                group.in_use += 1 # never evicted while in use
+                tier = group.tier
+
+            try:
+                if tier is None:
+                    start = time.time()
+                    models = group.loader()
+                    load_seconds = time.time() - start
+                    size = self.measure(list(models.values()))
+                    print('Loaded {} in {:.1f}s ({:.2f} GB)'.format(group.name, load_seconds, size / 1024**3))
+                elif tier != group.home_tier:
+                    for model in group.models.values():
+                        model.to(group.device)
+            except Exception:
+                with self._lock:
+                    group.in_use -= 1
+                raise
+
+            with self._lock:
+                if tier is None:
+                    group.models = models
+                    group.bytes = size
+                    stats['misses'] += 1
+                    stats['load_seconds'] += load_seconds
+                elif tier != group.home_tier:
+                    stats['restores'] += 1
+                else:
+                    stats['hits'] += 1
+
+                group.tier = group.home_tier
+                self._clock += 1
+                group.last_used = self._clock
+                victims = self._enforce_budget()
+
+        self._evict(victims)
+        return group
+
+    def _tier_bytes(self, tier):
+        return sum(group.bytes for group in self._groups.values() if group.tier == tier)
+
+    # called with self._lock held, the group returned is marked evicting and its lock is held (by this or an earlier eviction)
+    def _least_recently_used(self, tier, victims):
+        candidates = [group for group in self._groups.values() if group.tier == tier and group.in_use == 0]
+        for group in sorted(candidates, key=lambda group: group.last_used):
+            if group.evicting:
+                return group
+            # a group whose lock is taken is being loaded or restored, never block on it under self._lock
+            if group.lock.acquire(blocking=False):
+                group.evicting = True
+                victims.append(group)
+                return group
+        return None
+
+    # called with self._lock held, only updates the bookkeeping and returns [(group, models to move to the CPU or None)] for _evict
+    def _enforce_budget(self):
+        victims = []
+        offloaded = {}
+
+        while self.gpu_budget > 0 and self._tier_bytes('gpu') > self.gpu_budget:
+            group = self._least_recently_used('gpu', victims)
+            if group is None:
+                break
+            if group.offload:
+                offloaded[group.name] = list(group.models.values())
+                group.tier = 'cpu'
+            else:
+                self._drop(group)
+            self._count_eviction(group)
+
+        while self.cpu_budget > 0 and self._tier_bytes('cpu') > self.cpu_budget:
+            group = self._least_recently_used('cpu', victims)
+            if group is None:
+                break
+            self._drop(group)
+            self._count_eviction(group)
+
+        return [(group, offloaded.get(group.name) if group.tier == 'cpu' else None) for group in victims]
+
+    # moves the victims _enforce_budget picked to the CPU and releases the memory, called without self._lock
+    def _evict(self, victims):
+        if len(victims) == 0:
+            return
+
+        try:
+            for group, models in victims:
+                try:
+                    if models is not None:
+                        for model in models:
+                            model.to('cpu')
+                        print('Offloaded {} to CPU'.format(group.name))
+                except Exception as e:
+                    print('Error offloading {}: {}'.format(group.name, e))
+                    with self._lock:
+                        self._drop(group)
+                finally:
+                    with self._lock:
+                        group.evicting = False
+                    group.lock.release()
+        finally:
+            self.release()
+
+    def _drop(self, group):
+        group.models = None
+        group.tier = None
+        group.bytes = 0
+        print('Dropped {}'.format(group.name))
+
+    def _count_eviction(self, group):
+        for path in group.paths:
+            self._stats[path]['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for path, group in self._paths.items():
+                models['/'.join(path)] = dict(
+                    self._stats[path],
+                    tier=group.tier,
+                    evicting=group.evicting,
+                    bytes=group.bytes,
+                    group=group.name
+                )
+
+            return {
+                'gpu_bytes': self._tier_bytes('gpu'),
+                'cpu_bytes': self._tier_bytes('cpu'),
+                'gpu_budget': self.gpu_budget,
+                'cpu_budget': self.cpu_budget,
+                'models': models
+            }
+
+    def loaded(self):
+        """{path: model} of every model currently in memory."""
+        with self._lock:
+            return {
+                '/'.join(path): group.models[path]
+                for path, group in self._paths.items() if group.models is not None
+            }
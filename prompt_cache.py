@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import itertools
+import threading
+
+import torch
+
+from collections import OrderedDict
+
+from utils import fetch_env_config
+
+config = fetch_env_config()
+
+# text encoder outputs kept (~150KB each for SD 2 in fp16)
+PROMPT_CACHE_SIZE = int(config.get('prompt_cache_size', 256))
+
+
+class PromptEmbeddingCache:
+    """LRU of text encoder outputs, keyed by text encoder and tokenized prompt.
+
+    `encode` tokenizes prompts the way diffusers' `_encode_prompt` does and only runs the
+    text encoder on the ones it hasn't seen, in one batch, so popular prompts and the empty
+    negative prompt skip the encoder entirely. Text encoders are told apart by an id stamped
+    on the module the first time it's used, not `id()`, which can be reused once the model
+    manager drops a model. Entries of dropped encoders simply age out.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._encoder_ids = itertools.count()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _encoder_id(self, text_encoder):
+        with self._lock:
+            if getattr(text_encoder, '_prompt_cache_id', None) is None:
+                text_encoder._prompt_cache_id = next(self._encoder_ids)
+            return text_encoder._prompt_cache_id
+
+    # Returns the embeddings of prompts (str or list of str) as one (len(prompts), tokens, dim) tensor
+    @torch.no_grad()
+    def encode(self, tokenizer, text_encoder, prompts):
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        text_inputs = tokenizer(
+            prompts,
+            padding="max_length",
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        encoder_id = self._encoder_id(text_encoder)
+        keys = [(encoder_id, tuple(input_ids.tolist())) for input_ids in text_inputs.input_ids]
+
+        embeddings = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    embeddings[i] = self._entries[key]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            # repeated prompts in one batch are encoded once
+            unique = list(OrderedDict.fromkeys(keys[i] for i in missing))
+            rows = [keys.index(key) for key in unique]
+            if getattr(text_encoder.config, 'use_attention_mask', False):
+                attention_mask = text_inputs.attention_mask[rows].to(text_encoder.device)
+            else:
+                attention_mask = None
+            encoded = text_encoder(text_inputs.input_ids[rows].to(text_encoder.device), attention_mask=attention_mask)[0]
+
+            with self._lock:
+                for key, embedding in zip(unique, encoded):
+                    self._entries[key] = embedding
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+            by_key = dict(zip(unique, encoded))
+            for i in missing:
+                embeddings[i] = by_key[keys[i]]
+
+        return torch.stack(embeddings)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            }
+
+
+PROMPT_CACHE = PromptEmbeddingCache(PROMPT_CACHE_SIZE)
+
+
+# prompt_embeds / negative_prompt_embeds for a diffusers pipeline call in place of prompt / negative_prompt
+def prompt_embeddings(pipeline, prompt, negative_prompt=None):
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    if negative_prompt is None:
+        negative_prompts = [""] * len(prompts)
+    else:
+        negative_prompts = negative_prompt if isinstance(negative_prompt, list) else [negative_prompt]
+
+    return {
+        'prompt_embeds': PROMPT_CACHE.encode(pipeline.tokenizer, pipeline.text_encoder, prompts),
+        'negative_prompt_embeds': PROMPT_CACHE.encode(pipeline.tokenizer, pipeline.text_encoder, negative_prompts)
+    }
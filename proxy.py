@@ -1,55 +1,325 @@
-import requests
-from flask_cors import CORS
-from flask import Flask, request, Response
+import ssl
+import json
+import time
+import asyncio
+
+import aiohttp
+from aiohttp import web
 
 from db import fetch_api_hosts
+from load_balancer import LoadBalancer, model_path
 from utils import fetch_env_config
 
-app = Flask('__main__')
-CORS(app)
-
 config = fetch_env_config()
 
-API_HOSTS = fetch_api_hosts()
-COUNTER = 0
+# keep-alive connections to the API hosts, in total and per host
+PROXY_MAX_CONNECTIONS = int(config.get('proxy_max_connections', 512))
+PROXY_MAX_CONNECTIONS_PER_HOST = int(config.get('proxy_max_connections_per_host', 128))
+# seconds, generations take minutes so only connecting and the gaps between body chunks are bounded by default (0 disables)
+PROXY_CONNECT_TIMEOUT = float(config.get('proxy_connect_timeout', 10))
+PROXY_READ_TIMEOUT = float(config.get('proxy_read_timeout', 600))
+PROXY_TOTAL_TIMEOUT = float(config.get('proxy_total_timeout', 0))
+PROXY_CHUNK_SIZE = 64 * 1024
+# seconds between polls of every host's /load, and after which a report is too old to route on
+PROXY_LOAD_INTERVAL = float(config.get('proxy_load_interval', 1))
+PROXY_LOAD_STALE_AFTER = float(config.get('proxy_load_stale_after', 5))
+# weight of the newest sample in each host's latency moving average
+PROXY_LATENCY_ALPHA = float(config.get('proxy_latency_alpha', 0.2))
+# extra requests outstanding a host with the requested model loaded may have over the least loaded host and still get it
+PROXY_AFFINITY_SLACK = int(config.get('proxy_affinity_slack', 2))
+# seconds between /health probes of every host, and how long one may take
+PROXY_HEALTH_INTERVAL = float(config.get('proxy_health_interval', 5))
+PROXY_HEALTH_TIMEOUT = float(config.get('proxy_health_timeout', 2))
+# consecutive failures (requests or probes) that take a host out of rotation, and for how many seconds before a trial request
+PROXY_FAILURE_THRESHOLD = int(config.get('proxy_failure_threshold', 3))
+PROXY_BREAKER_RESET_TIMEOUT = float(config.get('proxy_breaker_reset_timeout', 30))
+# seconds between re-reads of the api_hosts table
+PROXY_HOSTS_REFRESH_INTERVAL = float(config.get('proxy_hosts_refresh_interval', 60))
+# other hosts a GET (idempotent) is retried on when its host can't be reached or answers with UNHEALTHY_STATUSES
+PROXY_GET_RETRIES = int(config.get('proxy_get_retries', 1))
+# JSON bodies on these routes are read to route on their model_id / inference_mode
+AFFINITY_PATHS = ['/images']
+# largest body read whole, the API hosts' MAX_CONTENT_LENGTH. Streamed bodies aren't limited by the proxy
+PROXY_MAX_READ_SIZE = 5 * 1024 * 1025
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>', methods=['GET', 'POST'])
-def redirect_to_API_HOST(path):
-    if 'challenge-token' not in request.headers or request.headers['challenge-token'] != config['challenge_token']:
-        return '\'challenge-token\' header missing / invalid', 401
+ALLOWED_METHODS = ['GET', 'POST']
+# statuses meaning the host (not the request) is in trouble, they count towards its circuit breaker
+UNHEALTHY_STATUSES = [502, 504]
+# hop-by-hop headers (RFC 7230), never forwarded in either direction
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade']
+
+BALANCER = LoadBalancer(
+    stale_after=PROXY_LOAD_STALE_AFTER,
+    latency_alpha=PROXY_LATENCY_ALPHA,
+    affinity_slack=PROXY_AFFINITY_SLACK,
+    failure_threshold=PROXY_FAILURE_THRESHOLD,
+    reset_timeout=PROXY_BREAKER_RESET_TIMEOUT
+)
+# requests being forwarded, per host in BALANCER. Only touched from the event loop, so plain ints are safe
+STATS = {
+    'in_flight': 0,
+    'forwarded': 0,
+    'errors': 0,
+    'timeouts': 0,
+    'retries': 0
+}
+
+
+class UpstreamUnavailable(Exception):
+    """A retryable request got one of UNHEALTHY_STATUSES, raised before anything was sent to the client."""
+
+
+async def refresh_hosts():
+    # psycopg2 blocks, keep it off the event loop
+    api_hosts = await asyncio.get_running_loop().run_in_executor(None, fetch_api_hosts)
+    BALANCER.set_hosts(api_hosts)
+    return api_hosts
+
+
+# new hosts join the rotation, removed ones leave it
+async def reload_hosts(app):
+    await refresh_hosts()
+
+
+async def poll_load(session, address):
+    try:
+        async with session.get(
+            address.rstrip('/') + '/load',
+            headers={'challenge-token': config['challenge_token']},
+            timeout=aiohttp.ClientTimeout(total=PROXY_LOAD_INTERVAL * 2),
+        ) as res:
+            if res.status == 200:
+                BALANCER.report_load(address, await res.json())
+    except (asyncio.TimeoutError, aiohttp.ClientError, ValueError):
+        # the last report goes stale and routing falls back to the power of two choices
+        pass
+
+
+async def poll_loads(app):
+    await asyncio.gather(*[poll_load(app['session'], address) for address in list(BALANCER.hosts)], return_exceptions=True)
+
+
+async def probe_health(session, host):
+    try:
+        async with session.get(host.address.rstrip('/') + '/health', timeout=aiohttp.ClientTimeout(total=PROXY_HEALTH_TIMEOUT)) as res:
+            healthy = res.status == 200
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        healthy = False
+
+    BALANCER.record_probe(host, healthy)
+
+
+async def probe_hosts(app):
+    await asyncio.gather(*[probe_health(app['session'], host) for host in list(BALANCER.hosts.values())], return_exceptions=True)
+
+
+# runs fn(app) every interval seconds until the app shuts down, errors are printed and retried next time
+async def every(interval, fn, app):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await fn(app)
+        except Exception as e:
+            print('Error in proxy background task {}: {}'.format(fn.__name__, str(e)))
+
+
+def forwarded_headers(headers):
+    # Host is set by the client session for the upstream, Content-Length is kept so bodies aren't re-chunked
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != 'host'}
+
+
+# the model_path of an /images request, None if the body doesn't name one
+def requested_model(body):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return model_path(data.get('inference_mode', None), data.get('model_id', None))
+
+
+# body is the request body if it was already read, otherwise it's streamed through
+async def forward(request, api_host, body=None, retryable=False):
+    session = request.app['session']
+    url = api_host.rstrip('/') + str(request.rel_url)
+    start = time.monotonic()
+    if body is not None:
+        data = body
+    else:
+        # stream the request body through instead of reading it into memory
+        data = request.content if request.body_exists else None
 
-    global API_HOSTS
-    global COUNTER
+    async with session.request(
+        request.method,
+        url,
+        headers=forwarded_headers(request.headers),
+        data=data,
+        allow_redirects=False,
+    ) as res:
+        # time until the host answers, i.e. how long it queued and generated for
+        request['proxy_latency'] = time.monotonic() - start
+        request['proxy_status'] = res.status
+        if retryable and res.status in UNHEALTHY_STATUSES:
+            raise UpstreamUnavailable(res.status)
 
+        response = web.StreamResponse(status=res.status, reason=res.reason)
+        for k, v in res.headers.items():
+            if k.lower() not in HOP_BY_HOP_HEADERS:
+                response.headers.add(k, v)
+
+        await response.prepare(request)
+        request['proxy_response'] = response
+        async for chunk in res.content.iter_chunked(PROXY_CHUNK_SIZE):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+async def redirect_to_API_HOST(request):
+    if request.method == 'OPTIONS':
+        # CORS preflight, answered here since browsers don't send the challenge token with it
+        response = web.Response(status=200)
+        response.headers['Access-Control-Allow-Methods'] = ', '.join(ALLOWED_METHODS + ['OPTIONS'])
+        if 'Access-Control-Request-Headers' in request.headers:
+            response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+        return response
+
+    if request.method not in ALLOWED_METHODS:
+        return web.Response(status=405, text='Method not allowed')
+
+    if 'challenge-token' not in request.headers or request.headers['challenge-token'] != config['challenge_token']:
+        return web.Response(status=401, text='\'challenge-token\' header missing / invalid')
+
+    path = request.match_info['path']
     if path == 'refresh_hosts':
-        API_HOSTS = fetch_api_hosts()
-        return Response('Success', 200, {API_HOSTS})
-    
-    api_host = API_HOSTS[COUNTER % len(API_HOSTS)]
-    COUNTER = COUNTER + 1
-    res = requests.request(
-        method          = request.method,
-        url             = request.url.replace(request.host_url, f'{api_host}/'),
-        headers         = {k:v for k,v in request.headers},
-        data            = request.data,
-        cookies         = request.cookies,
-        allow_redirects = False,
-    )
+        return web.json_response(await refresh_hosts())
+    if path == 'proxy_stats':
+        affinity = {'hits': BALANCER.affinity_hits, 'misses': BALANCER.affinity_misses}
+        return web.json_response(dict(STATS, affinity=affinity, hosts=BALANCER.stats()))
+
+    body = None
+    model = None
+    if request.method == 'POST' and request.path in AFFINITY_PATHS and request.content_type == 'application/json':
+        # small (capped at PROXY_MAX_READ_SIZE), read whole to find the model it needs
+        body = await request.read()
+        model = requested_model(body)
+
+    # GETs are idempotent, those without a body are retried on other hosts
+    retries = PROXY_GET_RETRIES if request.method == 'GET' and not request.body_exists else 0
+    tried = []
+    while True:
+        host = BALANCER.pick(model=model, exclude=tried)
+        if host is None:
+            return web.Response(status=503, text='No API hosts available')
+
+        tried.append(host.address)
+        response = await proxy_to_host(request, host, body, retryable=len(tried) <= retries)
+        if response is not None:
+            return response
+        STATS['retries'] += 1
+
+
+# forwards the request to one host, returns the response or None if it failed before answering and may be retried
+async def proxy_to_host(request, host, body, retryable):
+    api_host = host.address
+    request.pop('proxy_latency', None)
+    request.pop('proxy_status', None)
+    # True / False once the host proved healthy or failed. Stays None when the client goes away (the handler is
+    # cancelled or writing to it fails), which says nothing about the host
+    healthy = None
+
+    STATS['in_flight'] += 1
+    BALANCER.start(host)
+    try:
+        response = await forward(request, api_host, body, retryable)
+        STATS['forwarded'] += 1
+        healthy = request['proxy_status'] not in UNHEALTHY_STATUSES
+        return response
+    except UpstreamUnavailable as e:
+        healthy = False
+        print('{} {} got {} from {}, retrying on another host'.format(request.method, request.rel_url, str(e), api_host))
+        return None
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        timed_out = isinstance(e, asyncio.TimeoutError)
+        # once the response is prepared, client errors may be the client's connection failing, not the host's
+        if timed_out or 'proxy_response' not in request:
+            healthy = False
+        STATS['timeouts' if timed_out else 'errors'] += 1
+        print('Error proxying {} {} to {}: {}'.format(request.method, request.rel_url, api_host, 'timed out' if timed_out else str(e)))
 
-    excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
-    headers          = [
-        (k,v) for k,v in res.raw.headers.items()
-        if k.lower() not in excluded_headers
+        if 'proxy_response' in request:
+            # the status line is already sent, all that's left is to cut the response short
+            if request.transport is not None:
+                request.transport.close()
+            return request['proxy_response']
+        if retryable:
+            return None
+        if timed_out:
+            return web.Response(status=504, text='Upstream timed out')
+        return web.Response(status=502, text='Upstream error')
+    finally:
+        STATS['in_flight'] -= 1
+        if healthy is None:
+            BALANCER.cancel(host)
+        else:
+            BALANCER.finish(host, request.get('proxy_latency', None) if healthy else None)
+            BALANCER.record_health(host, healthy)
+
+
+async def add_cors_headers(request, response):
+    # API hosts already set their own CORS headers on proxied responses
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+
+
+async def on_startup(app):
+    timeout = aiohttp.ClientTimeout(
+        total=PROXY_TOTAL_TIMEOUT or None,
+        sock_connect=PROXY_CONNECT_TIMEOUT or None,
+        sock_read=PROXY_READ_TIMEOUT or None,
+    )
+    connector = aiohttp.TCPConnector(limit=PROXY_MAX_CONNECTIONS, limit_per_host=PROXY_MAX_CONNECTIONS_PER_HOST)
+    # bodies are passed through as they are, compressed or not
+    app['session'] = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False, cookie_jar=aiohttp.DummyCookieJar())
+    await refresh_hosts()
+    app['background_tasks'] = [
+        asyncio.create_task(every(PROXY_LOAD_INTERVAL, poll_loads, app)),
+        asyncio.create_task(every(PROXY_HEALTH_INTERVAL, probe_hosts, app)),
+        asyncio.create_task(every(PROXY_HOSTS_REFRESH_INTERVAL, reload_hosts, app)),
     ]
 
-    response = Response(res.content, res.status_code, headers)
-    return response
 
+async def on_cleanup(app):
+    for task in app['background_tasks']:
+        task.cancel()
+    await app['session'].close()
 
-if __name__ == '__main__':
+
+def create_app():
+    app = web.Application(client_max_size=PROXY_MAX_READ_SIZE)
+    app.router.add_route('*', '/{path:.*}', redirect_to_API_HOST)
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+app = create_app()
+
+
+def run(port=5000):
     if config['environment'] == 'prod':
-        app.run(host='0.0.0.0', port='5000', ssl_context='adhoc')
+        if 'proxy_ssl_cert' in config:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(config['proxy_ssl_cert'], config.get('proxy_ssl_key', None))
+        else:
+            # self-signed, like Flask's ssl_context='adhoc'
+            from werkzeug.serving import generate_adhoc_ssl_context
+            ssl_context = generate_adhoc_ssl_context()
+        web.run_app(app, host='0.0.0.0', port=port, ssl_context=ssl_context)
     else:
-        app.run(host='0.0.0.0', debug=True, port='5000')
+        web.run_app(app, host='0.0.0.0', port=port)
+
 
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+# the /images request fields that determine the generated image, inference() seeds its generator from 'seed'
+KEY_FIELDS = {
+    'model_id': str,
+    'inference_mode': str,
+    'prompt': str,
+    'negative_prompt': str,
+    'steps': int,
+    'scale': float,
+    'seed': int,
+    'aspect_ratio': str,
+    'strength': float,
+    'samples': int,
+}
+
+
+def _normalize(value, kind):
+    if value is None:
+        return None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+# Returns the cache key of an /images request, None if it isn't deterministic (no seed)
+def request_key(data):
+    if data.get('seed', None) is None:
+        return None
+
+    fields = {field: _normalize(data.get(field, None), kind) for field, kind in KEY_FIELDS.items()}
+    # input image / mask by content
+    for field in ['base_64', 'mask']:
+        if data.get(field, None) is not None:
+            fields[field] = hashlib.sha256(str(data[field]).encode('utf-8')).hexdigest()
+
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Maps deterministic /images requests to the hash (images.hash) of the image they generated.
+
+    Values are tiny, so the in-memory LRU holds `max_entries` of them. With a `disk`
+    DiskCache they also survive restarts and are shared by the processes of a host: memory
+    misses fall through to disk and are promoted back. Callers resolve the hash to an image
+    record and `invalidate` the key if that record or its file is gone.
+    """
+
+    def __init__(self, max_entries=1024, disk=None):
+        self.max_entries = max_entries
+        self.disk = disk
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _remember(self, key, image_hash):
+        # called with self._lock held
+        self._entries[key] = image_hash
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+
+        image_hash = None
+        if self.disk is not None:
+            content = self.disk.get(key)
+            if content is not None:
+                image_hash = content.decode('utf-8')
+
+        with self._lock:
+            if image_hash is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, image_hash)
+            return image_hash
+
+    def put(self, key, image_hash):
+        with self._lock:
+            self._remember(key, image_hash)
+        if self.disk is not None:
+            self.disk.put(key, image_hash.encode('utf-8'))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self.invalidations += 1
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            requests = hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / requests if requests > 0 else 0.0,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            }
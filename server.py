@@ -10,21 +10,26 @@ import secrets
 import requests
 import uuid
 import base64
+import time
+import socket
+import threading
 import traceback
 
 from PIL import Image
 from io import BytesIO 
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from flask_cors import CORS
 from passlib.hash import sha256_crypt
-from flask import Flask, jsonify, request, g, make_response
+from flask import Flask, jsonify, request, g, make_response, Response
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, To
 
-from utils import bytes_from_image, thumbnail_bytes_for_image, fetch_env_config, image_from_base_64, serve_pil_image, _hide_seek, extract_start_and_end_frames, pil_to_bytes, REPLICATE_MODELS
+from utils import bytes_from_image, thumbnail_bytes_for_image, fetch_env_config, image_from_base_64, serve_pil_image, _hide_seek, extract_start_and_end_frames, spool_upload_to_file, pil_to_bytes, \
+        REPLICATE_MODELS, TEXT_MODELS, INTERROGATOR_MODELS, UPSCALE_MODELS
 from db import create_user, fetch_user, fetch_user_for_email, update_user, delete_user, \
         create_image, fetch_images, fetch_images_for_user, fetch_images_with_hash, fetch_image_ids_for_user, fetch_image_for_user, update_image_for_user, delete_image_for_user, \
         create_audio, fetch_audios, fetch_audios_for_user, fetch_queued_audios, fetch_audio_for_user, update_audio_for_user, delete_audio_and_video_project_for_user, \
@@ -35,13 +40,16 @@ from db import create_user, fetch_user, fetch_user_for_email, update_user, delet
         update_user_referral_token, fetch_user_for_referral_token, create_referral, fetch_referral_for_referred, \
         execute_reward, update_user_metadata, create_transaction, fetch_transactions_for_user, \
         update_video_project_state, fetch_video_project_for_id, fetch_image, update_video_project_cdn_id, \
-        fetch_image_with_cdn_id
-from cdn import download_audio_from_cdn, delete_video_project_from_cdn
+        fetch_image_with_cdn_id, create_image_job, fetch_image_job_for_user, update_image_job_state, update_image_job_progress, \
+        renew_image_job_leases, expire_image_jobs
+from cdn import download_audio_from_cdn, delete_video_project_from_cdn, download_image_from_cdn, CDN, CDN_CACHE
+from disk_cache import DiskCache
+from result_cache import ResultCache, request_key
 
 import torchaudio
 
 config = fetch_env_config()
-PIPELINE_DICT = {}
+MODEL_MANAGER = None
 if config['server_type'] == 'gpu':
     from segment_anything import SamPredictor
     from middleware import inference, setup_pipelines
@@ -50,8 +58,9 @@ if config['server_type'] == 'gpu':
         txt_and_audio_to_audio, setup_audio, 
         separate_audio_tracks
     )
+    from prompt_cache import PROMPT_CACHE
     # AUDIO_DICT = setup_audio()
-    PIPELINE_DICT = setup_pipelines()
+    MODEL_MANAGER = setup_pipelines()
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1025 # 5 MB
@@ -67,6 +76,60 @@ limiter = Limiter(
 
 sg = SendGridAPIClient(config['sendgrid_api_key'])
 
+# async image jobs (POST /images?async=true) run on this process' executor, their state lives in
+# image_jobs so GET /jobs/<id> can be answered by any web worker / host behind the proxy
+IMAGE_JOB_WORKERS = int(config.get('image_job_workers', 4))
+IMAGE_JOB_MAX_PENDING = int(config.get('image_job_max_pending', 64))
+IMAGE_JOB_PROGRESS_INTERVAL = float(config.get('image_job_progress_interval', 0.5))
+# seconds a job outlives its process: renewed every quarter of it, then a dead process' jobs are marked ERROR
+IMAGE_JOB_LEASE_DURATION = int(config.get('image_job_lease_duration', 60))
+# seconds a GET /jobs/<id>/events stream (and the worker serving it) is held open at most
+IMAGE_JOB_STREAM_MAX_DURATION = float(config.get('image_job_stream_max_duration', 600))
+# seconds between the job reads of an event stream
+IMAGE_JOB_STREAM_POLL_INTERVAL = float(config.get('image_job_stream_poll_interval', 2))
+# event streams a process serves at once, further ones get a 503 (clients poll GET /jobs/<id> instead)
+IMAGE_JOB_MAX_STREAMS = int(config.get('image_job_max_streams', 8))
+IMAGE_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_JOB_WORKERS, thread_name_prefix='image-job')
+IMAGE_JOB_LOCK = threading.Lock()
+IMAGE_JOB_PENDING = 0
+IMAGE_JOB_STREAMS = 0
+IMAGE_JOB_HEARTBEAT = None
+IMAGE_JOB_LAST_EXPIRY = 0
+
+# deterministic /images requests (same parameters and seed) -> hash of the image they generated, so repeats are
+# served from the existing image instead of the GPU. The disk tier is shared by this host's processes (0 disables it)
+RESULT_CACHE_SIZE = int(config.get('result_cache_size', 4096))
+RESULT_CACHE_DIR = config.get('result_cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_cache'))
+RESULT_CACHE_DISK_MB = float(config.get('result_cache_disk_mb', 64))
+RESULT_CACHE = ResultCache(
+    max_entries=RESULT_CACHE_SIZE,
+    disk=DiskCache(RESULT_CACHE_DIR, RESULT_CACHE_DISK_MB * 1024**2) if RESULT_CACHE_DISK_MB > 0 else None
+)
+
+# requests this process is serving, reported to the proxy by /load for routing
+IN_FLIGHT_LOCK = threading.Lock()
+IN_FLIGHT_REQUESTS = 0
+# cheap routes that say nothing about the host's load
+UNCOUNTED_ENDPOINTS = ['health', 'load']
+
+
+@app.before_request
+def count_request_started():
+    global IN_FLIGHT_REQUESTS
+
+    if request.endpoint not in UNCOUNTED_ENDPOINTS:
+        g.counted_in_flight = True
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT_REQUESTS += 1
+
+@app.teardown_request
+def count_request_finished(exception=None):
+    global IN_FLIGHT_REQUESTS
+
+    if g.pop('counted_in_flight', False):
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT_REQUESTS -= 1
+
 
 #######################################################
 ######################### API #########################
@@ -413,24 +476,84 @@ def api_create_image(current_user_id):
 
     data = json.loads(request.data)
 
+    if data.pop('async', False) or request.args.get('async', 'false').lower() == 'true':
+        return enqueue_image_job(current_user_id, data)
+
+    id, _, image = generate_image(current_user_id, data)
+
+    # TODO: Make this return image metadata.
+    response = make_response(serve_pil_image(image))
+    response.headers['X-Image-Id'] = id
+    response.headers['Access-Control-Expose-Headers'] = 'X-Image-Id'
+    return response
+
+# Serve a repeated /images request from the image it generated before, returns (image id, cdn id, image) or None
+def cached_image(current_user_id, data, key, use_thread=True):
+
+    image_hash = RESULT_CACHE.get(key)
+    if image_hash is None:
+        return None
+
+    records = fetch_images_with_hash(image_hash)
+    records_for_user = [record for record in records if str(record['user_id']) == str(current_user_id)]
+    record = records_for_user[0] if len(records_for_user) > 0 else (records[0] if len(records) > 0 else None)
+    image_byte_data = download_image_from_cdn(record['user_id'], record['cdn_id']) if record is not None else None
+    if image_byte_data is None:
+        # deleted since
+        RESULT_CACHE.invalidate(key)
+        return None
+
+    image = Image.open(BytesIO(image_byte_data))
+    if len(records_for_user) > 0:
+        return record['id'], record['cdn_id'], image
+
+    # generated by another user, saved for this one without running the pipeline again
+    id, cdn_id = create_image(
+        current_user_id,
+        image_byte_data,
+        thumbnail_bytes_for_image(image),
+        image_hash,
+        data,
+        False,
+        False,
+        -1 if 'parent_id' not in data else data['parent_id'],
+        use_thread=use_thread
+    )
+    return id, cdn_id, image
+
+# Run inference for an /images request and save the result, returns (image id, cdn id, image)
+def generate_image(current_user_id, data, callback=None, use_thread=True):
+
     parent_id = -1 if 'parent_id' not in data else data['parent_id']
     images = []
 
+    # replicate runs aren't seeded by us
+    key = request_key(data) if data['model_id'] not in REPLICATE_MODELS else None
+    if key is not None:
+        cached = cached_image(current_user_id, data, key, use_thread=use_thread)
+        if cached is not None:
+            return cached
+
     if data['inference_mode'] == 'Text to Image':
         if data['model_id'] in REPLICATE_MODELS:
             images = inference('REPLICATE', 'Text to Image', data['prompt'], n_images=int(data['samples']), negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), aspect_ratio=data['aspect_ratio'])
         else:
-            images = inference(PIPELINE_DICT['Text to Image'][data['model_id']], 'Text to Image', data['prompt'], n_images=int(data['samples']), negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), aspect_ratio=data['aspect_ratio'])
+            with MODEL_MANAGER.use('Text to Image', data['model_id']) as pipeline:
+                images = inference(pipeline, 'Text to Image', data['prompt'], n_images=int(data['samples']), negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), aspect_ratio=data['aspect_ratio'], callback=callback)
     else:
         image = image_from_base_64(data['base_64'])
         if data['inference_mode'] == 'Image to Image':
-            images = inference(PIPELINE_DICT['Image to Image'][data['model_id']], 'Image to Image', data['prompt'], n_images=int(data['samples']), negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), aspect_ratio=data['aspect_ratio'], img=image, strength=float(data['strength']))
+            with MODEL_MANAGER.use('Image to Image', data['model_id']) as pipeline:
+                images = inference(pipeline, 'Image to Image', data['prompt'], n_images=int(data['samples']), negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), aspect_ratio=data['aspect_ratio'], img=image, strength=float(data['strength']), callback=callback)
         elif data['inference_mode'] == 'Pix to Pix':
-            images = inference(PIPELINE_DICT['Pix to Pix'][data['model_id']], 'Pix to Pix', data['prompt'], n_images=int(data['samples']), steps=int(data['steps']), seed=int(data['seed']), img=image)
+            with MODEL_MANAGER.use('Pix to Pix', data['model_id']) as pipeline:
+                images = inference(pipeline, 'Pix to Pix', data['prompt'], n_images=int(data['samples']), steps=int(data['steps']), seed=int(data['seed']), img=image)
         elif data['inference_mode'].split(' ')[0] == 'ControlNet':
-            images = inference(PIPELINE_DICT['ControlNet'][data['inference_mode'].split(' ')[1]][data['model_id']], data['inference_mode'], data['prompt'], n_images=1, negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), img=image, strength=int(data['strength']))
+            with MODEL_MANAGER.use('ControlNet', data['inference_mode'].split(' ')[1], data['model_id']) as pipeline:
+                images = inference(pipeline, data['inference_mode'], data['prompt'], n_images=1, negative_prompt=data['negative_prompt'], steps=int(data['steps']), seed=int(data['seed']), img=image, strength=int(data['strength']))
         elif data['inference_mode'] == 'Mask':
-            images = inference(PIPELINE_DICT['Mask']['Inpainting'], data['inference_mode'], data['prompt'], n_images=1, negative_prompt=data['negative_prompt'], seed=int(data['seed']), img=image, mask=data['mask'])
+            with MODEL_MANAGER.use('Mask', 'Inpainting') as pipeline:
+                images = inference(pipeline, data['inference_mode'], data['prompt'], n_images=1, negative_prompt=data['negative_prompt'], seed=int(data['seed']), img=image, mask=data['mask'])
 
         if parent_id == -1:
             images_with_hash = fetch_images_with_hash(hashlib.sha256(data['base_64'].encode('utf-8')).hexdigest())
@@ -440,23 +563,224 @@ def api_create_image(current_user_id):
             elif len(images_with_hash) > 0:
                 parent_id = images_with_hash[0].id
     
+    if images is None or len(images) == 0:
+        raise ValueError('Inference for {} returned no images'.format(data['inference_mode']))
+
     image_byte_data = bytes_from_image(images[0])
     thumbnail_byte_data = thumbnail_bytes_for_image(images[0])
-    id, _ = create_image(
+    image_hash = (hashlib.sha256(image_byte_data)).hexdigest()
+    id, cdn_id = create_image(
         current_user_id,
         image_byte_data,
         thumbnail_byte_data,
-        (hashlib.sha256(image_byte_data)).hexdigest(),
+        image_hash,
         data,
         False,
         False,
-        parent_id
+        parent_id,
+        use_thread=use_thread
     )
+    if key is not None:
+        RESULT_CACHE.put(key, image_hash)
 
-    # TODO: Make this return image metadata.
-    response = make_response(serve_pil_image(images[0]))
-    response.headers['X-Image-Id'] = id
-    response.headers['Access-Control-Expose-Headers'] = 'X-Image-Id'
+    return id, cdn_id, images[0]
+
+# the process image jobs are leased to, computed on use since gunicorn may fork workers after import
+def image_job_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+# Fails the jobs of processes that died without finishing them, at most once per lease period per process
+# since a lease can't run out any faster
+def expire_lost_image_jobs():
+    global IMAGE_JOB_LAST_EXPIRY
+
+    with IMAGE_JOB_LOCK:
+        now = time.time()
+        if now - IMAGE_JOB_LAST_EXPIRY < IMAGE_JOB_LEASE_DURATION:
+            return
+        IMAGE_JOB_LAST_EXPIRY = now
+
+    try:
+        expired = expire_image_jobs()
+        if expired > 0:
+            print('Marked {} image job(s) of stopped servers ERROR'.format(expired))
+    except Exception as e:
+        print('Error expiring image jobs: {}'.format(str(e)))
+
+# Renews the leases of this process' jobs and fails those of processes that died without finishing theirs
+def image_job_heartbeat():
+    while True:
+        time.sleep(IMAGE_JOB_LEASE_DURATION / 4)
+        try:
+            renew_image_job_leases(image_job_worker_id(), IMAGE_JOB_LEASE_DURATION)
+        except Exception as e:
+            print('Error renewing image job leases: {}'.format(str(e)))
+        expire_lost_image_jobs()
+
+# started with the first job of a process (threads don't survive a fork)
+def start_image_job_heartbeat():
+    global IMAGE_JOB_HEARTBEAT
+
+    with IMAGE_JOB_LOCK:
+        if IMAGE_JOB_HEARTBEAT is None or not IMAGE_JOB_HEARTBEAT.is_alive():
+            IMAGE_JOB_HEARTBEAT = threading.Thread(target=image_job_heartbeat, name='image-job-heartbeat', daemon=True)
+            IMAGE_JOB_HEARTBEAT.start()
+
+# Queue an /images request on the job executor, returns 202 with the job id right away
+def enqueue_image_job(current_user_id, data):
+    global IMAGE_JOB_PENDING
+
+    with IMAGE_JOB_LOCK:
+        if IMAGE_JOB_PENDING >= IMAGE_JOB_MAX_PENDING:
+            response = jsonify({'error': 'Too many queued image jobs, try again later'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        IMAGE_JOB_PENDING += 1
+
+    try:
+        start_image_job_heartbeat()
+        job_id = create_image_job(current_user_id, data, image_job_worker_id(), IMAGE_JOB_LEASE_DURATION)
+        IMAGE_JOB_EXECUTOR.submit(run_image_job, job_id, current_user_id, data)
+    except Exception as e:
+        with IMAGE_JOB_LOCK:
+            IMAGE_JOB_PENDING -= 1
+        print("Internal server error: {}".format(str(e)))
+        return { 'error': "Internal server error: {}".format(str(e)) }, 500
+
+    response = jsonify({'job_id': job_id, 'state': 'QUEUED'})
+    response.headers['Location'] = '/jobs/{}'.format(job_id)
+    return response, 202
+
+# Pipeline callback that records a job's denoising progress, at most once per IMAGE_JOB_PROGRESS_INTERVAL
+def image_job_progress_callback(job_id, data):
+
+    total_steps = int(data['steps'])
+    if data['inference_mode'] == 'Image to Image':
+        # img2img only runs the last `strength` fraction of the schedule
+        total_steps = max(1, int(total_steps * float(data['strength'])))
+    last_update = [0.0]
+
+    def callback(step, timestep, latents):
+        now = time.time()
+        if now - last_update[0] < IMAGE_JOB_PROGRESS_INTERVAL:
+            return
+        last_update[0] = now
+        try:
+            update_image_job_progress(job_id, min(1.0, (step + 1) / total_steps))
+        except Exception as e:
+            print('Error updating progress for image job {}: {}'.format(job_id, str(e)))
+
+    return callback
+
+def run_image_job(job_id, current_user_id, data):
+    global IMAGE_JOB_PENDING
+
+    try:
+        update_image_job_state(job_id, 'PROCESSING')
+        # upload in this thread so the image is on the cdn by the time the job is COMPLETED
+        id, cdn_id, _ = generate_image(current_user_id, data, callback=image_job_progress_callback(job_id, data), use_thread=False)
+        update_image_job_state(job_id, 'COMPLETED', image_id=id, cdn_id=cdn_id)
+    except Exception as e:
+        print('Error running image job {}: {}'.format(job_id, str(e)))
+        traceback.print_exc()
+        try:
+            update_image_job_state(job_id, 'ERROR', error=str(e))
+        except Exception as e:
+            print('Error updating image job {}: {}'.format(job_id, str(e)))
+    finally:
+        with IMAGE_JOB_LOCK:
+            IMAGE_JOB_PENDING -= 1
+
+def image_job_status(job):
+    return {
+        'job_id': job['id'],
+        'state': job['state'],
+        'progress': job['progress'],
+        'image_id': job['image_id'],
+        'error': job['error']
+    }
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@challenge_token_required
+@prepend_user_id
+@limiter.limit('120 per minute', key_func=lambda: g.get('current_user_id', request.remote_addr))
+def api_fetch_image_job(current_user_id, job_id):
+
+    try:
+        expire_lost_image_jobs()
+        job = fetch_image_job_for_user(job_id, current_user_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+
+        if job['state'] == 'ERROR':
+            return jsonify(image_job_status(job)), 500
+        elif job['state'] != 'COMPLETED':
+            return jsonify(image_job_status(job)), 202
+
+        # same response as a synchronous POST /images
+        image_bytes = download_image_from_cdn(current_user_id, job['cdn_id'])
+        if image_bytes is None:
+            return jsonify({'error': 'Image not found'}), 404
+
+        response = make_response(serve_pil_image(Image.open(BytesIO(image_bytes))))
+        response.headers['X-Image-Id'] = job['image_id']
+        response.headers['Access-Control-Expose-Headers'] = 'X-Image-Id'
+        return response
+    except Exception as e:
+        print("Internal server error: {}".format(str(e)))
+        return { 'error': "Internal server error: {}".format(str(e)) }, 500
+
+# server-sent events stream of a job's state / progress, ends once the job is COMPLETED or ERROR, or with an
+# 'event: timeout' after IMAGE_JOB_STREAM_MAX_DURATION seconds (clients reconnect or poll /jobs/<id>).
+# Each stream holds a worker, so a process serves at most IMAGE_JOB_MAX_STREAMS of them
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+@challenge_token_required
+@prepend_user_id
+@limiter.limit('30 per minute', key_func=lambda: g.get('current_user_id', request.remote_addr))
+def api_stream_image_job(current_user_id, job_id):
+    global IMAGE_JOB_STREAMS
+
+    if fetch_image_job_for_user(job_id, current_user_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    with IMAGE_JOB_LOCK:
+        if IMAGE_JOB_STREAMS >= IMAGE_JOB_MAX_STREAMS:
+            response = jsonify({'error': 'Too many job event streams, poll /jobs/{} instead'.format(job_id)})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        IMAGE_JOB_STREAMS += 1
+
+    def close_stream():
+        global IMAGE_JOB_STREAMS
+
+        with IMAGE_JOB_LOCK:
+            IMAGE_JOB_STREAMS -= 1
+
+    def events():
+        last_status = None
+        deadline = time.time() + IMAGE_JOB_STREAM_MAX_DURATION
+        while True:
+            expire_lost_image_jobs()
+            job = fetch_image_job_for_user(job_id, current_user_id)
+            if job is None:
+                yield 'event: error\ndata: {}\n\n'.format(json.dumps({'error': 'Job not found'}))
+                return
+
+            status = image_job_status(job)
+            if status != last_status:
+                yield 'data: {}\n\n'.format(json.dumps(status))
+                last_status = status
+
+            if job['state'] in ('COMPLETED', 'ERROR'):
+                return
+            if time.time() >= deadline:
+                yield 'event: timeout\ndata: {}\n\n'.format(json.dumps(status))
+                return
+            time.sleep(IMAGE_JOB_STREAM_POLL_INTERVAL)
+
+    # called once the response is closed, also when the client left before the stream started
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close_stream)
     return response
 
 @app.route('/images', methods=['GET'])
@@ -729,13 +1053,15 @@ def api_create_audio_for_user(current_user_id, user_id):
     if request.files:
         audio_file = request.files["audio"]
         use_thread = request.form.get("useThread", None)
-        audio_data = audio_file.read()
         
+        audio_path = None
         try:
+            # copied to a file of its own so the upload can outlive the request, create_audio removes it
+            audio_path = spool_upload_to_file(audio_file)
             if (use_thread is not None):
                 id, cdn_id = create_audio(
                     user_id=current_user_id,
-                    audio_byte_data=audio_data,
+                    audio_file_path=audio_path,
                     name=audio_file.filename,
                     size=audio_file.content_length,
                     metadata={},
@@ -744,15 +1070,21 @@ def api_create_audio_for_user(current_user_id, user_id):
             else:
                 id, cdn_id = create_audio(
                     user_id=current_user_id,
-                    audio_byte_data=audio_data,
+                    audio_file_path=audio_path,
                     name=audio_file.filename,
                     size=audio_file.content_length,
                     metadata={},
                 )
+            # the upload owns the file now
+            audio_path = None
             return { 'id': id, 'cdn_id': cdn_id }, 200
         except Exception as e:
             print("Internal server error: {}".format(str(e)))
             return { 'error': "Internal server error: {}".format(str(e)) }, 500
+        finally:
+            # create_audio failed before handing the file to the upload
+            if audio_path is not None and os.path.exists(audio_path):
+                os.remove(audio_path)
     else:
         return jsonify({"error": "No audio file detected"}), 400
 
@@ -973,14 +1305,16 @@ def api_create_video_for_user(current_user_id):
     if not request.files:
         return { 'error': 'file not found' }, 404
     
+    video_path = None
     try:
         video_file = request.files['video']
         video_name = video_file.filename
-        video_bytes = video_file.read()
+        # streamed to disk instead of read into memory, removed once uploaded
+        video_path = spool_upload_to_file(video_file)
 
         cdn_uuid = str(uuid.uuid4())
 
-        first_frame, last_frame, duration = extract_start_and_end_frames(video_bytes) 
+        first_frame, last_frame, duration = extract_start_and_end_frames(video_path) 
 
         first_frame_bytes = pil_to_bytes(first_frame)
         last_frame_bytes = pil_to_bytes(last_frame)
@@ -1010,18 +1344,19 @@ def api_create_video_for_user(current_user_id):
             use_thread=False
         )
         # save video
-        id = create_video(
-            current_user_id,
-            {},
-            duration,
-            first_id,
-            first_cdn_id,
-            last_id,
-            last_cdn_id,
-            cdn_uuid,
-            video_bytes,
-            video_name
-        )
+        with open(video_path, 'rb') as video_bytes:
+            id = create_video(
+                current_user_id,
+                {},
+                duration,
+                first_id,
+                first_cdn_id,
+                last_id,
+                last_cdn_id,
+                cdn_uuid,
+                video_bytes,
+                video_name
+            )
 
         return { 
             'id': id, 
@@ -1039,6 +1374,9 @@ def api_create_video_for_user(current_user_id):
         print(traceback.format_exc())
         print("Internal server error: {}".format(str(e)))
         return { 'error': "Internal server error: {}".format(str(e)) }, 500
+    finally:
+        if video_path is not None:
+            os.remove(video_path)
 
 @app.route('/users/<user_id>/videos', methods=['GET'])
 @auth_token_required
@@ -1273,13 +1611,52 @@ def queue_video_project_for_generation(current_user_id, video_project_id):
 def health():
     return jsonify({'message': 'API is up and running!'}), 200
 
+# work in progress on this host, polled by the proxy to route to the least loaded host
+@app.route('/load', methods=['GET'])
+@challenge_token_required
+def load():
+    models = {}
+    if MODEL_MANAGER is not None:
+        models = {path: stats['tier'] for path, stats in MODEL_MANAGER.stats()['models'].items() if stats['tier'] is not None}
+
+    return jsonify({
+        'in_flight': IN_FLIGHT_REQUESTS,
+        'queued_jobs': IMAGE_JOB_PENDING,
+        'models': models
+    }), 200
+
+# hit rate of the /images result cache
+@app.route('/results/stats', methods=['GET'])
+@challenge_token_required
+def result_stats():
+    return jsonify(RESULT_CACHE.stats()), 200
+
+# model cache hit / miss / load time stats and memory per model
+@app.route('/models/stats', methods=['GET'])
+@challenge_token_required
+def model_stats():
+    if MODEL_MANAGER is None:
+        return jsonify({'error': 'No models on this server'}), 404
+    stats = MODEL_MANAGER.stats()
+    stats['prompt_cache'] = PROMPT_CACHE.stats()
+    return jsonify(stats), 200
+
+# background CDN upload queue depth / outcomes for this process
+@app.route('/cdn/stats', methods=['GET'])
+@challenge_token_required
+def cdn_stats():
+    metrics = CDN.metrics()
+    metrics['cache'] = CDN_CACHE.stats() if CDN_CACHE is not None else None
+    return jsonify(metrics), 200
+
 @app.route('/extend_prompt', methods=['POST'])
 @challenge_token_required
 @limiter.limit(limit_value=lambda: '20 per minute' if g.get('current_user_id', None) else '5 per minute', key_func=lambda: g.get('current_user_id', request.remote_addr))
 def extend_prompt():
 
     content = json.loads(request.data)
-    return {'prompt': list(PIPELINE_DICT['Text'].values())[0](content['prompt'] + ',', num_return_sequences=1)[0]['generated_text']}, 200
+    with MODEL_MANAGER.use('Text', TEXT_MODELS[0]) as text_pipeline:
+        return {'prompt': text_pipeline(content['prompt'] + ',', num_return_sequences=1)[0]['generated_text']}, 200
 
 @app.route('/interrogate', methods=['POST'])
 @auth_token_required
@@ -1288,7 +1665,8 @@ def interrogate(current_user_id):
 
     content = json.loads(request.data)
     image = image_from_base_64(content['base_64']).convert('RGB')
-    return {'prompt': list(PIPELINE_DICT['Interrogator'].values())[0].interrogate_fast(image)}, 200
+    with MODEL_MANAGER.use('Interrogator', INTERROGATOR_MODELS[0]) as interrogator:
+        return {'prompt': interrogator.interrogate_fast(image)}, 200
 
 @app.route('/upscale', methods=['POST'])
 @auth_token_required
@@ -1300,10 +1678,11 @@ def upscale(current_user_id):
     [h,w,c] = numpy.shape(image)
     scalar = float(384 / max(h, w, 384))
     image = image.resize((int(w*scalar), int(h*scalar)))
-    images = list(PIPELINE_DICT['Upscale'].values())[0](
-        prompt='',
-        image=image
-    ).images
+    with MODEL_MANAGER.use('Upscale', UPSCALE_MODELS[0]) as upscale_pipeline:
+        images = upscale_pipeline(
+            prompt='',
+            image=image
+        ).images
     return serve_pil_image(images[0])
 
 @app.route('/mask', methods=['POST'])
@@ -1314,11 +1693,12 @@ def mask_from_points():
     image = image_from_base_64(content['base64']).convert('RGB')
     coordinates = content['coordinates']
 
-    predictor = SamPredictor(PIPELINE_DICT['Mask']['SAM'])
-    predictor.set_image(numpy.asarray(image))
+    with MODEL_MANAGER.use('Mask', 'SAM') as sam:
+        predictor = SamPredictor(sam)
+        predictor.set_image(numpy.asarray(image))
 
-    masks, _, _ = predictor.predict(
-        point_coords=numpy.array(coordinates), point_labels=numpy.array([1] * len(coordinates)))
+        masks, _, _ = predictor.predict(
+            point_coords=numpy.array(coordinates), point_labels=numpy.array([1] * len(coordinates)))
     merged_mask = numpy.any(masks, axis=0)
 
     # convert to base 64
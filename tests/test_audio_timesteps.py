@@ -0,0 +1,93 @@
+import numpy as np
+import librosa
+import soundfile
+
+from audio_timesteps import AUDIO_HOP_LENGTH, audio_onset_envelope, timesteps_from_envelope, get_timesteps_arr
+
+
+# the per segment get_timesteps_arr Image2ImageWalkPipeline.walk used to call, decoding and analysing each span on its own
+def single_span_timesteps(audio_filepath, offset, duration, fps=30, margin=1.0, smooth=0.0, sr=None):
+    y, sr = librosa.load(audio_filepath, offset=offset, duration=duration, sr=sr)
+    D = librosa.stft(y, n_fft=2048, hop_length=2048 // 4, win_length=2048)
+    D_harmonic, D_percussive = librosa.decompose.hpss(D, margin=margin)
+    y_percussive = librosa.istft(D_percussive, length=len(y))
+
+    spec_raw = librosa.feature.melspectrogram(y=y_percussive, sr=sr)
+    spec_max = np.amax(spec_raw, axis=0)
+    spec_norm = (spec_max - np.min(spec_max)) / np.ptp(spec_max)
+
+    x_norm = np.linspace(0, spec_norm.shape[-1], spec_norm.shape[-1])
+    y_norm = np.cumsum(spec_norm)
+    y_norm /= y_norm[-1]
+    x_resize = np.linspace(0, y_norm.shape[-1], int(duration * fps))
+
+    T = np.interp(x_resize, x_norm, y_norm)
+    return T * (1 - smooth) + np.linspace(0.0, 1.0, T.shape[0]) * smooth
+
+
+def click_track(path, sr=22050, seconds=4):
+    # a click every half second over low noise
+    rng = np.random.default_rng(0)
+    y = 0.01 * rng.standard_normal(sr * seconds).astype(np.float32)
+    for start in range(0, y.shape[0], sr // 2):
+        y[start:start + 64] += 0.9
+    soundfile.write(str(path), y, sr)
+    return path
+
+
+class TestAudioTimesteps:
+
+    def test_slices_the_segment_from_the_envelope(cls):
+        """
+        Test that a segment's timesteps only follow its own slice of the envelope, normalized from 0 to 1
+        """
+        frame_rate = 10.0
+        # flat for the first second, a single onset in the middle of the second
+        envelope = np.concatenate([np.full(10, 5.0), np.zeros(10)])
+        envelope[15] = 1.0
+
+        T = timesteps_from_envelope(envelope, frame_rate, offset=1.0, duration=1.0, fps=20)
+
+        assert T.shape == (20,)
+        assert T[0] == 0.0 and T[-1] == 1.0
+        assert np.all(np.diff(T) >= 0)
+        # all of the movement happens around the onset
+        assert T[5] < 0.1 and T[-5] > 0.9
+
+
+    def test_flat_or_missing_audio_interpolates_linearly(cls):
+        """
+        Test that silent segments (ptp == 0) and segments past the end of the audio fall back to linear timesteps
+        """
+        frame_rate = 10.0
+        envelope = np.concatenate([np.full(10, 0.5), np.arange(10, dtype=float)])
+
+        silent = timesteps_from_envelope(envelope, frame_rate, offset=0.0, duration=0.9, fps=10)
+        assert np.allclose(silent, np.linspace(0.0, 1.0, 9))
+
+        past_the_end = timesteps_from_envelope(envelope, frame_rate, offset=5.0, duration=1.0, fps=10)
+        assert np.allclose(past_the_end, np.linspace(0.0, 1.0, 10))
+        assert not np.any(np.isnan(past_the_end))
+
+
+    def test_get_timesteps_arr_matches_single_span_analysis(cls, tmp_path):
+        """
+        Test that get_timesteps_arr still gives the timesteps the old per segment analysis did
+        """
+        path = click_track(tmp_path / 'clicks.wav')
+
+        for offset, duration in [(0.0, 4.0), (0.5, 2.0)]:
+            expected = single_span_timesteps(path, offset, duration, fps=8, smooth=0.1)
+            assert np.allclose(get_timesteps_arr(path, offset, duration, fps=8, smooth=0.1), expected)
+
+
+    def test_envelope_is_analysed_once(cls, tmp_path):
+        """
+        Test that the envelope of the same audio and parameters comes from the cache, keyed by the given key
+        """
+        path = click_track(tmp_path / 'clicks.wav')
+
+        envelope, frame_rate = audio_onset_envelope(path, offset=0.0, duration=4.0, key='cdn-id')
+        assert frame_rate == 22050 / AUDIO_HOP_LENGTH
+        assert audio_onset_envelope(path, offset=0.0, duration=4.0, key='cdn-id')[0] is envelope
+        assert audio_onset_envelope(path, offset=0.0, duration=4.0, key='other-id')[0] is not envelope
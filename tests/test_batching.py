@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from batching import InferenceBatcher
+
+
+def run_concurrently(batcher, submissions):
+    results = [None] * len(submissions)
+
+    def submit(i, key, run_batch, request):
+        try:
+            results[i] = batcher.submit(key, run_batch, request)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i, *submission)) for i, submission in enumerate(submissions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestInferenceBatcher:
+
+    def test_coalesces_compatible_requests(cls):
+        """
+        Test that compatible requests inside the wait window run as one batch and get their own results back
+        """
+        batches = []
+
+        def run_batch(requests):
+            batches.append(list(requests))
+            return [request.upper() for request in requests]
+
+        batcher = InferenceBatcher(max_batch_size=4, max_wait=0.5)
+        results = run_concurrently(batcher, [('512x512', run_batch, prompt) for prompt in ['a', 'b', 'c', 'd']])
+
+        assert results == ['A', 'B', 'C', 'D']
+        assert len(batches) == 1
+        assert sorted(batches[0]) == ['a', 'b', 'c', 'd']
+
+
+    def test_splits_incompatible_requests(cls):
+        """
+        Test that requests with different keys never share a batch
+        """
+        batches = []
+
+        def run_batch(requests):
+            batches.append(list(requests))
+            return requests
+
+        batcher = InferenceBatcher(max_batch_size=4, max_wait=0.2)
+        results = run_concurrently(batcher, [
+            ('512x512', run_batch, '512-a'),
+            ('768x768', run_batch, '768-a'),
+            ('512x512', run_batch, '512-b'),
+        ])
+
+        assert results == ['512-a', '768-a', '512-b']
+        for batch in batches:
+            assert len(set(request.split('-')[0] for request in batch)) == 1
+
+
+    def test_respects_max_batch_size(cls):
+        """
+        Test that no batch is larger than max_batch_size
+        """
+        sizes = []
+
+        def run_batch(requests):
+            sizes.append(len(requests))
+            return requests
+
+        batcher = InferenceBatcher(max_batch_size=2, max_wait=0.2)
+        results = run_concurrently(batcher, [('key', run_batch, i) for i in range(5)])
+
+        assert results == list(range(5))
+        assert max(sizes) <= 2
+        assert sum(sizes) == 5
+
+
+    def test_errors_reach_every_request(cls):
+        """
+        Test that an exception raised by a batch is re-raised to each of its callers
+        """
+        def run_batch(requests):
+            raise RuntimeError('CUDA out of memory')
+
+        batcher = InferenceBatcher(max_batch_size=4, max_wait=0.2)
+        results = run_concurrently(batcher, [('key', run_batch, i) for i in range(3)])
+
+        assert all(isinstance(result, RuntimeError) for result in results)
+        with pytest.raises(RuntimeError):
+            batcher.submit('key', run_batch, 0)
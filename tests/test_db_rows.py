@@ -0,0 +1,84 @@
+import os
+import db
+import json
+import time
+import decimal
+import datetime
+
+import pytest
+
+# (name, type_code) pairs shaped like a psycopg2 cursor.description
+DESCRIPTION = [
+    ('id', 23),
+    ('email', 1043),
+    ('is_verified', 16),
+    ('metadata', 114),
+    ('amount', 1700),
+    ('created_at', 1114),
+    ('expires_at', 1114),
+]
+COLUMNS = [column[0] for column in DESCRIPTION]
+
+# timings only, they depend on the machine, run with RUN_BENCHMARKS=1 python -m pytest -s
+benchmark = pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason='set RUN_BENCHMARKS=1 to run benchmarks')
+
+
+def make_rows(n):
+    rows = []
+    for i in range(n):
+        rows.append((
+            i,
+            f'user{i}@example.com',
+            i % 2 == 0,
+            {'rewards_referral_verify': True, 'nested': {'index': i}},
+            decimal.Decimal('12.25'),
+            datetime.datetime(2023, 7, 1, 12, 30, 15, 123456) + datetime.timedelta(minutes=i),
+            None if i % 3 == 0 else datetime.datetime(2023, 8, 1) + datetime.timedelta(days=i),
+        ))
+    return rows
+
+
+# pandas is only a test dependency (pip install pandas), the comparisons are skipped without it
+def pandas_records(rows):
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame.from_records(rows, columns=COLUMNS, coerce_float=True)
+    return json.loads(df.to_json(orient='records'))
+
+
+class TestRowMapping:
+
+    def test_matches_pandas_json(cls):
+        """
+        Test that mapped rows serialise to the same JSON the pandas round-trip produced
+        """
+        rows = make_rows(10)
+        assert json.dumps(db.map_rows(DESCRIPTION, rows)) == json.dumps(pandas_records(rows))
+
+
+    def test_dates_are_epoch_ms(cls):
+        """
+        Test that timestamps become epoch milliseconds and nulls stay null
+        """
+        row = db.map_rows(DESCRIPTION, make_rows(1))[0]
+        assert row['created_at'] == 1688214615123
+        assert row['expires_at'] is None
+        assert row['amount'] == 12.25
+        assert row['metadata']['nested']['index'] == 0
+
+
+    @benchmark
+    def test_per_row_cost(cls):
+        """
+        Benchmark the per-row cost of the row mapper against the pandas round-trip it replaced
+        """
+        rows = make_rows(10000)
+
+        start = time.perf_counter()
+        db.map_rows(DESCRIPTION, rows)
+        mapper_cost = (time.perf_counter() - start) / len(rows)
+
+        start = time.perf_counter()
+        pandas_records(rows)
+        pandas_cost = (time.perf_counter() - start) / len(rows)
+
+        print(f'\nrow mapper: {mapper_cost * 1e6:.2f}us/row, pandas round-trip: {pandas_cost * 1e6:.2f}us/row')
@@ -0,0 +1,80 @@
+import os
+
+from disk_cache import DiskCache
+
+
+class TestDiskCache:
+
+    def test_round_trip(cls, tmp_path):
+        """
+        Test that stored blobs (bytes or chunks) are read back and counted as hits, unknown keys as misses
+        """
+        cache = DiskCache(str(tmp_path), max_bytes=1024)
+
+        assert cache.get('audio/1/a-full.mp3') is None
+        cache.put('audio/1/a-full.mp3', b'abc')
+        path = cache.put('image/1/b-full.png', iter([b'de', b'f']))
+
+        assert cache.get('audio/1/a-full.mp3') == b'abc'
+        assert path.endswith('.png')
+        with open(cache.path('image/1/b-full.png'), 'rb') as file:
+            assert file.read() == b'def'
+
+        stats = cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 2
+
+
+    def test_evicts_least_recently_used(cls, tmp_path):
+        """
+        Test that going over max_bytes removes the least recently used files first
+        """
+        cache = DiskCache(str(tmp_path), max_bytes=20)
+        cache.put('a', b'x' * 10)
+        cache.put('b', b'x' * 10)
+        os.utime(cache.path('b'), (1, 1))
+        os.utime(cache.path('a'), (2, 2))
+
+        cache.put('c', b'x' * 10)
+
+        assert cache.path('b') is None
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+        assert cache.stats()['evictions'] == 1
+
+
+    def test_entry_evicted_before_open_is_a_miss(cls, tmp_path):
+        """
+        Test that an entry removed (e.g. evicted by another process) after it was looked up reads as a miss, not an error,
+        and that a file opened before its eviction stays readable
+        """
+        cache = DiskCache(str(tmp_path), max_bytes=1024)
+        path = cache.put('audio/1/a-full.mp3', b'abc')
+
+        file = cache.open('audio/1/a-full.mp3')
+        os.remove(path)
+        with file:
+            assert file.read() == b'abc'
+
+        assert cache.open('audio/1/a-full.mp3') is None
+        assert cache.get('audio/1/a-full.mp3') is None
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+
+
+    def test_overwrite_replaces_the_old_size(cls, tmp_path):
+        """
+        Test that storing a key again counts only the new entry's size
+        """
+        cache = DiskCache(str(tmp_path), max_bytes=100)
+        cache.put('a', b'x' * 10)
+        cache.put('b', b'x' * 5)
+        assert cache.stats()['bytes'] == 15
+
+        cache.put('a', b'y' * 12)
+        cache.put('a', b'z' * 8)
+
+        assert cache.stats()['bytes'] == 13
+        assert cache.get('a') == b'z' * 8
+        assert cache.get('b') == b'x' * 5
@@ -0,0 +1,93 @@
+import time
+import threading
+
+import pytest
+
+from frame_writer import FrameWriter
+
+
+class FakePipeline:
+    """Stands in for Image2ImageWalkPipeline: frames are strings, 'emitting' one records it in the sink."""
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.release = threading.Event()
+        self.release.set()
+
+    def load_frame(self, frame, upsample=False):
+        return frame.upper() if upsample else frame
+
+    def emit_frame(self, image, frame_index, sink=None, save_path=None, image_file_ext=".png"):
+        self.release.wait()
+        if image == self.fail_on:
+            raise ValueError(f'cannot encode {image}')
+        sink.append((frame_index, image, save_path))
+
+
+class TestFrameWriter:
+
+    def test_writes_frames_in_order(cls):
+        """
+        Test that frames of every batch reach the sink in the order they were queued, converted and with their save_path
+        """
+        sink = []
+        with FrameWriter(FakePipeline(), sink) as writer:
+            writer.put([(0, 'a', False), (1, 'b', True)], save_path='clip_0')
+            writer.put([(2, 'c', False)], save_path='clip_1')
+
+        assert sink == [(0, 'a', 'clip_0'), (1, 'B', 'clip_0'), (2, 'c', 'clip_1')]
+        assert set(writer.timings) >= {'convert', 'encode', 'queue_wait'}
+
+
+    def test_bounded_queue_holds_the_producer_back(cls):
+        """
+        Test that put blocks once max_batches batches are waiting behind the one being written
+        """
+        pipeline = FakePipeline()
+        pipeline.release.clear()
+        sink = []
+        writer = FrameWriter(pipeline, sink, max_batches=1)
+
+        # the worker takes the first batch and blocks on it, the second fills the queue
+        writer.put([(0, 'a', False)])
+        writer.put([(1, 'b', False)])
+
+        blocked = threading.Thread(target=writer.put, args=([(2, 'c', False)],))
+        blocked.start()
+        blocked.join(timeout=0.2)
+        assert blocked.is_alive()
+
+        pipeline.release.set()
+        blocked.join(timeout=5)
+        assert not blocked.is_alive()
+        writer.close()
+        assert [frame for _, frame, _ in sink] == ['a', 'b', 'c']
+
+
+    def test_worker_errors_are_raised_to_the_producer(cls):
+        """
+        Test that a failure on the worker thread is raised by the next put, and by close
+        """
+        writer = FrameWriter(FakePipeline(fail_on='b'), [])
+        writer.put([(0, 'a', False), (1, 'b', False)])
+        deadline = time.monotonic() + 5
+        while writer.error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with pytest.raises(ValueError):
+            writer.put([(2, 'c', False)])
+        with pytest.raises(ValueError):
+            writer.close()
+        assert not writer.thread.is_alive()
+
+
+    def test_exit_on_exception_stops_the_worker(cls):
+        """
+        Test that leaving the with block on an exception stops the worker and keeps the original exception
+        """
+        with pytest.raises(KeyError):
+            with FrameWriter(FakePipeline(fail_on='a'), []) as writer:
+                writer.put([(0, 'a', False)])
+                raise KeyError('denoising failed')
+
+        assert not writer.thread.is_alive()
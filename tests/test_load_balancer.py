@@ -0,0 +1,170 @@
+import random
+
+from load_balancer import LoadBalancer, model_path
+
+
+def make_balancer(*addresses):
+    balancer = LoadBalancer(stale_after=5, rng=random.Random(0))
+    balancer.set_hosts(list(addresses))
+    return balancer
+
+
+class TestLoadBalancer:
+
+    def test_routes_to_least_outstanding_work(cls):
+        """
+        Test that with fresh load reports the host with the fewest requests in flight and queued jobs is picked
+        """
+        balancer = make_balancer('a', 'b', 'c')
+        balancer.report_load('a', {'in_flight': 3, 'queued_jobs': 0}, now=0)
+        balancer.report_load('b', {'in_flight': 1, 'queued_jobs': 4}, now=0)
+        balancer.report_load('c', {'in_flight': 1, 'queued_jobs': 1}, now=0)
+
+        assert balancer.pick(now=1).address == 'c'
+
+        # requests sent since the last report count as well
+        for _ in range(3):
+            balancer.start(balancer.hosts['c'])
+        assert balancer.pick(now=1).address == 'a'
+
+
+    def test_latency_breaks_ties(cls):
+        """
+        Test that equally loaded hosts are told apart by their latency moving average
+        """
+        balancer = make_balancer('a', 'b')
+        for address in ['a', 'b']:
+            balancer.report_load(address, {'in_flight': 0, 'queued_jobs': 0}, now=0)
+
+        balancer.start(balancer.hosts['a'])
+        balancer.finish(balancer.hosts['a'], latency=10)
+        balancer.start(balancer.hosts['b'])
+        balancer.finish(balancer.hosts['b'], latency=2)
+
+        assert balancer.pick(now=1).address == 'b'
+
+
+    def test_falls_back_to_power_of_two_choices(cls):
+        """
+        Test that without fresh reports the busiest host never wins a power of two choices draw
+        """
+        balancer = make_balancer('a', 'b', 'c')
+        balancer.report_load('a', {'in_flight': 0, 'queued_jobs': 0}, now=0)
+        for _ in range(5):
+            balancer.start(balancer.hosts['a'])
+        balancer.start(balancer.hosts['b'])
+
+        picks = {balancer.pick(now=100).address for _ in range(50)}
+        assert 'a' not in picks
+
+
+    def test_latency_moving_average(cls):
+        """
+        Test that the latency moving average weighs new samples by latency_alpha and failures don't count
+        """
+        balancer = make_balancer('a')
+        host = balancer.hosts['a']
+
+        for latency in [1.0, 2.0, None]:
+            balancer.start(host)
+            balancer.finish(host, latency=latency)
+
+        assert abs(host.latency - 1.2) < 1e-9
+        assert host.in_flight == 0
+        assert host.errors == 1
+
+
+    def test_prefers_hosts_with_the_model_loaded(cls):
+        """
+        Test that a model's requests go to a host with it on the GPU, before one with it offloaded, before the least loaded host
+        """
+        balancer = make_balancer('a', 'b', 'c')
+        balancer.report_load('a', {'in_flight': 0, 'queued_jobs': 0, 'models': {}}, now=0)
+        balancer.report_load('b', {'in_flight': 1, 'queued_jobs': 0, 'models': {'Text to Image/model': 'cpu'}}, now=0)
+        balancer.report_load('c', {'in_flight': 2, 'queued_jobs': 0, 'models': {'Text to Image/model': 'gpu'}}, now=0)
+
+        assert balancer.pick(model=model_path('Text to Image', 'model'), now=1).address == 'c'
+        assert balancer.pick(model=model_path('Text to Image', 'other'), now=1).address == 'a'
+
+        balancer.report_load('c', {'in_flight': 2, 'queued_jobs': 0, 'models': {}}, now=0)
+        assert balancer.pick(model=model_path('Text to Image', 'model'), now=1).address == 'b'
+        assert balancer.affinity_hits == 2
+        assert balancer.affinity_misses == 1
+
+
+    def test_affinity_gives_way_to_overloaded_hosts(cls):
+        """
+        Test that a host with the model loaded but affinity_slack more requests outstanding than the least loaded one is skipped
+        """
+        balancer = make_balancer('a', 'b')
+        balancer.report_load('a', {'in_flight': 0, 'queued_jobs': 0, 'models': {}}, now=0)
+        balancer.report_load('b', {'in_flight': 2, 'queued_jobs': 1, 'models': {'ControlNet/Depth/model': 'gpu'}}, now=0)
+
+        assert balancer.pick(model=model_path('ControlNet Depth', 'model'), now=1).address == 'a'
+
+
+    def test_circuit_breaker_takes_failing_hosts_out(cls):
+        """
+        Test that failure_threshold consecutive failures stop routing to a host, until a half-open trial succeeds
+        """
+        balancer = LoadBalancer(failure_threshold=2, reset_timeout=30, rng=random.Random(0))
+        balancer.set_hosts(['a', 'b'])
+        a = balancer.hosts['a']
+
+        balancer.record_health(a, False, now=0)
+        assert a.breaker.allows(now=0)
+        balancer.record_health(a, False, now=0)
+        assert {balancer.pick(now=1).address for _ in range(20)} == {'b'}
+        assert balancer.pick(now=1, exclude=['b']) is None
+
+        # half-open after reset_timeout, a single trial request goes through
+        host = balancer.pick(now=31, exclude=['b'])
+        assert host is a
+        balancer.start(a)
+        assert balancer.pick(now=31, exclude=['b']) is None
+
+        balancer.finish(a, latency=1)
+        balancer.record_health(a, True)
+        assert a.breaker.state == 'closed'
+        assert balancer.pick(now=32, exclude=['b']) is a
+
+
+    def test_failed_trial_reopens_breaker(cls):
+        """
+        Test that a failing half-open trial opens the breaker again and probes don't close it early
+        """
+        balancer = LoadBalancer(failure_threshold=1, reset_timeout=30)
+        balancer.set_hosts(['a'])
+        a = balancer.hosts['a']
+
+        balancer.record_health(a, False, now=0)
+        balancer.record_probe(a, True, now=10)
+        assert a.breaker.state == 'open'
+
+        assert a.breaker.allows(now=30)
+        balancer.record_health(a, False, now=30)
+        assert not a.breaker.allows(now=40)
+        assert a.breaker.opened == 2
+
+
+    def test_abandoned_requests_dont_count_against_the_host(cls):
+        """
+        Test that requests cancelled by their client neither open the breaker nor count as errors, and free the trial
+        """
+        balancer = LoadBalancer(failure_threshold=1, reset_timeout=30)
+        balancer.set_hosts(['a'])
+        a = balancer.hosts['a']
+
+        for _ in range(3):
+            balancer.start(a)
+            balancer.cancel(a)
+        assert a.breaker.state == 'closed'
+        assert a.in_flight == 0
+        assert a.errors == 0
+
+        # an abandoned trial lets the next request be the trial
+        balancer.record_health(a, False, now=0)
+        balancer.start(balancer.pick(now=30))
+        assert balancer.pick(now=30) is None
+        balancer.cancel(a)
+        assert balancer.pick(now=30) is a
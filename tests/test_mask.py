@@ -0,0 +1,87 @@
+import os
+import time
+import base64
+
+import numpy as np
+import pytest
+
+from PIL import Image
+
+from utils import mask_from_base_64
+
+
+# timings only, they depend on the machine, run with RUN_BENCHMARKS=1 python -m pytest -s
+benchmark = pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason='set RUN_BENCHMARKS=1 to run benchmarks')
+
+
+def encode_mask(mask):
+    return base64.b64encode(np.packbits(mask.flatten()).tobytes()).decode()
+
+
+# the per-pixel putpixel loop control_net_mask used to run
+def putpixel_mask(base64_mask, width, height):
+    boolean_mask = np.unpackbits(np.frombuffer(base64.b64decode(base64_mask), dtype=np.uint8)).astype(bool)
+    mask_image = Image.new('RGB', (width, height), (0, 0, 0))
+    for y in range(height):
+        for x in range(width):
+            if boolean_mask[y * width + x]:
+                mask_image.putpixel((x, y), (255, 255, 255))
+    return mask_image
+
+
+class TestMaskFromBase64:
+
+    def test_matches_putpixel_loop(cls):
+        """
+        Test that the vectorized mask is pixel for pixel the image the putpixel loop produced, including a padded last byte
+        """
+        rng = np.random.default_rng(0)
+        width, height = 67, 45 # 3015 pixels, not a multiple of 8
+        mask = rng.random((height, width)) > 0.5
+        base64_mask = encode_mask(mask)
+
+        image = mask_from_base_64(base64_mask, width, height)
+        assert image.mode == 'RGB'
+        assert image.size == (width, height)
+        assert np.array_equal(np.asarray(image), np.asarray(putpixel_mask(base64_mask, width, height)))
+
+
+    def test_rejects_mismatched_size(cls):
+        """
+        Test that a mask packed for a different image size is rejected
+        """
+        base64_mask = encode_mask(np.ones((64, 64), dtype=bool))
+
+        with pytest.raises(ValueError):
+            mask_from_base_64(base64_mask, 64, 65)
+        with pytest.raises(ValueError):
+            mask_from_base_64(base64_mask, 64, 63)
+
+
+    def test_rejects_set_padding_bits(cls):
+        """
+        Test that padding bits past width * height must be zero
+        """
+        base64_mask = base64.b64encode(bytes([0xff, 0xff])).decode()
+
+        with pytest.raises(ValueError):
+            mask_from_base_64(base64_mask, 3, 4) # 12 pixels, 4 padding bits set
+
+
+    @benchmark
+    def test_benchmark(cls):
+        """
+        Benchmark the vectorized mask against the putpixel loop on a 768x768 mask
+        """
+        width, height = 768, 768
+        base64_mask = encode_mask(np.random.default_rng(0).random((height, width)) > 0.5)
+
+        start = time.perf_counter()
+        mask_from_base_64(base64_mask, width, height)
+        vectorized = time.perf_counter() - start
+
+        start = time.perf_counter()
+        putpixel_mask(base64_mask, width, height)
+        loop = time.perf_counter() - start
+
+        print(f'\nvectorized: {vectorized * 1e3:.2f}ms, putpixel loop: {loop * 1e3:.2f}ms')
@@ -0,0 +1,145 @@
+from model_manager import ModelManager
+
+
+class FakeModel:
+
+    def __init__(self, size):
+        self.size = size
+        self.device = 'cuda'
+
+    def to(self, device):
+        self.device = device
+        return self
+
+
+def make_manager(gpu_budget=0, cpu_budget=0):
+    return ModelManager(gpu_budget=gpu_budget, cpu_budget=cpu_budget, measure=lambda models: sum(model.size for model in models))
+
+
+class TestModelManager:
+
+    def test_loads_on_first_use(cls):
+        """
+        Test that models are only loaded when first used and counted as hits afterwards
+        """
+        loads = []
+        manager = make_manager()
+        manager.register_model(('Text to Image', 'model'), lambda: loads.append(1) or FakeModel(10))
+
+        assert len(loads) == 0
+        with manager.use('Text to Image', 'model') as model:
+            assert model.size == 10
+        with manager.use('Text to Image', 'model'):
+            pass
+
+        stats = manager.stats()['models']['Text to Image/model']
+        assert len(loads) == 1
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+
+
+    def test_group_shares_one_load(cls):
+        """
+        Test that paths registered as one group are loaded together
+        """
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return {('Text to Image', 'base'): FakeModel(5), ('Image to Image', 'base'): FakeModel(5)}
+
+        manager = make_manager()
+        manager.register('base', loader, paths=[('Text to Image', 'base'), ('Image to Image', 'base')])
+
+        with manager.use('Text to Image', 'base'):
+            pass
+        with manager.use('Image to Image', 'base'):
+            pass
+
+        assert len(loads) == 1
+
+
+    def test_evicts_least_recently_used(cls):
+        """
+        Test that going over the GPU budget offloads the least recently used group to CPU, and over the CPU budget drops it
+        """
+        manager = make_manager(gpu_budget=20, cpu_budget=10)
+        manager.register_model(('Text to Image', 'a'), lambda: FakeModel(10), offload=True)
+        manager.register_model(('Text to Image', 'b'), lambda: FakeModel(10), offload=True)
+        manager.register_model(('Upscale', 'c'), lambda: FakeModel(10), offload=True)
+
+        with manager.use('Text to Image', 'a') as a:
+            pass
+        with manager.use('Text to Image', 'b'):
+            pass
+        with manager.use('Upscale', 'c'):
+            pass
+
+        models = manager.stats()['models']
+        assert models['Text to Image/a']['tier'] == 'cpu'
+        assert a.device == 'cpu'
+        assert models['Text to Image/b']['tier'] == 'gpu'
+
+        # using a again restores it to the GPU and pushes b, now the least recently used, out to the CPU
+        with manager.use('Text to Image', 'a'):
+            pass
+
+        models = manager.stats()['models']
+        assert models['Text to Image/a']['tier'] == 'gpu'
+        assert models['Text to Image/a']['restores'] == 1
+        assert a.device == 'cuda'
+        assert models['Text to Image/b']['tier'] == 'cpu'
+        assert manager.stats()['cpu_bytes'] <= 10
+
+
+    def test_never_evicts_models_in_use(cls):
+        """
+        Test that a model being used is kept in place even when the budget is exceeded
+        """
+        manager = make_manager(gpu_budget=10)
+        manager.register_model(('Text to Image', 'a'), lambda: FakeModel(10))
+        manager.register_model(('Upscale', 'b'), lambda: FakeModel(10))
+
+        with manager.use('Text to Image', 'a'):
+            with manager.use('Upscale', 'b'):
+                assert manager.stats()['models']['Text to Image/a']['tier'] == 'gpu'
+
+        with manager.use('Upscale', 'b'):
+            pass
+        assert manager.stats()['models']['Text to Image/a']['tier'] is None
+
+
+    def test_evicts_outside_the_manager_lock(cls):
+        """
+        Test that victims are moved and memory released without holding the manager lock, and that the victim is marked evicting meanwhile
+        """
+        seen = []
+
+        class WatchedModel(FakeModel):
+            def to(self, device):
+                if device == 'cpu':
+                    seen.append(('to', manager._lock.locked(), manager._groups['Text to Image/a'].evicting))
+                return super().to(device)
+
+        manager = ModelManager(
+            gpu_budget=10,
+            measure=lambda models: sum(model.size for model in models),
+            release=lambda: seen.append(('release', manager._lock.locked()))
+        )
+        manager.register_model(('Text to Image', 'a'), lambda: WatchedModel(10), offload=True)
+        manager.register_model(('Upscale', 'b'), lambda: FakeModel(10))
+
+        with manager.use('Text to Image', 'a') as a:
+            pass
+        with manager.use('Upscale', 'b'):
+            pass
+
+        assert seen == [('to', False, True), ('release', False)]
+        assert a.device == 'cpu'
+        models = manager.stats()['models']
+        assert models['Text to Image/a']['tier'] == 'cpu'
+        assert models['Text to Image/a']['evicting'] is False
+
+        # the victim's group lock was handed back, so it can be restored
+        with manager.use('Text to Image', 'a'):
+            assert a.device == 'cuda'
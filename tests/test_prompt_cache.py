@@ -0,0 +1,60 @@
+import torch
+
+from prompt_cache import PromptEmbeddingCache
+
+
+class FakeTokenizer:
+
+    model_max_length = 4
+
+    def __call__(self, prompts, padding=None, max_length=None, truncation=None, return_tensors=None):
+        class Inputs:
+            input_ids = torch.tensor([[len(prompt), ord(prompt[0]) if prompt else 0, 0, 0] for prompt in prompts])
+            attention_mask = torch.ones(len(prompts), 4, dtype=torch.long)
+        return Inputs()
+
+
+class FakeTextEncoder(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.config = type('Config', (), {})()
+        self.device = torch.device('cpu')
+
+    def forward(self, input_ids, attention_mask=None):
+        self.calls.append(input_ids.shape[0])
+        return (input_ids.float().unsqueeze(-1).repeat(1, 1, 2),)
+
+
+class TestPromptEmbeddingCache:
+
+    def test_encodes_each_prompt_once(cls):
+        """
+        Test that cached prompts skip the encoder and repeats in a batch are encoded once, with embeddings in prompt order
+        """
+        cache = PromptEmbeddingCache(max_entries=8)
+        tokenizer, encoder = FakeTokenizer(), FakeTextEncoder()
+
+        first = cache.encode(tokenizer, encoder, ['a noun', '', 'a noun'])
+        second = cache.encode(tokenizer, encoder, ['', 'a noun'])
+
+        assert encoder.calls == [2]
+        assert first.shape == (3, 4, 2)
+        assert torch.equal(first[0], second[1])
+        assert torch.equal(first[1], second[0])
+        assert cache.stats()['hits'] == 2
+
+
+    def test_keys_by_text_encoder(cls):
+        """
+        Test that the same prompt is encoded again by a different text encoder, and the LRU is bounded
+        """
+        cache = PromptEmbeddingCache(max_entries=1)
+        tokenizer, encoder_a, encoder_b = FakeTokenizer(), FakeTextEncoder(), FakeTextEncoder()
+
+        cache.encode(tokenizer, encoder_a, 'a noun')
+        cache.encode(tokenizer, encoder_b, 'a noun')
+
+        assert encoder_b.calls == [1]
+        assert cache.stats()['entries'] == 1
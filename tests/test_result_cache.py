@@ -0,0 +1,48 @@
+from disk_cache import DiskCache
+from result_cache import ResultCache, request_key
+
+
+REQUEST = {
+    'model_id': 'stabilityai/stable-diffusion-2-1',
+    'inference_mode': 'Text to Image',
+    'prompt': 'a noun',
+    'negative_prompt': '',
+    'steps': 25,
+    'seed': 42,
+    'aspect_ratio': '768:768',
+    'samples': 1
+}
+
+
+class TestResultCache:
+
+    def test_request_key(cls):
+        """
+        Test that requests differing only in number formatting share a key, any parameter or input change doesn't
+        """
+        key = request_key(REQUEST)
+
+        assert request_key(dict(REQUEST, steps='25', seed='42')) == key
+        assert request_key(dict(REQUEST, seed=43)) != key
+        assert request_key(dict(REQUEST, prompt='a nouns')) != key
+        assert request_key(dict(REQUEST, base_64='aW1hZ2U=')) != request_key(dict(REQUEST, base_64='aW1hZ2Uy'))
+        assert request_key(dict(REQUEST, seed=None)) is None
+
+
+    def test_lru_and_disk_tier(cls, tmp_path):
+        """
+        Test that evicted entries are still found on disk and invalidated ones are gone from both tiers
+        """
+        cache = ResultCache(max_entries=1, disk=DiskCache(str(tmp_path), max_bytes=1024))
+        cache.put('a', 'hash-a')
+        cache.put('b', 'hash-b')
+
+        assert cache.get('b') == 'hash-b'
+        assert cache.get('a') == 'hash-a'
+        cache.invalidate('a')
+        assert cache.get('a') is None
+
+        stats = cache.stats()
+        assert stats['memory_hits'] == 1
+        assert stats['disk_hits'] == 1
+        assert stats['misses'] == 1
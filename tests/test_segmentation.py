@@ -0,0 +1,60 @@
+import numpy as np
+
+from PIL import Image
+
+import utils
+from utils import PALETTE, colorize_segmentation, segment_image
+
+
+# the per-label masked assignment segmentation maps used to be coloured with
+def loop_colorize(seg):
+    color_seg = np.zeros((seg.shape[0], seg.shape[1], 3), dtype=np.uint8)
+    for label, color in enumerate(PALETTE):
+        color_seg[seg == label, :] = color
+    return color_seg
+
+
+class FakeSegmentor:
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, pixel_values):
+        self.calls += 1
+        return pixel_values
+
+
+class FakeProcessor:
+
+    def __call__(self, image, return_tensors=None):
+        class Inputs:
+            pixel_values = np.asarray(image)[:, :, 0]
+        return Inputs()
+
+    def post_process_semantic_segmentation(self, outputs, target_sizes=None):
+        return [np.asarray(outputs) % len(PALETTE)]
+
+
+class TestSegmentation:
+
+    def test_palette_gather_matches_label_loop(cls):
+        """
+        Test that the PALETTE gather colours every label like the per-label loop did
+        """
+        seg = np.random.default_rng(0).integers(0, len(PALETTE), size=(96, 128))
+        assert np.array_equal(colorize_segmentation(seg), loop_colorize(seg))
+
+
+    def test_results_are_cached_by_image(cls):
+        """
+        Test that segmenting the same image twice only runs the segmentor once
+        """
+        utils.SEGMENTATION_CACHE.clear()
+        segmentor = FakeSegmentor()
+        image = Image.fromarray(np.random.default_rng(1).integers(0, 255, size=(32, 48, 3), dtype=np.uint8))
+
+        first = segment_image(FakeProcessor(), segmentor, image)
+        second = segment_image(FakeProcessor(), segmentor, image.copy())
+
+        assert segmentor.calls == 1
+        assert np.array_equal(np.asarray(first), np.asarray(second))
@@ -0,0 +1,68 @@
+import numpy as np
+import torch
+
+from utils import slerp_batch
+
+
+# the per frame slerp Image2ImageWalkPipeline.generate_inputs used to call, via numpy on the CPU
+def numpy_slerp(t, v0, v1, DOT_THRESHOLD=0.9995):
+    input_device = v0.device
+    v0 = v0.cpu().numpy()
+    v1 = v1.cpu().numpy()
+
+    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+    if np.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * v0 + t * v1
+    else:
+        theta_0 = np.arccos(dot)
+        sin_theta_0 = np.sin(theta_0)
+        theta_t = theta_0 * t
+        sin_theta_t = np.sin(theta_t)
+        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = sin_theta_t / sin_theta_0
+        v2 = s0 * v0 + s1 * v1
+
+    return torch.from_numpy(v2).to(input_device)
+
+
+def frame_by_frame(T, v0, v1):
+    return torch.cat([numpy_slerp(float(t), v0, v1) for t in T])
+
+
+class TestSlerpBatch:
+
+    def test_matches_per_frame_slerp(cls):
+        """
+        Test that interpolating a whole batch at once matches the per frame numpy slerp for noise-like inputs
+        """
+        generator = torch.Generator().manual_seed(0)
+        v0 = torch.randn((1, 4, 16, 16), generator=generator)
+        v1 = torch.randn((1, 4, 16, 16), generator=generator)
+        T = np.sort(np.random.default_rng(0).random(7))
+
+        batched = slerp_batch(T, v0, v1)
+        assert batched.shape == (7, 4, 16, 16)
+        assert torch.allclose(batched, frame_by_frame(T, v0, v1), atol=1e-5)
+
+
+    def test_nearly_parallel_inputs_lerp(cls):
+        """
+        Test that inputs past DOT_THRESHOLD take the linear interpolation branch, like the per frame slerp
+        """
+        v0 = torch.randn((1, 4, 8, 8), generator=torch.Generator().manual_seed(1))
+        v1 = v0 * 2 + 1e-4
+        T = np.linspace(0.0, 1.0, 5)
+
+        batched = slerp_batch(T, v0, v1)
+        assert torch.allclose(batched, frame_by_frame(T, v0, v1), atol=1e-5)
+        assert torch.allclose(batched[-1:], v1, atol=1e-5)
+
+
+    def test_keeps_dtype(cls):
+        """
+        Test that half precision inputs come back in half precision
+        """
+        v0 = torch.randn((1, 4, 8, 8)).half()
+        v1 = torch.randn((1, 4, 8, 8)).half()
+
+        assert slerp_batch(np.linspace(0.0, 1.0, 3), v0, v1).dtype == torch.float16
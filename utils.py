@@ -8,6 +8,8 @@ import sys
 import json
 import time
 import torch
+import hashlib
+import threading
 import base64
 import shutil
 import dropbox
@@ -19,6 +21,7 @@ import tempfile
 
 from PIL import Image
 from io import BytesIO 
+from collections import OrderedDict
 from flask import send_file
 from dropbox.exceptions import AuthError
 
@@ -64,8 +67,8 @@ INFERENCE_MODES = [
     'Image to Image',
     'Pix to Pix'
 ]
+# ADE20K colours the segmentation ControlNets were trained on, UperNet label i is drawn as PALETTE[i]
 PALETTE = np.asarray([
-    [0, 0, 0],
     [120, 120, 120],
     [180, 120, 120],
     [6, 230, 230],
@@ -216,7 +219,58 @@ PALETTE = np.asarray([
     [25, 194, 194],
     [102, 255, 0],
     [92, 0, 255],
-])
+], dtype=np.uint8)
+
+# number of segmentation maps kept by segment_image, keyed by image hash
+SEGMENTATION_CACHE_SIZE = int(config.get('segmentation_cache_size', 32))
+
+#######################################################
+#################### SEGMENTATION #####################
+#######################################################
+
+SEGMENTATION_CACHE = OrderedDict()
+SEGMENTATION_CACHE_LOCK = threading.Lock()
+
+
+def image_hash(image):
+
+    digest = hashlib.sha256('{}:{}x{}:'.format(image.mode, *image.size).encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+# Colour a (height, width) label map with PALETTE in a single gather, on the label map's device if it is a tensor
+def colorize_segmentation(seg):
+
+    if isinstance(seg, torch.Tensor):
+        palette = torch.as_tensor(PALETTE, device=seg.device)
+        return palette[seg.long()].cpu().numpy()
+    return PALETTE[np.asarray(seg)]
+
+
+# Segment an image with UperNet and return the colourised map as an image, results are cached by image hash
+def segment_image(image_processor, image_segmentor, image):
+
+    key = image_hash(image)
+    with SEGMENTATION_CACHE_LOCK:
+        if key in SEGMENTATION_CACHE:
+            SEGMENTATION_CACHE.move_to_end(key)
+            return SEGMENTATION_CACHE[key].copy()
+
+    pixel_values = image_processor(image, return_tensors="pt").pixel_values
+    with torch.no_grad():
+        outputs = image_segmentor(pixel_values)
+    seg = image_processor.post_process_semantic_segmentation(outputs, target_sizes=[image.size[::-1]])[0]
+    seg_image = Image.fromarray(colorize_segmentation(seg))
+
+    if SEGMENTATION_CACHE_SIZE > 0:
+        with SEGMENTATION_CACHE_LOCK:
+            SEGMENTATION_CACHE[key] = seg_image
+            while len(SEGMENTATION_CACHE) > SEGMENTATION_CACHE_SIZE:
+                SEGMENTATION_CACHE.popitem(last=False)
+
+    return seg_image.copy()
+
 
 #######################################################
 ####################### DROPBOX #######################
@@ -353,6 +407,27 @@ def image_from_base_64(base64_string):
     return Image.open(BytesIO(base64.b64decode(image_data)))
 
 
+def mask_from_base_64(base64_mask, width, height):
+    """Decode a base64 `numpy.packbits` mask (row-major, one bit per pixel) into a black / white RGB image.
+
+    packbits pads the last byte with zero bits, so the mask must be exactly ceil(width * height / 8)
+    bytes long and any padding bits must be 0.
+    """
+
+    n_pixels = width * height
+    packed = np.frombuffer(base64.b64decode(base64_mask), dtype=np.uint8)
+    expected_bytes = (n_pixels + 7) // 8
+    if packed.size != expected_bytes:
+        raise ValueError('Mask has {} bytes, expected {} for a {}x{} image'.format(packed.size, expected_bytes, width, height))
+
+    bits = np.unpackbits(packed)
+    if bits[n_pixels:].any():
+        raise ValueError('Mask has non-zero padding bits, it doesn\'t match a {}x{} image'.format(width, height))
+
+    mask = bits[:n_pixels].reshape(height, width) * np.uint8(255)
+    return Image.fromarray(mask).convert('RGB')
+
+
 def thumbnail_bytes_for_image(image):
     
     buffer = io.BytesIO()
@@ -419,6 +494,29 @@ def _hide_seek(obj):
     return _wrapper(obj)
 
 
+# Spherically interpolate v0 and v1 (a batch of one each) at every t in T in one device side operation, returns
+# len(T) rows stacked on the batch dimension. Nearly parallel inputs fall back to a linear interpolation, like the
+# per frame numpy slerp did. Computed in float32 and returned in the inputs' dtype
+def slerp_batch(T, v0, v1, DOT_THRESHOLD=0.9995):
+    t = torch.as_tensor(T, dtype=torch.float32, device=v0.device).reshape(-1, *([1] * (v0.dim() - 1)))
+    v0_32 = v0.float()
+    v1_32 = v1.float()
+
+    # one scalar for the whole tensor pair, so a single host sync per batch
+    dot = torch.sum(v0_32 * v1_32 / (torch.linalg.norm(v0_32) * torch.linalg.norm(v1_32)))
+    if torch.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * v0_32 + t * v1_32
+    else:
+        theta_0 = torch.arccos(dot)
+        sin_theta_0 = torch.sin(theta_0)
+        theta_t = theta_0 * t
+        s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = torch.sin(theta_t) / sin_theta_0
+        v2 = s0 * v0_32 + s1 * v1_32
+
+    return v2.to(v0.dtype)
+
+
 def cv2_to_pil(img):
     converted = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     pil = Image.fromarray(converted).convert('RGB')
@@ -429,27 +527,39 @@ def pil_to_bytes(img):
     img.save(img_byte_arr, format='PNG')
     return img_byte_arr.getvalue()
 
-def extract_start_and_end_frames(video_bytes):
-    with tempfile.NamedTemporaryFile() as temp:
-        temp.write(video_bytes)
-        cap = cv2.VideoCapture(temp.name)
+def extract_start_and_end_frames(video_path):
+    cap = cv2.VideoCapture(video_path)
+
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
 
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
+    duration = round(total_frames / fps, 1)
 
-        duration = round(total_frames / fps, 1)
+    # Get the first frame
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    _, first_frame = cap.read()
 
-        # Get the first frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        _, first_frame = cap.read()
+    first_frame = cv2_to_pil(first_frame)
 
-        first_frame = cv2_to_pil(first_frame)
+    # Get the last frame
+    cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 1)
+    _, last_frame = cap.read()
 
-        # Get the last frame
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 1)
-        _, last_frame = cap.read()
+    last_frame = cv2_to_pil(last_frame)
 
-        last_frame = cv2_to_pil(last_frame)
+    cap.release()
+    return first_frame, last_frame, duration
 
-        cap.release()
-        return first_frame, last_frame, duration
\ No newline at end of file
+
+# copy an uploaded file (werkzeug FileStorage, already spooled to disk by the multipart parser) to a temp file in
+# chunks, returns its path. The caller owns the file and must remove it
+def spool_upload_to_file(file_storage):
+    suffix = os.path.splitext(file_storage.filename or '')[1]
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            shutil.copyfileobj(file_storage.stream, file, 1024 * 1024)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
@@ -6,49 +6,114 @@ import inspect
 from diffusers.pipelines.stable_diffusion import StableDiffusionPipelineOutput
 import numpy as np
 from random import randint
-from stable_diffusion_videos import make_video_pyav
 import PIL
 from transformers import pipeline
 import json 
 import time
 import librosa
+import av
 
 import tempfile
 import cv2
 import requests
 
 from pathlib import Path
+from contextlib import nullcontext
+
+from utils import cv2_to_pil, slerp_batch
+from prompt_cache import PROMPT_CACHE
+from frame_writer import FrameWriter
+from audio_timesteps import audio_onset_envelope, timesteps_from_envelope, get_timesteps_arr
+
+
+class Keyframe:
+    """One image of a walk, shared by the segments ending and starting on it.
+
+    Its caption (when no prompt is given), prompt embedding, VAE latent and noise are
+    computed once by `Image2ImageWalkPipeline.prepare_keyframe` and reused by the next
+    segment, so every keyframe is encoded once and both segments meet on the same latent
+    and noise.
+    """
+
+    def __init__(self, image, prompt=None, seed=None):
+        self.image = image
+        self.prompt = prompt
+        self.seed = seed
+
+        self.embeds = None
+        self.latents = None
+        self.noise = None
+
+
+class VideoFrameSink:
+    """Encodes frames straight into one H.264 mp4 as they are generated.
+
+    The video stream is opened on the first frame with its size, later frames of another size
+    (e.g. upsampled ones) are resized to it. The audio span, if any, is decoded and muxed
+    once in `close`. Frames never touch the disk unless the walk is asked to keep PNGs.
+    """
+
+    def __init__(self, output_filepath, fps=30, audio_filepath=None, audio_offset=0, audio_duration=None, sr=44100, crf=10):
+        self.output_filepath = str(output_filepath)
+        self.fps = fps
+        self.audio_filepath = audio_filepath
+        self.audio_offset = audio_offset
+        self.audio_duration = audio_duration
+        self.sr = sr
+        self.crf = crf
+
+        self.container = av.open(self.output_filepath, mode="w")
+        self.video_stream = None
+        # streams must all be added before the first packet is muxed
+        self.audio_stream = self.container.add_stream("aac", rate=sr, layout="mono") if audio_filepath else None
+
+        self.frames = 0
+
+    def _open_video_stream(self, width, height):
+        self.video_stream = self.container.add_stream("libx264", rate=self.fps)
+        # yuv420p needs even dimensions
+        self.video_stream.width = width - width % 2
+        self.video_stream.height = height - height % 2
+        self.video_stream.pix_fmt = "yuv420p"
+        self.video_stream.options = {"crf": str(self.crf)}
+
+    def write(self, image):
+        if self.video_stream is None:
+            self._open_video_stream(*image.size)
+        size = (self.video_stream.width, self.video_stream.height)
+        if image.size != size:
+            image = image.resize(size, resample=PIL.Image.LANCZOS)
+
+        frame = av.VideoFrame.from_image(image.convert("RGB"))
+        self.container.mux(self.video_stream.encode(frame))
+        self.frames += 1
+
+    def _mux_audio(self):
+        audio, _ = librosa.load(self.audio_filepath, sr=self.sr, mono=True, offset=self.audio_offset, duration=self.audio_duration)
+        frame_size = self.audio_stream.codec_context.frame_size or 1024
+        for start in range(0, audio.shape[0], frame_size):
+            chunk = audio[start:start + frame_size]
+            frame = av.AudioFrame.from_ndarray(chunk.reshape(1, -1).astype(np.float32), format="fltp", layout="mono")
+            frame.sample_rate = self.sr
+            frame.pts = start
+            self.container.mux(self.audio_stream.encode(frame))
+        self.container.mux(self.audio_stream.encode())
+
+    # Flushes the encoders and muxes the audio, returns the path of the video
+    def close(self):
+        try:
+            if self.video_stream is not None:
+                self.container.mux(self.video_stream.encode())
+            if self.audio_stream is not None:
+                self._mux_audio()
+        finally:
+            self.container.close()
+        return self.output_filepath
+
+    # Closes the video without flushing, when the walk failed
+    def abort(self):
+        self.container.close()
 
-from utils import cv2_to_pil
-
-def get_timesteps_arr(audio_filepath, offset, duration, fps=30, margin=1.0, smooth=0.0, sr=None):
-    y, sr = librosa.load(audio_filepath, offset=offset, duration=duration, sr=sr)
-
-    # librosa.stft hardcoded defaults...
-    # n_fft defaults to 2048
-    # hop length is win_length // 4
-    # win_length defaults to n_fft
-    D = librosa.stft(y, n_fft=2048, hop_length=2048 // 4, win_length=2048)
-
-    # Extract percussive elements
-    D_harmonic, D_percussive = librosa.decompose.hpss(D, margin=margin)
-    y_percussive = librosa.istft(D_percussive, length=len(y))
-
-    # Get normalized melspectrogram
-    spec_raw = librosa.feature.melspectrogram(y=y_percussive, sr=sr)
-    spec_max = np.amax(spec_raw, axis=0)
-    spec_norm = (spec_max - np.min(spec_max)) / np.ptp(spec_max)
-
-    # Resize cumsum of spec norm to our desired number of interpolation frames
-    x_norm = np.linspace(0, spec_norm.shape[-1], spec_norm.shape[-1])
-    y_norm = np.cumsum(spec_norm)
-    y_norm /= y_norm[-1]
-    x_resize = np.linspace(0, y_norm.shape[-1], int(duration * fps))
-
-    T = np.interp(x_resize, x_norm, y_norm)
-
-    # Apply smoothing
-    return T * (1 - smooth) + np.linspace(0.0, 1.0, T.shape[0]) * smooth
 
 class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
 
@@ -58,17 +123,8 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         return self.captioner(image, max_new_tokens=70)[0]['generated_text']
     
     def prompt_to_embedding(self, prompt):
-        text_inputs = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
-        text_inputs = text_inputs.input_ids.to(self.text_encoder.device)
-        text_embeddings = self.text_encoder(text_inputs)[0]
-
-        return text_embeddings.detach()
+        # adjacent segments share their keyframe prompts, so most of these are cache hits
+        return PROMPT_CACHE.encode(self.tokenizer, self.text_encoder, prompt)
 
     @torch.no_grad()
     def __call__(
@@ -184,15 +240,7 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
             else:
                 uncond_tokens = negative_prompt
 
-            max_length = self.tokenizer.model_max_length
-            uncond_input = self.tokenizer(
-                uncond_tokens,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-            uncond_embeddings = self.text_encoder(uncond_input.input_ids.to(self.device))[0]
+            uncond_embeddings = PROMPT_CACHE.encode(self.tokenizer, self.text_encoder, uncond_tokens)
 
             # duplicate unconditional embeddings for each generation per prompt
             uncond_embeddings = uncond_embeddings.repeat_interleave(batch_size * num_images_per_prompt, dim=0)
@@ -352,39 +400,61 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         return (2.0 * image - 1.0).detach().to(dtype).to(self.device)
 
     
-    def generate_inputs(self, image_a, image_b, prompt_a, prompt_b, seed_a, seed_b, T, batch_size):
-        embeds_a = self.prompt_to_embedding(prompt_a)
-        embeds_b = self.prompt_to_embedding(prompt_b)
+    # computes whatever the keyframe is still missing, a no-op for keyframes an earlier segment already used
+    def prepare_keyframe(self, keyframe):
+        if keyframe.prompt is None or len(keyframe.prompt) == 0:
+            keyframe.prompt = self.image_to_caption(keyframe.image)
+        if keyframe.seed is None:
+            keyframe.seed = self.random_seed()
+        if keyframe.embeds is None:
+            keyframe.embeds = self.prompt_to_embedding(keyframe.prompt)
+        latents_dtype = keyframe.embeds.dtype
+        if keyframe.latents is None:
+            keyframe.latents = self.vae.encode(self.pil_preprocess(keyframe.image, latents_dtype)).latent_dist.sample().detach().to(self.device)
+        if keyframe.noise is None:
+            keyframe.noise = self.init_noise(keyframe.seed, keyframe.latents.shape, latents_dtype)
+        return keyframe
+
+    def generate_inputs(self, keyframe_a, keyframe_b, T, batch_size):
+        self.prepare_keyframe(keyframe_a)
+        self.prepare_keyframe(keyframe_b)
+        embeds_a, embeds_b = keyframe_a.embeds, keyframe_b.embeds
+        latents_a, latents_b = keyframe_a.latents, keyframe_b.latents
+        noise_a, noise_b = keyframe_a.noise, keyframe_b.noise
         latents_dtype = embeds_a.dtype
 
-        latents_a = self.vae.encode(self.pil_preprocess(image_a, latents_dtype)).latent_dist.sample().detach().to(self.device)
-        latents_b = self.vae.encode(self.pil_preprocess(image_b, latents_dtype)).latent_dist.sample().detach().to(self.device)
-        noise_shape = latents_a.shape
-
-        noise_a = self.init_noise(seed_a, noise_shape, latents_dtype)
-        noise_b = self.init_noise(seed_b, noise_shape, latents_dtype)
+        # every frame of a batch is interpolated at once on the device, instead of a numpy round trip per frame
+        for batch_idx, start in enumerate(range(0, T.shape[0], batch_size)):
+            T_batch = T[start:start + batch_size]
+            t = torch.as_tensor(T_batch, dtype=latents_dtype, device=embeds_a.device).reshape(-1, 1, 1)
 
-        batch_idx = 0
-        embeds_batch, noise_batch, latents_batch = None, None, None
+            embeds_batch = embeds_a + t * (embeds_b - embeds_a)
+            # embeds_batch = slerp_batch(T_batch, embeds_a, embeds_b)
+            noise_batch = slerp_batch(T_batch, noise_a, noise_b)
+            latents_batch = slerp_batch(T_batch, latents_a, latents_b)
 
-        for i, t in enumerate(T):
-            embeds = torch.lerp(embeds_a, embeds_b, t)
-            # embeds = self.slerp(float(t), embeds_a, embeds_b)
-            noise = self.slerp(float(t), noise_a, noise_b)
-            latents = self.slerp(float(t), latents_a, latents_b)
-
-            embeds_batch = embeds if embeds_batch is None else torch.cat([embeds_batch, embeds])
-            noise_batch = noise if noise_batch is None else torch.cat([noise_batch, noise])
-            latents_batch = latents if latents_batch is None else torch.cat([latents_batch, latents])
-            batch_is_ready = embeds_batch.shape[0] == batch_size or i + 1 == T.shape[0]
-            if not batch_is_ready:
-                continue
             yield batch_idx, embeds_batch, noise_batch, latents_batch
-            batch_idx += 1
             del embeds_batch, noise_batch, latents_batch
             torch.cuda.empty_cache()
-            embeds_batch, noise_batch, latents_batch = None, None, None
     
+    # PIL image of a queued frame: a decoded (height, width, 3) array, a PIL image or the path of a saved frame
+    def load_frame(self, frame, upsample=False):
+        if isinstance(frame, (str, Path)):
+            with PIL.Image.open(frame) as saved:
+                frame = saved.convert("RGB")
+        elif isinstance(frame, np.ndarray):
+            frame = self.numpy_to_pil(frame)[0]
+        if upsample:
+            frame = self.upsampler(frame)
+        return frame
+
+    # Hands a frame to the video sink, and saves it as a PNG (or image_file_ext) under save_path if given
+    def emit_frame(self, image, frame_index, sink=None, save_path=None, image_file_ext=".png"):
+        if save_path is not None:
+            image.save(save_path / (f"frame%06d{image_file_ext}" % frame_index))
+        if sink is not None:
+            sink.write(image)
+
     def get_small_divisor(self, num, max):
         candidates = list(range(1, max + 1, 1))
         candidates.reverse()
@@ -394,14 +464,11 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
 
     def make_clip_frames(
         self,
-        image_a,
-        image_b,
-        prompt_a,
-        prompt_b,
-        seed_a,
-        seed_b,
+        keyframe_a: Keyframe,
+        keyframe_b: Keyframe,
         num_interpolation_steps: int = 5,
-        save_path: Union[str, Path] = "outputs/",
+        save_path: Optional[Union[str, Path]] = None,
+        writer: Optional[FrameWriter] = None,
         num_inference_steps: int = 50,
         guidance_scale: float = 7.5,
         eta: float = 0.0,
@@ -416,8 +483,9 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         step: Optional[Tuple[int, int]] = None,
     ):
 
-        save_path = Path(save_path)
-        save_path.mkdir(parents=True, exist_ok=True)
+        if save_path is not None:
+            save_path = Path(save_path)
+            save_path.mkdir(parents=True, exist_ok=True)
 
         T = T if T is not None else np.linspace(0.0, 1.0, num_interpolation_steps)
         if T.shape[0] != num_interpolation_steps:
@@ -429,53 +497,57 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         
         print('using capped batch size:', capped_batch_size)
 
+        image_a = keyframe_a.image
+        image_b = keyframe_b.image
         batch_generator = self.generate_inputs(
-            image_a,
-            image_b,
-            prompt_a,
-            prompt_b,
-            seed_a,
-            seed_b,
+            keyframe_a,
+            keyframe_b,
             # (1, self.unet.in_channels, height // 8, width // 8),
             T[skip:],
             capped_batch_size,
         )
 
         frame_index = skip
-        for batch_idx, embeds_batch, noise_batch, latents_batch in batch_generator:
-            outputs = self(
-                prompt=embeds_batch,
-                init_latent=latents_batch,
-                strength=0.75,
-                guidance_scale=guidance_scale,
-                noise=noise_batch,
-                num_inference_steps = num_inference_steps
-            )['images']
-
-            print(f'generated: {(batch_idx + 1) * capped_batch_size} / {len(T)}')
-
-            for image_idx, image in enumerate(outputs):
-                if frame_index == skip and image_idx == 0:
-                    frame_filepath = save_path / (f"frame%06d{image_file_ext}" % frame_index)
-                    image_a.save(frame_filepath)
-                    frame_index += 1
-                elif (batch_idx + 1) * capped_batch_size == len(T) and image_idx + 1 == len(outputs):
-                    frame_filepath = save_path / (f"frame%06d{image_file_ext}" % (frame_index))
-                    image_b.save(frame_filepath)
-                    frame_index += 1
-                else:
-                    frame_filepath = save_path / (f"frame%06d{image_file_ext}" % frame_index)
-                    image = image if not upsample else self.upsampler(image)
-                    image.save(frame_filepath)
+        # frames are written by the writer's thread while the next batch is denoised
+        with (nullcontext(writer) if writer is not None else FrameWriter(self)) as writer:
+            start = time.perf_counter()
+            for batch_idx, embeds_batch, noise_batch, latents_batch in batch_generator:
+                writer.add_time('inputs', time.perf_counter() - start)
+
+                start = time.perf_counter()
+                outputs = self(
+                    prompt=embeds_batch,
+                    init_latent=latents_batch,
+                    strength=0.75,
+                    guidance_scale=guidance_scale,
+                    noise=noise_batch,
+                    num_inference_steps = num_inference_steps,
+                    output_type="np",
+                )['images']
+                writer.add_time('denoise', time.perf_counter() - start)
+
+                print(f'generated: {(batch_idx + 1) * capped_batch_size} / {len(T)}')
+
+                frames = []
+                for image_idx, image in enumerate(outputs):
+                    if frame_index == skip and image_idx == 0:
+                        frames.append((frame_index, image_a, False))
+                    elif (batch_idx + 1) * capped_batch_size == len(T) and image_idx + 1 == len(outputs):
+                        frames.append((frame_index, image_b, False))
+                    else:
+                        frames.append((frame_index, image, upsample))
                     frame_index += 1
+                writer.put(frames, save_path, image_file_ext)
+                start = time.perf_counter()
 
-    def embed_video(self, video_url, fps, save_path, skip, width, height, image_file_ext='.png'):
-        save_path = Path(save_path)
-        save_path.mkdir(parents=True, exist_ok=True)
+    def embed_video(self, video_url, fps, save_path, skip, width, height, image_file_ext='.png', writer=None):
+        if save_path is not None:
+            save_path = Path(save_path)
+            save_path.mkdir(parents=True, exist_ok=True)
 
         r = requests.get(video_url, stream=True)
         # download video
-        with tempfile.NamedTemporaryFile() as temp:
+        with tempfile.NamedTemporaryFile() as temp, (nullcontext(writer) if writer is not None else FrameWriter(self)) as writer:
             for chunk in r.iter_content(chunk_size = 1024 * 1024):
                 if chunk:
                     temp.write(chunk)
@@ -505,8 +577,7 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
                     # frame
                     frame_pil = cv2_to_pil(frame)
                     frame_pil = frame_pil.resize((width, height), resample=PIL.Image.LANCZOS)
-                    frame_filepath = save_path / (f"frame%06d{image_file_ext}" % (skip + frame_counter))
-                    frame_pil.save(frame_filepath)
+                    writer.put([(skip + frame_counter, frame_pil, False)], save_path, image_file_ext)
                     frame_counter += 1
 
             cap.release()
@@ -531,10 +602,12 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         resume: Optional[bool] = False,
         audio_filepath: str = None,
         audio_start_sec: Optional[Union[int, float]] = None,
+        audio_cache_key: Optional[str] = None,
         margin: Optional[float] = 1.0,
         smooth: Optional[float] = 0.0,
         negative_prompt: Optional[str] = None,
         make_video: Optional[bool] = True,
+        save_frames: Optional[bool] = False,
     ):
         """Generate a video from a sequence of prompts and seeds. Optionally, add audio to the
         video to interpolate to the intensity of the audio.
@@ -581,6 +654,8 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
                 Optional path to an audio file to influence the interpolation rate.
             audio_start_sec (Optional[Union[int, float]], *optional*, defaults to 0):
                 Global start time of the provided audio_filepath.
+            audio_cache_key (Optional[str], *optional*, defaults to None):
+                Identifies the audio (e.g. its cdn_id) in the onset envelope cache. Defaults to the file's path.
             margin (Optional[float], *optional*, defaults to 1.0):
                 Margin from librosa hpss to use for audio interpolation.
             smooth (Optional[float], *optional*, defaults to 0.0):
@@ -588,10 +663,12 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
             negative_prompt (Optional[str], *optional*, defaults to None):
                 Optional negative prompt to use. Same across all prompts.
             make_video (Optional[bool], *optional*, defaults to True):
-                When True, makes a video from the generated frames. If False, only
-                generates the frames.
+                When True, encodes the generated frames into a video as they are generated.
+            save_frames (Optional[bool], *optional*, defaults to False):
+                When True, also saves every frame as an image, for debugging and to `resume` from.
+                Always True when resuming or when `make_video` is False.
 
-        This function will create sub directories for each prompt and seed pair.
+        With `save_frames`, this function will create sub directories for each prompt and seed pair.
 
         For example, if you provide the following prompts and seeds:
 
@@ -613,19 +690,17 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         │   │   ├── frame000000.png
         │   │   ├── ...
         │   │   ├── frame000004.png
-        │   │   ├── name_000000.mp4
         │   ├── name_000001
         │   │   ├── frame000000.png
         │   │   ├── ...
         │   │   ├── frame000004.png
-        │   │   ├── name_000001.mp4
         │   ├── ...
         │   ├── name.mp4
         |   |── prompt_config.json
         ```
 
         Returns:
-            str: The resulting video filepath. This video includes all sub directories' video clips.
+            str: The resulting video filepath, None if `make_video` is False.
         """
         # 0. Default height and width to unet
         first_image_height = images[0].size[1]
@@ -643,6 +718,9 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
         # Where the final video of all the clips combined will be saved
         output_filepath = save_path_root / f"{name}.mp4"
 
+        # frames already on disk are what a resumed walk picks up from, and all there is without a video
+        save_frames = save_frames or resume or not make_video
+
         # If using same number of interpolation steps between, we turn into list
         if not resume and isinstance(num_interpolation_steps, int):
             num_interpolation_steps = [num_interpolation_steps] * (len(images) - 1)
@@ -686,137 +764,127 @@ class Image2ImageWalkPipeline(StableDiffusionWalkPipeline):
             audio_start_sec = data["audio_start_sec"]
             negative_prompt = data.get("negative_prompt", None)
         
-        prompt_a = None
-        prompt_b = None
-        seed_a = None
-        seed_b = None
-
-        for i, (image_a, image_b, num_step) in enumerate(
-            zip(images, images[1:], num_interpolation_steps)
-        ):
-
-            # {name}_000000 / {name}_000001 / ...
-            save_path = save_path_root / f"{name}_{i:06d}"
-
-            # Where the individual clips will be saved
-            step_output_filepath = save_path / f"{name}_{i:06d}.mp4"
-
-            # Determine if we need to resume from a previous run
-            skip = 0
-            if resume:
-                if step_output_filepath.exists():
-                    print(f"Skipping {save_path} because frames already exist")
-                    continue
-
-                existing_frames = sorted(save_path.glob(f"*{image_file_ext}"))
-                if existing_frames:
-                    skip = int(existing_frames[-1].stem[-6:]) + 1
-                    if skip + 1 >= num_step:
-                        print(f"Skipping {save_path} because frames already exist")
-                        continue
-                    print(f"Resuming {save_path.name} from frame {skip}")
-
-            audio_offset = audio_start_sec + sum(num_interpolation_steps[:i]) / fps
-            audio_duration = num_step / fps
-
-            # resize images
-            image_a_re = image_a.resize((width, height), resample=PIL.Image.LANCZOS)
-            image_b_re = image_b.resize((width, height), resample=PIL.Image.LANCZOS)
-
-            # get prompts
-            if prompts is not None:
-                start_index = i
-                if start_index < len(prompts):
-                    prompt_a = prompts[start_index]
-                if start_index + 1 < len(prompts):
-                    prompt_b = prompts[start_index + 1]
-                
-            # generate if not found
-            if prompt_a is None or len(prompt_a) == 0:
-                prompt_a = self.image_to_caption(image_a_re)
-            if prompt_b is None or len(prompt_b) == 0:
-                prompt_b = self.image_to_caption(image_b_re)
-
-            video_a = False
-            video_b = False
-            if video_urls is not None:
-                if video_urls[i] is not None:
-                    video_a = True
-                if video_urls[i + 1] is not None:
-                    video_b = True
-            
-            # generate seeds
-            seed_a = self.random_seed()
-            seed_b = self.random_seed()
-
-            if video_a and video_b:
-                self.embed_video(
-                    video_url=video_urls[i],
-                    fps=fps,
-                    save_path=save_path,
-                    skip=skip,
-                    width=width,
-                    height=height
-                )
-            else:
-                self.make_clip_frames(
-                    image_a_re,
-                    image_b_re,
-                    prompt_a,
-                    prompt_b,
-                    seed_a,
-                    seed_b,
-                    num_interpolation_steps=num_step,
-                    save_path=save_path,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    eta=eta,
-                    height=height,
-                    width=width,
-                    upsample=upsample,
-                    batch_size=batch_size,
-                    T=get_timesteps_arr(
-                        audio_filepath,
-                        offset=audio_offset,
-                        duration=audio_duration,
-                        fps=fps,
-                        margin=margin,
-                        smooth=smooth,
-                    )
-                    if audio_filepath
-                    else None,
-                    skip=skip,
-                    negative_prompt=negative_prompt,
-                    step=(i, len(images) - 1),
-                )
-
-            # update prompts
-            prompt_a = prompt_b
-            prompt_b = None
+        # one per image, resized, with its prompt if given. Captions, embeddings, latents and seeds are filled in
+        # on first use and shared by the two segments around the keyframe
+        keyframes = [
+            Keyframe(
+                image.resize((width, height), resample=PIL.Image.LANCZOS),
+                prompt=prompts[index] if prompts is not None and index < len(prompts) else None,
+            )
+            for index, image in enumerate(images)
+        ]
+
+        # analyse the audio of the whole video once, each segment's timesteps are sliced from it
+        if audio_filepath:
+            audio_envelope, audio_frame_rate = audio_onset_envelope(
+                audio_filepath,
+                offset=audio_start_sec,
+                duration=sum(num_interpolation_steps) / fps,
+                margin=margin,
+                key=audio_cache_key,
+            )
 
-            # update seeds
-            seed_a = seed_b
-            seed_b = None
-    
-            if make_video:
-                make_video_pyav(
-                    save_path,
-                    audio_filepath=audio_filepath,
-                    fps=fps,
-                    output_filepath=step_output_filepath,
-                    glob_pattern=f"*{image_file_ext}",
-                    audio_offset=audio_offset,
-                    audio_duration=audio_duration,
-                    sr=44100,
-                )
+        # every frame goes straight into one encoder, the audio is muxed in when it's closed
+        sink = None
         if make_video:
-            return make_video_pyav(
-                save_path_root,
-                audio_filepath=audio_filepath,
+            sink = VideoFrameSink(
+                output_filepath,
                 fps=fps,
+                audio_filepath=audio_filepath,
                 audio_offset=audio_start_sec,
                 audio_duration=sum(num_interpolation_steps) / fps,
-                output_filepath=output_filepath,
-                glob_pattern=f"**/*{image_file_ext}",
                 sr=44100,
-            )
\ No newline at end of file
+            )
+
+        # frames are converted and encoded on the writer's thread, overlapping the denoising of the next batch
+        writer = FrameWriter(self, sink)
+        try:
+            with writer:
+                for i, (keyframe_a, keyframe_b, num_step) in enumerate(
+                    zip(keyframes, keyframes[1:], num_interpolation_steps)
+                ):
+
+                    # {name}_000000 / {name}_000001 / ...
+                    save_path = save_path_root / f"{name}_{i:06d}" if save_frames else None
+
+                    # Determine if we need to resume from a previous run, the frames already saved are encoded again
+                    skip = 0
+                    if resume:
+                        existing_frames = sorted(save_path.glob(f"*{image_file_ext}"))
+                        if sink is not None:
+                            # paths, each frame is only opened when the writer gets to it
+                            writer.put([(None, frame_filepath, False) for frame_filepath in existing_frames])
+                        if existing_frames:
+                            skip = int(existing_frames[-1].stem[-6:]) + 1
+                            if skip + 1 >= num_step:
+                                print(f"Skipping {save_path} because frames already exist")
+                                continue
+                            print(f"Resuming {save_path.name} from frame {skip}")
+
+                    audio_offset = audio_start_sec + sum(num_interpolation_steps[:i]) / fps
+                    audio_duration = num_step / fps
+
+                    video_a = False
+                    video_b = False
+                    if video_urls is not None:
+                        if video_urls[i] is not None:
+                            video_a = True
+                        if video_urls[i + 1] is not None:
+                            video_b = True
+
+                    if video_a and video_b:
+                        self.embed_video(
+                            video_url=video_urls[i],
+                            fps=fps,
+                            save_path=save_path,
+                            skip=skip,
+                            width=width,
+                            height=height,
+                            image_file_ext=image_file_ext,
+                            writer=writer,
+                        )
+                    else:
+                        self.make_clip_frames(
+                            keyframe_a,
+                            keyframe_b,
+                            num_interpolation_steps=num_step,
+                            save_path=save_path,
+                            writer=writer,
+                            num_inference_steps=num_inference_steps,
+                            guidance_scale=guidance_scale,
+                            eta=eta,
+                            height=height,
+                            width=width,
+                            upsample=upsample,
+                            batch_size=batch_size,
+                            image_file_ext=image_file_ext,
+                            T=timesteps_from_envelope(
+                                audio_envelope,
+                                audio_frame_rate,
+                                offset=audio_offset - audio_start_sec,
+                                duration=audio_duration,
+                                fps=fps,
+                                smooth=smooth,
+                            )
+                            if audio_filepath
+                            else None,
+                            skip=skip,
+                            negative_prompt=negative_prompt,
+                            step=(i, len(images) - 1),
+                        )
+
+                    # keyframe_a isn't used again
+                    keyframe_a.embeds, keyframe_a.latents, keyframe_a.noise = None, None, None
+        except BaseException:
+            if sink is not None:
+                sink.abort()
+            raise
+
+        if sink is not None:
+            start = time.perf_counter()
+            output_filepath = sink.close()
+            writer.add_time('encode', time.perf_counter() - start)
+
+        print('walk timings: ' + ', '.join(f'{stage} {seconds:.1f}s' for stage, seconds in writer.timings.items()))
+
+        return str(output_filepath) if make_video else None
\ No newline at end of file
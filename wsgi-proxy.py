@@ -1,4 +1,4 @@
-from proxy import app
+from proxy import app, run
 
 if __name__ == "__main__":
-    app.run()
+    run()